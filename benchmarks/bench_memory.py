@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure how much memory each route and NI Railways station takes, compared
+with how they used to be stored.
+
+Usage:
+
+    python benchmarks/bench_memory.py [-n ROUTES]
+
+Routes are built the way the scraper builds them, from freshly scraped
+text and timetable links, once as the old Route (a __dict__ and the whole
+re-encoded url per route) and once as the current one. The stations on a
+saved journeycheck page are loaded from a snapshot twice, as happens when
+the station list is refreshed, into plain dicts and into StationMapper.
+Needs Python 3 (tracemalloc).
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import io
+import json
+import os
+import sys
+import tracemalloc
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+from opentranslink import Service
+from opentranslink.routes import Route
+from opentranslink.services import nir
+from opentranslink.utils import parse_html
+from benchmarks.server import FIXTURES_DIR
+
+DEFAULT_ROUTES = 5000
+TIMETABLE_LINK = 'http://www.translink.co.uk/Services/Goldline-Service-Page/Timetable/?routeId=%d&outputFormat=1'
+
+
+class LegacyRoute(object):
+    """Route as it was stored before it had slots"""
+
+    def __init__(self, code, name, url):
+        self.code = code
+        self.name = name
+        self.url = url
+        self._timetable = None
+
+
+def legacy_fix_url_format(url):
+    qs = urlparse(url).query
+    temp = dict(parse_qsl(qs))
+    temp['outputFormat'] = 0
+    return url.replace(qs, urlencode(temp))
+
+
+def scraped(text):
+    # a new string, as every get_text() call on a page returns
+    return ''.join(list(text))
+
+
+def measure(build):
+    """Returns (bytes still allocated after build(), build's result)
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def build_routes(route_class, fix_url_format, n):
+    return [route_class(scraped(str(i % 400)), scraped('Belfast - Route %d' % (i % 400)),
+                        fix_url_format(scraped(TIMETABLE_LINK % i))) for i in range(n)]
+
+
+def station_snapshot():
+    with io.open(os.path.join(FIXTURES_DIR, 'journeycheck_departures.html'), encoding='utf-8') as f:
+        station_mapper = nir.parse_station_mapper(parse_html(f.read()))
+    return json.dumps({'stations': sorted(station_mapper.ids_and_names())})
+
+
+def load_stations_twice(data, mapper):
+    loaded = []
+    for _ in range(2):
+        pairs = [(k, v) for k, v in json.loads(data)['stations']]
+        if mapper:
+            loaded.append(nir.StationMapper.from_pairs(pairs))
+        else:
+            ids_to_names = dict(pairs)
+            loaded.append((ids_to_names, dict((v, k) for k, v in ids_to_names.items())))
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--routes', type=int, default=DEFAULT_ROUTES)
+    args = parser.parse_args()
+
+    service = Service('goldline')
+    stations = station_snapshot()
+    n_stations = len(json.loads(stations)['stations'])
+    cases = [
+        ('route', 'before', args.routes, lambda: build_routes(LegacyRoute, legacy_fix_url_format, args.routes)),
+        ('route', 'after', args.routes, lambda: build_routes(Route, service._fix_url_format, args.routes)),
+        ('station', 'before', n_stations, lambda: load_stations_twice(stations, False)),
+        ('station', 'after', n_stations, lambda: load_stations_twice(stations, True)),
+    ]
+
+    print('%-10s %-8s %10s %14s' % ('record', 'layout', 'count', 'bytes each'))
+    print('-' * 45)
+    for record, layout, count, build in cases:
+        size, result = measure(build)
+        print('%-10s %-8s %10d %14.1f' % (record, layout, count, float(size) / count))
+        del result
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
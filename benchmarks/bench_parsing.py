@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the HTML parser engines on saved timetable and route list pages, with
+and without restricting parsing to the elements we actually use.
+
+Usage:
+
+    python benchmarks/bench_parsing.py [-n ITERATIONS] [--timetable PAGE] [--routes PAGE]
+
+Pages default to the fixtures in tests/fixtures, pass real saved pages for
+representative numbers.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import sys
+import timeit
+
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+from bs4 import BeautifulSoup
+
+from opentranslink import Service
+from opentranslink.routes import TIMETABLE_STRAINER
+from opentranslink.routes import Timetable
+from opentranslink.services import ROUTES_STRAINER
+from opentranslink.utils import available_parsers
+
+FIXTURES_DIR = os.path.join(PARENT_DIR, 'tests', 'fixtures')
+
+
+def read_page(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def parse_timetable(markup, features, parse_only):
+    return Timetable('', BeautifulSoup(markup, features, parse_only=parse_only)).times
+
+
+def parse_routes(service, markup, features, parse_only):
+    soup = BeautifulSoup(markup, features, parse_only=parse_only)
+    routes, last_page = service._parse_routes_page(soup)
+    if not last_page:
+        service._parse_next_page_data(soup)
+    return routes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--timetable', default=os.path.join(FIXTURES_DIR, 'timetable.html'))
+    parser.add_argument('--routes', default=os.path.join(FIXTURES_DIR, 'routes_page1.html'))
+    args = parser.parse_args()
+
+    timetable_markup = read_page(args.timetable)
+    routes_markup = read_page(args.routes)
+    service = Service('goldline')
+
+    cases = [
+        ('timetable', TIMETABLE_STRAINER, lambda f, s: parse_timetable(timetable_markup, f, s)),
+        ('routes', ROUTES_STRAINER, lambda f, s: parse_routes(service, routes_markup, f, s)),
+    ]
+
+    print('%-10s %-12s %-10s %12s' % ('page', 'parser', 'strained', 'ms/page'))
+    print('-' * 47)
+    for page, strainer, func in cases:
+        for features in available_parsers():
+            for parse_only in (None, strainer):
+                seconds = timeit.timeit(lambda: func(features, parse_only), number=args.iterations)
+                print('%-10s %-12s %-10s %12.3f' % (
+                    page, features, 'yes' if parse_only else 'no', seconds * 1000 / args.iterations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time the scraping hot paths end to end and per phase against a local server
+replaying saved pages, and compare the results with stored baselines.
+
+Usage:
+
+    python benchmarks/bench_scraping.py [-n ITERATIONS] [--fixtures DIR]
+                                        [--baseline FILE] [--threshold FRACTION]
+                                        [--save-baseline]
+
+Each case is timed end to end through the public API and then phase by
+phase: fetch (the HTTP round trip), parse (building the soup) and transform
+(turning the soup into library objects). Departures are parsed while the
+page streams in, so that case reports parse and transform as one phase.
+
+The median of each timing is compared with the baseline file and the run
+exits non-zero if any is more than threshold slower. Baselines depend on the
+machine, regenerate them with --save-baseline on the one you benchmark on.
+Pages default to the fixtures in tests/fixtures, pass a directory of real
+saved pages using the same file names for representative numbers.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+from opentranslink import Service
+from opentranslink.cache import configure_parsed_cache
+from opentranslink.routes import TIMETABLE_STRAINER
+from opentranslink.routes import Timetable
+from opentranslink.services import ROUTES_STRAINER
+from opentranslink.services import nir
+from opentranslink.utils import configure_session
+from opentranslink.utils import fetch
+from opentranslink.utils import parse_html
+from benchmarks.server import FIXTURES_DIR
+from benchmarks.server import FixtureServer
+
+DEFAULT_BASELINE = os.path.join(THIS_DIR, 'baseline.json')
+DEFAULT_THRESHOLD = 0.25
+# differences smaller than this (in ms) are noise, whatever the percentage
+MIN_REGRESSION_MS = 0.5
+
+
+class Timer(object):
+    """Accumulates the time spent in each named phase of one run
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, phase, func, *args, **kwargs):
+        start = timeit.default_timer()
+        result = func(*args, **kwargs)
+        self.phases[phase] = self.phases.get(phase, 0) + timeit.default_timer() - start
+        return result
+
+
+def bench_routes(base_url, timer):
+    service = Service('goldline')
+    service.service_url = base_url + '/Routes-and-Timetables/goldline/'
+    timer('total', service.routes)
+
+    markup = timer('fetch', lambda: fetch('get', service.service_url).text)
+    while True:
+        soup = timer('parse', parse_html, markup, ROUTES_STRAINER)
+        routes, last_page = timer('transform', service._parse_routes_page, soup)
+        if last_page:
+            break
+        data = timer('transform', service._parse_next_page_data, soup)
+        markup = timer('fetch', lambda: fetch('post', service.service_url, data=data).text)
+
+
+def bench_timetable(base_url, timer):
+    url = base_url + '/Timetable/?routeId=212&outputFormat=1'
+    timer('total', lambda: Timetable(url).times)
+
+    markup = timer('fetch', lambda: fetch('get', url).text)
+    soup = timer('parse', parse_html, markup, TIMETABLE_STRAINER)
+    timer('transform', Timetable(url, soup)._parse_timetable)
+
+
+def bench_station_mapper(base_url, timer):
+    timer('total', nir.get_station_mapper)
+
+    browser = nir.build_browser()
+    markup = timer('fetch', browser.get_raw_page, nir.nir_stations_url)
+    soup = timer('parse', parse_html, markup)
+    timer('transform', nir.parse_station_mapper, soup)
+
+
+def bench_departures(base_url, timer, station_mapper):
+    timer('total', lambda: list(nir.get_departures_by_station_ids('GVA', 'BFC', station_mapper)))
+
+    browser = nir.build_browser()
+    markup = timer('fetch', browser.get_raw_page, nir.departures_url('GVA', 'BFC'))
+    timer('parse', lambda: list(nir.iter_departures([markup], 'GVA', station_mapper)))
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run(fixtures_dir, iterations):
+    """Returns {case: {phase: median ms}}
+    """
+
+    # every request should reach the server, and every page be parsed, not
+    # served from the response or parsed caches
+    configure_session(cache=False)
+    configure_parsed_cache(max_bytes=0)
+
+    with io.open(os.path.join(fixtures_dir, 'journeycheck_departures.html'), encoding='utf-8') as f:
+        station_mapper = nir.parse_station_mapper(parse_html(f.read()))
+
+    with FixtureServer(fixtures_dir) as server:
+        nir.nir_stations_url = server.url + '/nirailways/route?from=GVA&to=CLA&action=search&savedRoute='
+        nir.nir_departures_url_template = server.url + '/nirailways/route?from=%(src)s&to=%(dst)s&action=search&savedRoute='
+
+        cases = [
+            ('routes', lambda timer: bench_routes(server.url, timer)),
+            ('timetable', lambda timer: bench_timetable(server.url, timer)),
+            ('station_mapper', lambda timer: bench_station_mapper(server.url, timer)),
+            ('departures', lambda timer: bench_departures(server.url, timer, station_mapper)),
+        ]
+
+        results = {}
+        for case, func in cases:
+            # one untimed run to warm up the connection pool
+            func(Timer())
+            runs = []
+            for _ in range(iterations):
+                timer = Timer()
+                func(timer)
+                runs.append(timer.phases)
+            results[case] = dict((phase, round(median([r[phase] for r in runs]) * 1000, 3)) for phase in runs[0])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of (case, phase, baseline ms, ms) slower than threshold allows
+    """
+
+    regressions = []
+    for case, phases in sorted(results.items()):
+        for phase, ms in sorted(phases.items()):
+            expected = baseline.get(case, {}).get(phase)
+            if expected is None:
+                continue
+            if ms > expected * (1 + threshold) and ms - expected > MIN_REGRESSION_MS:
+                regressions.append((case, phase, expected, ms))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    results = run(args.fixtures, args.iterations)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with io.open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print('%-16s %-10s %12s %12s' % ('case', 'phase', 'ms', 'baseline'))
+    print('-' * 53)
+    for case, phases in sorted(results.items()):
+        for phase, ms in sorted(phases.items()):
+            expected = baseline.get(case, {}).get(phase)
+            print('%-16s %-10s %12.3f %12s' % (case, phase, ms, '-' if expected is None else '%.3f' % expected))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        print('\nsaved baseline to %s' % args.baseline)
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for case, phase, expected, ms in regressions:
+        print('\nREGRESSION %s %s: %.3f ms, baseline %.3f ms (+%d%%)' % (
+            case, phase, ms, expected, (ms / expected - 1) * 100))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
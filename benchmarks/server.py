@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for translink.co.uk and journeycheck.com, serving recorded
+fixture pages so the scrapers can be benchmarked end to end offline.
+"""
+from __future__ import print_function
+
+import io
+import os
+import threading
+try:
+    # python 3+
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from urllib.parse import parse_qs
+except ImportError:
+    # python 2+
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from urlparse import parse_qs
+
+THIS_DIR = os.path.dirname(__file__)
+FIXTURES_DIR = os.path.abspath(os.path.join(THIS_DIR, '..', 'tests', 'fixtures'))
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+
+    def _send_fixture(self, name):
+        with io.open(os.path.join(self.server.fixtures_dir, name), 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/nirailways/'):
+            self._send_fixture('journeycheck_departures.html')
+        elif self.path.startswith('/Timetable/'):
+            self._send_fixture('timetable.html')
+        else:
+            self._send_fixture('routes_page1.html')
+
+    def do_POST(self):
+        # postbacks carry the viewstate of the page they came from, which
+        # ends in that page's number on the fixture pages
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        viewstate = form.get('__VIEWSTATE', [''])[0]
+        page = int(viewstate.rsplit('page', 1)[-1] or 1) + 1
+        name = 'routes_page%d.html' % page
+        if not os.path.exists(os.path.join(self.server.fixtures_dir, name)):
+            self.send_error(404)
+            return
+        self._send_fixture(name)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer(object):
+    """
+    Serves fixtures_dir on a free local port in a background thread, use as
+    a context manager and read the base url from `url`
+    """
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR):
+        self.httpd = HTTPServer(('127.0.0.1', 0), FixtureHandler)
+        self.httpd.fixtures_dir = fixtures_dir
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
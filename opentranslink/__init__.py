@@ -5,9 +5,10 @@ from __future__ import absolute_import
 from . import services
 from .services import Service
 from .services import InvalidServiceError
+from .services import get_registry
 
 
-__all__ = ['InvalidServiceError', 'Service']
+__all__ = ['InvalidServiceError', 'Service', 'get_registry']
 
 
 __author__ = 'Patrick Carey, Lee Braiden'
@@ -0,0 +1,270 @@
+"""
+asyncio counterparts to the synchronous API, for use from inside an event
+loop. Pages are fetched with aiohttp and parsed in an executor so that
+BeautifulSoup never blocks the loop.
+
+Requires python 3.7+ and aiohttp (`pip install opentranslink[async]`).
+"""
+# stdlib imports
+import asyncio
+
+# third-party imports
+import aiohttp
+
+# local imports
+from . import metrics
+from .routes import Timetable
+from .services import ROUTES_STRAINER
+from .services import Service
+from .services import nir
+from .utils import DEFAULT_BACKOFF_FACTOR
+from .utils import DEFAULT_MAX_RETRIES
+from .utils import DEFAULT_POOL_SIZE
+from .utils import DEFAULT_TIMEOUT
+from .utils import RETRY_STATUS_CODES
+from .utils import RateLimiter
+from .utils import get_session
+from .utils import parse_html
+
+
+class AsyncResponse(object):
+    """A response read in full from aiohttp, with the attributes of a
+    requests.Response that ResponseCache.store needs
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+class AsyncHTTPSession(object):
+    """
+    Non-blocking counterpart to utils.HTTPSession: pooled keep-alive
+    connections, retries with exponential backoff, rate limiting and a
+    response cache with revalidation. Unless told otherwise the cache and
+    rate limiter are shared with the synchronous session, so both count
+    towards the same limit.
+
+    The underlying aiohttp session is created on first use so that it belongs
+    to the running event loop, call close() when finished with it.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 rate_limit=None, cache=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.cache = get_session().cache if cache is None else (cache or None)
+        # rate_limit is requests per second or a (Shared)RateLimiter, pass
+        # rate_limit=False to turn off the synchronous session's limit
+        if rate_limit is None:
+            self.rate_limiter = get_session().rate_limiter
+        elif hasattr(rate_limit, 'reserve'):
+            self.rate_limiter = rate_limit
+        else:
+            self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def request(self, method, url, cache_ttl=None, **kwargs):
+        """Make HTTP request, returning the body of the response and raising an
+        exception if it fails.
+
+        Responses are served from and stored in the session's cache (if it has
+        one), cache_ttl overrides how long this response stays fresh.
+        """
+        cache = self.cache
+        if cache is None or not cache.is_cacheable(method):
+            return (await self._request(method, url, **kwargs)).content
+
+        ttl = cache.ttl_for(url, cache_ttl)
+        if ttl <= 0:
+            return (await self._request(method, url, **kwargs)).content
+
+        key = cache.key(method, url, kwargs.get('params'), kwargs.get('data'))
+        entry = cache.get(key)
+        if entry is not None and entry.is_fresh(ttl):
+            cache.stats.incr('hits')
+            metrics.emit('cache_hits')
+            return entry.body
+
+        headers = cache.conditional_headers(entry, kwargs.get('headers'))
+        if headers is not None:
+            # stale, but we can ask upstream whether it's changed
+            kwargs['headers'] = headers
+            response = await self._request(method, url, **kwargs)
+            if response.status_code == 304:
+                cache.stats.incr('revalidations')
+                metrics.emit('cache_revalidations')
+                return cache.refresh(key, entry).body
+        else:
+            response = await self._request(method, url, **kwargs)
+
+        cache.stats.incr('misses')
+        metrics.emit('cache_misses')
+        cache.store(key, response)
+        return response.content
+
+    async def _request(self, method, url, **kwargs):
+        with metrics.timed('fetch'):
+            response = await self._request_with_retries(method, url, **kwargs)
+        metrics.emit('fetch_bytes', len(response.content))
+        return response
+
+    async def _request_with_retries(self, method, url, **kwargs):
+        session = self._get_session()
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                delay = self.rate_limiter.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    if response.status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                        response.raise_for_status()
+                        body = await response.read()
+                        return AsyncResponse(str(response.url), response.status, response.headers, body)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    raise
+            metrics.emit('retries')
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncService(object):
+    """
+    Async wrapper around the timetable provider for a service, sharing its
+    route list and timetables with the synchronous provider (available as
+    `provider`).
+    """
+
+    def __init__(self, service_name, session=None, executor=None):
+        self.provider = Service(service_name)
+        self.session = session if session is not None else AsyncHTTPSession()
+        self.executor = executor
+        self._routes_lock = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _parse_routes_page(self, markup):
+        soup = parse_html(markup, ROUTES_STRAINER)
+        routes, last_page = self.provider._parse_routes_page(soup)
+        next_page_data = None if last_page else self.provider._parse_next_page_data(soup)
+        return routes, next_page_data
+
+    def _parse_timetable(self, url, markup):
+        timetable = Timetable(url, page=markup)
+        # parse now, while we're off the event loop
+        timetable.times
+        return timetable
+
+    async def routes(self):
+        """
+        Fetch and parse the list of routes for this service, paging through
+        the route lists if necessary
+        """
+        provider = self.provider
+        if self._routes_lock is None:
+            self._routes_lock = asyncio.Lock()
+
+        # only let one caller walk the pages, everyone else waits for its result
+        async with self._routes_lock:
+            if provider._routes is not None:
+                return provider._routes
+
+            if provider.service_name in ['nir', 'enterprise']:
+                return provider._parse_train_routes_page(None)
+
+            markup = await self.session.request('get', provider.service_url)
+            routes, next_page_data = await self._run(self._parse_routes_page, markup)
+            while next_page_data is not None:
+                markup = await self.session.request('post', provider.service_url, data=next_page_data)
+                new_routes, next_page_data = await self._run(self._parse_routes_page, markup)
+                routes.extend(new_routes)
+
+            provider._routes = routes
+            return routes
+
+    async def route(self, code):
+        """returns the route that matches the given code or None if not found
+        """
+        await self.routes()
+        return self.provider.route(code)
+
+    async def timetable(self, route):
+        """
+        Returns the timetable for the given route, the async equivalent of
+        `route.timetable`
+        """
+        if route._timetable is None:
+            markup = await self.session.request('get', route.url)
+            route._timetable = await self._run(self._parse_timetable, route.url, markup)
+        return route._timetable.times
+
+    async def close(self):
+        await self.session.close()
+
+
+async def _fetch_nir_page(session, url, max_age):
+    return await session.request('get', url, headers=nir.Browser.headers, cache_ttl=max_age.total_seconds())
+
+
+async def get_station_mapper(session, executor=None):
+    """
+    Returns a StationMapper, which provides a mapping of all station ids and names
+    """
+    page = await _fetch_nir_page(session, nir.nir_stations_url, nir.MAX_CACHE_TIME)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, lambda: nir.parse_station_mapper(parse_html(page)))
+
+
+async def get_departures_by_station_ids(src_station_id, dst_station_id, station_mapper, session, executor=None):
+    """
+    Returns a list of upcoming departures from the given src_station_id, to the
+    given dst_station_id
+    """
+    url = nir.departures_url(src_station_id, dst_station_id)
+    page = await _fetch_nir_page(session, url, nir.DEPARTURES_CACHE_TIME)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, lambda: list(nir.parse_departures(parse_html(page), src_station_id, station_mapper)))
+
+
+async def departure_updates(poller, src_station_id=None, dst_station_id=None):
+    """
+    Async iterator over the DepartureUpdates pushed by a
+    nir_poller.DeparturePoller (optionally for one src and/or dst station),
+    which can be polling from another thread
+    """
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
+
+    def callback(update):
+        loop.call_soon_threadsafe(updates.put_nowait, update)
+
+    poller.subscribe(callback, src_station_id, dst_station_id)
+    try:
+        while True:
+            yield await updates.get()
+    finally:
+        poller.unsubscribe(callback)
@@ -0,0 +1,481 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import collections
+import hashlib
+import json
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+
+
+DEFAULT_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_PARSED_MAX_BYTES = 32 * 1024 * 1024
+
+# how long translink pages stay fresh when nothing else is configured, first
+# match wins: timetables rarely change, route lists a little more often, and
+# live departures (normally given their own ttl by the caller) hardly at all
+DEFAULT_TTLS = [
+    (r'/Timetable/|[?&]outputFormat=', 24 * 60 * 60),
+    (r'translink\.co\.uk/Routes-and-Timetables/', 60 * 60),
+    (r'journeycheck\.com/', 30),
+]
+
+# headers we keep alongside a cached body, everything else is dropped
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+class CacheEntry(object):
+    """A cached HTTP response body and the metadata needed to revalidate it.
+    """
+
+    def __init__(self, url, body, headers, stored_at):
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.stored_at = stored_at
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified')
+
+    def is_fresh(self, ttl, now=None):
+        return (now if now is not None else time.time()) - self.stored_at < ttl
+
+
+class CacheStats(object):
+    """Hit/miss counters for a cache, safe to update from many threads.
+    """
+
+    fields = ('hits', 'misses', 'revalidations', 'stores', 'evictions')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        for field in self.fields:
+            setattr(self, field, 0)
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def __repr__(self):
+        return '<opentranslink.CacheStats {0}>'.format(self.as_dict())
+
+
+class MemoryCache(object):
+    """In-process LRU cache backend, evicting the least recently used entries
+    once the total body size goes over max_bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-insert to mark as most recently used
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry.size
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+                self.stats.incr('evictions')
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache(object):
+    """On-disk cache backend keeping every entry in a single SQLite file,
+    evicting the least recently used entries once the total body size goes
+    over max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_DISK_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, url TEXT, headers TEXT, body BLOB, '
+                'stored_at REAL, accessed_at REAL, size INTEGER)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT url, headers, body, stored_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            with self._db:
+                self._db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        url, headers, body, stored_at = row
+        return CacheEntry(url, bytes(body), json.loads(headers), stored_at)
+
+    def set(self, key, entry):
+        import sqlite3
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (key, entry.url, json.dumps(entry.headers), sqlite3.Binary(entry.body),
+                     entry.stored_at, time.time(), entry.size)
+                )
+                self._evict()
+
+    def _evict(self):
+        size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        rows = self._db.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall()
+        for key, entry_size in rows:
+            if size <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            size -= entry_size
+            self.stats.incr('evictions')
+
+    def delete(self, key):
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM responses')
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+class ResponseCache(object):
+    """
+    Caches HTTP responses in one or more backends (fastest first, e.g. a
+    MemoryCache in front of an SQLiteCache).
+
+    How long a response stays fresh is taken from, in order: the ttl given
+    with the request, the first of `ttls` (a list of (url regex, seconds)
+    pairs, DEFAULT_TTLS unless given) matching the URL, then default_ttl.
+    Freshness is judged against the
+    ttl of the request being served, so callers wanting fresher data than
+    others can share the same entries. Responses with a ttl of 0 are not
+    cached. Stale entries carrying an ETag or Last-Modified header are
+    revalidated with a conditional request rather than fetched again.
+    """
+
+    def __init__(self, backends=None, ttls=None, default_ttl=0, methods=('get',)):
+        self.backends = backends if backends is not None else [MemoryCache()]
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (DEFAULT_TTLS if ttls is None else ttls)]
+        self.default_ttl = default_ttl
+        self.methods = methods
+        self.stats = CacheStats()
+
+    def key(self, method, url, params=None, data=None):
+        """Build the cache key for a request.
+        """
+        parts = [method.lower(), url]
+        for extra in (params, data):
+            if extra:
+                items = extra.items() if hasattr(extra, 'items') else extra
+                parts.append(json.dumps(sorted(items)))
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def ttl_for(self, url, ttl=None):
+        if ttl is not None:
+            return ttl
+        for pattern, pattern_ttl in self.ttls:
+            if pattern.search(url):
+                return pattern_ttl
+        return self.default_ttl
+
+    def is_cacheable(self, method):
+        return method.lower() in self.methods
+
+    def get(self, key):
+        """Return the entry for key from the fastest backend holding it,
+        copying it into any faster backends that missed.
+        """
+        missed = []
+        for backend in self.backends:
+            entry = backend.get(key)
+            if entry is not None:
+                for faster_backend in missed:
+                    faster_backend.set(key, entry)
+                return entry
+            missed.append(backend)
+        return None
+
+    def set(self, key, entry):
+        self.stats.incr('stores')
+        for backend in self.backends:
+            backend.set(key, entry)
+
+    def conditional_headers(self, entry, headers=None):
+        """Request headers (based on headers) asking upstream whether a stale
+        entry has changed, or None if there's no entry or it can't be asked.
+        """
+        if entry is None or not (entry.etag or entry.last_modified):
+            return None
+        headers = dict(headers or {})
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def store(self, key, response, body=None):
+        """Cache a response, body overrides the response's content (e.g. when
+        it was streamed).
+        """
+        headers = dict((name, response.headers[name]) for name in STORED_HEADERS if name in response.headers)
+        body = body if body is not None else response.content
+        entry = CacheEntry(response.url, body, headers, time.time())
+        self.set(key, entry)
+        return entry
+
+    def refresh(self, key, entry):
+        """Mark a revalidated entry as fresh again.
+        """
+        entry = CacheEntry(entry.url, entry.body, entry.headers, time.time())
+        self.set(key, entry)
+        return entry
+
+    def clear(self):
+        for backend in self.backends:
+            backend.clear()
+
+
+def content_hash(page):
+    """Hex digest identifying the content of a page (bytes or text).
+    """
+    if not isinstance(page, bytes):
+        page = page.encode('utf-8')
+    return hashlib.sha1(page).hexdigest()
+
+
+class ParsedCache(object):
+    """
+    Process-wide LRU of objects parsed from pages, keyed by the page's URL
+    and content hash so that a page is never parsed twice, whichever
+    provider or thread fetched it. Entries are evicted once their total
+    (estimated) size goes over max_bytes.
+
+    If path is given parsed objects are also pickled to that directory,
+    which other processes (and later runs) can share. Only the latest page of
+    each URL is kept there, the files are trusted, so only point it at a
+    directory you control.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_PARSED_MAX_BYTES, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.stats = CacheStats()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, url, page_hash):
+        return hashlib.sha1('\n'.join([url, page_hash]).encode('utf-8')).hexdigest()
+
+    def _directory(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def _filename(self, url, page_hash):
+        return os.path.join(self._directory(url), page_hash + '.pickle')
+
+    def get(self, url, page_hash):
+        key = self.key(url, page_hash)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-insert to mark as most recently used
+                self._entries[key] = entry
+        if entry is not None:
+            self.stats.incr('hits')
+            return entry[0]
+
+        value = self._load(url, page_hash)
+        if value is None:
+            self.stats.incr('misses')
+            return None
+        self.stats.incr('hits')
+        self._remember(key, value[0], value[1])
+        return value[0]
+
+    def set(self, url, page_hash, value, size):
+        key = self.key(url, page_hash)
+        self.stats.incr('stores')
+        self._remember(key, value, size)
+        if self.path is not None:
+            self._dump(url, page_hash, (value, size))
+
+    def _remember(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.stats.incr('evictions')
+
+    def _load(self, url, page_hash):
+        if self.path is None:
+            return None
+        filename = self._filename(url, page_hash)
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # truncated or from an incompatible version, parse it again
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+
+    def _dump(self, url, page_hash, value):
+        directory = self._directory(url)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another process got there first
+            if not os.path.isdir(directory):
+                raise
+        # write to a temporary file and rename it into place, so that other
+        # processes never see half a pickle
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        filename = self._filename(url, page_hash)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            getattr(os, 'replace', os.rename)(tmp_filename, filename)
+        except Exception:
+            os.remove(tmp_filename)
+            raise
+
+        # earlier versions of the page will never be asked for again
+        for name in os.listdir(directory):
+            if name.endswith('.pickle') and os.path.join(directory, name) != filename:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                directory = os.path.join(self.path, name)
+                if os.path.isdir(directory):
+                    for filename in os.listdir(directory):
+                        if filename.endswith('.pickle'):
+                            os.remove(os.path.join(directory, filename))
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_parsed_cache = None
+_parsed_cache_lock = threading.Lock()
+
+
+def configure_parsed_cache(**kwargs):
+    """Replace the parsed-object cache shared by every provider, see
+    ParsedCache for the available options.
+    """
+    global _parsed_cache
+    with _parsed_cache_lock:
+        _parsed_cache = ParsedCache(**kwargs)
+        return _parsed_cache
+
+
+def get_parsed_cache():
+    """Return the shared parsed-object cache, creating it with the default
+    settings if needed.
+    """
+    global _parsed_cache
+    with _parsed_cache_lock:
+        if _parsed_cache is None:
+            _parsed_cache = ParsedCache()
+        return _parsed_cache
@@ -0,0 +1,194 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import collections
+import sqlite3
+import threading
+import time
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+# a trip is identified by where and when it sets off: its first stop and the
+# minutes since midnight it departs from there
+Change = collections.namedtuple('Change', ['version', 'service', 'route', 'change', 'label', 'stop', 'departs'])
+
+
+class ChangeLog(object):
+    """
+    Tracks timetables from one refresh to the next in a SQLite file, keeping
+    a content hash of every timetable block and a feed of the trips added,
+    removed or modified each time something changed.
+
+        >>> changelog = ChangeLog('/var/lib/opentranslink/changes.sqlite')
+        >>> version = changelog.version
+        >>> changelog.record('goldline', goldline.routes())
+        >>> for change in changelog.changes_since(version):
+        ...     print change.route, change.change, change.stop, change.departs
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._migrate()
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS versions ('
+                'version INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL)'
+            )
+            # a block is identified by the url of its route's timetable, its
+            # label and which of that route's blocks with the label it is
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS blocks ('
+                'service TEXT, route TEXT, url TEXT, label TEXT, n INTEGER, hash TEXT, '
+                'PRIMARY KEY (service, url, label, n))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS trips ('
+                'service TEXT, url TEXT, label TEXT, n INTEGER, stop TEXT, departs INTEGER, digest TEXT, '
+                'PRIMARY KEY (service, url, label, n, stop, departs))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS changes ('
+                'version INTEGER, service TEXT, route TEXT, change TEXT, label TEXT, stop TEXT, departs INTEGER)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS changes_version ON changes (version)')
+            # services whose next record only re-bases their blocks
+            self._db.execute('CREATE TABLE IF NOT EXISTS rebase (service TEXT PRIMARY KEY)')
+
+    def _migrate(self):
+        """
+        Blocks used to be numbered by position within each route code, which
+        can't be mapped onto their keys now. Drop them, and have the next
+        record of each of their services store its blocks without reporting
+        every trip as changed.
+        """
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(blocks)')]
+        if 'block_no' not in columns:
+            return
+        self._db.execute('CREATE TABLE IF NOT EXISTS rebase (service TEXT PRIMARY KEY)')
+        self._db.execute('INSERT OR IGNORE INTO rebase SELECT DISTINCT service FROM blocks')
+        self._db.execute('DROP TABLE blocks')
+        self._db.execute('DROP TABLE IF EXISTS trips')
+
+    @property
+    def version(self):
+        """The latest version, 0 if nothing has ever changed
+        """
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(MAX(version), 0) FROM versions').fetchone()[0]
+
+    def record(self, service_name, routes):
+        """
+        Compare the timetables of routes (every route of service_name) with
+        those last recorded, storing a new version listing the trips which
+        changed if any did. Returns the latest version.
+
+        Blocks are matched up by route url and label, so blocks being added,
+        removed or moved around only affect their own trips. Blocks whose hash
+        hasn't changed are skipped without looking at their trips. Routes
+        recorded before but missing from routes have all of their trips
+        removed.
+        """
+        blocks = collections.OrderedDict()
+        for route in routes:
+            seen = collections.Counter()
+            for block in route.compact_timetable:
+                blocks[(route.url, block.label, seen[block.label])] = (route.code, block)
+                seen[block.label] += 1
+
+        with self._lock:
+            with self._db:
+                old_blocks = dict(((url, label, n), (route, block_hash))
+                                  for route, url, label, n, block_hash in self._db.execute(
+                    'SELECT route, url, label, n, hash FROM blocks WHERE service = ?', (service_name,)))
+
+                changes = []
+                for key, (route, block) in blocks.items():
+                    block_hash = block.content_hash()
+                    if old_blocks.pop(key, (None, None))[1] == block_hash:
+                        continue
+                    changes.extend(self._diff_block(service_name, route, key, block))
+                    self._db.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)',
+                                     (service_name, route) + key + (block_hash,))
+
+                # blocks (and whole routes) which have disappeared
+                for key, (route, _) in sorted(old_blocks.items()):
+                    changes.extend(self._diff_block(service_name, route, key, None))
+                    self._db.execute('DELETE FROM blocks WHERE service = ? AND url = ? AND label = ? AND n = ?',
+                                     (service_name,) + key)
+
+                if self._db.execute('DELETE FROM rebase WHERE service = ?', (service_name,)).rowcount:
+                    changes = []
+                if changes:
+                    version = self._db.execute('INSERT INTO versions (created_at) VALUES (?)', (time.time(),)).lastrowid
+                    self._db.executemany(
+                        'INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        [(version, service_name, route, change, label, stop, departs)
+                         for route, change, label, stop, departs in changes])
+            return self._db.execute('SELECT COALESCE(MAX(version), 0) FROM versions').fetchone()[0]
+
+    def _diff_block(self, service_name, route, key, block):
+        """
+        Replace the recorded trips of the block with key (url, label, n),
+        returning [(route, change, label, stop, departs)] for every trip
+        added, removed or modified
+        """
+        where = 'service = ? AND url = ? AND label = ? AND n = ?'
+        args = (service_name,) + key
+        label = key[1]
+        old_trips = dict(((stop, departs), digest) for stop, departs, digest in self._db.execute(
+            'SELECT stop, departs, digest FROM trips WHERE ' + where, args))
+        new_trips = {}
+        if block is not None:
+            for trip in range(block.n_trips):
+                trip_key, digest = block.trip_signature(trip)
+                if trip_key is not None:
+                    new_trips[trip_key] = digest
+
+        changes = []
+        for trip_key, digest in sorted(new_trips.items()):
+            if trip_key not in old_trips:
+                changes.append((route, ADDED, label, trip_key[0], trip_key[1]))
+            elif old_trips[trip_key] != digest:
+                changes.append((route, MODIFIED, label, trip_key[0], trip_key[1]))
+        for trip_key, digest in sorted(old_trips.items()):
+            if trip_key not in new_trips:
+                changes.append((route, REMOVED, label, trip_key[0], trip_key[1]))
+
+        self._db.execute('DELETE FROM trips WHERE ' + where, args)
+        self._db.executemany(
+            'INSERT INTO trips VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [args + (stop, departs, digest) for (stop, departs), digest in new_trips.items()])
+        return changes
+
+    def changes_since(self, version, service_name=None):
+        """
+        Returns every Change recorded after version (optionally just for one
+        service), oldest first
+        """
+        query = 'SELECT version, service, route, change, label, stop, departs FROM changes WHERE version > ?'
+        args = [version]
+        if service_name is not None:
+            query += ' AND service = ?'
+            args.append(service_name)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY version, rowid', args).fetchall()
+        return [Change(*row) for row in rows]
+
+    def block_hashes(self, service_name, route_code):
+        """The recorded content hash of each block of a route's timetable
+        """
+        with self._lock:
+            return [block_hash for block_hash, in self._db.execute(
+                'SELECT hash FROM blocks WHERE service = ? AND route = ? ORDER BY url, label, n',
+                (service_name, route_code))]
+
+    def close(self):
+        self._db.close()
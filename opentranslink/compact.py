@@ -0,0 +1,218 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import hashlib
+import json
+import sys
+from array import array
+
+
+# stored in place of a time where a trip doesn't call at a stop
+NO_STOP = 0xFFFF
+
+_interned = {}
+
+
+def intern_text(text):
+    """Return a canonical copy of text, so that stop names and labels repeated
+    across thousands of timetables are only held in memory once.
+    """
+    return _interned.setdefault(text, text)
+
+
+def parse_time(text):
+    """Convert a timetable cell such as '0835' to minutes since midnight,
+    returning None if the cell doesn't hold a time.
+    """
+    if len(text) != 4 or not text.isdigit():
+        return None
+    hours, minutes = int(text[:2]), int(text[2:])
+    if minutes >= 60:
+        return None
+    return hours * 60 + minutes
+
+
+def format_time(minutes):
+    """Convert minutes since midnight back to a timetable cell such as '0835'.
+    """
+    return '%02d%02d' % divmod(minutes, 60)
+
+
+def times_to_bytes(times):
+    """Little-endian bytes of a times array, the same on every machine
+    """
+    if sys.byteorder != 'little':
+        times = array(times.typecode, times)
+        times.byteswap()
+    return times.tobytes() if hasattr(times, 'tobytes') else times.tostring()
+
+
+def times_from_bytes(data):
+    times = array(str('H'))
+    if hasattr(times, 'frombytes'):
+        times.frombytes(bytes(data))
+    else:
+        times.fromstring(bytes(data))
+    if sys.byteorder != 'little':
+        times.byteswap()
+    return times
+
+
+class TimetableBlock(object):
+    """
+    A single weekday block of a timetable stored column-wise: stop names are
+    interned and times are held as minutes since midnight in one flat
+    array('H'), row-major by trip, with NO_STOP where a trip doesn't call.
+
+    Any cell that isn't a plain time (blank cells aside) is kept verbatim in
+    `extras`, keyed by (trip, stop), so to_dataset() gives back exactly what
+    was scraped.
+    """
+
+    __slots__ = ('label', 'stops', 'times', 'extras')
+
+    def __init__(self, label, stops, times, extras=None):
+        self.label = label
+        self.stops = stops
+        self.times = times
+        self.extras = extras or {}
+
+    @classmethod
+    def from_columns(cls, label, stops, columns):
+        """
+        Build a block from the scraped cell text, one list of cells per stop
+        (as laid out on the timetable page)
+        """
+        if len(stops) != len(columns):
+            raise ValueError('{0} stops but {1} columns of times'.format(len(stops), len(columns)))
+        n_trips = len(columns[0]) if columns else 0
+        if any(len(column) != n_trips for column in columns):
+            raise ValueError('every stop must have the same number of trips')
+
+        times = array(str('H'), [NO_STOP]) * (n_trips * len(stops))
+        extras = {}
+        n_stops = len(stops)
+        for stop, column in enumerate(columns):
+            for trip, cell in enumerate(column):
+                minutes = parse_time(cell)
+                if minutes is not None:
+                    times[trip * n_stops + stop] = minutes
+                elif cell:
+                    extras[(trip, stop)] = cell
+        return cls(intern_text(label), tuple(intern_text(stop) for stop in stops), times, extras)
+
+    def __getstate__(self):
+        return self.label, self.stops, self.times, self.extras
+
+    def __setstate__(self, state):
+        # unpickled (e.g. from another process) blocks share text like any other
+        label, stops, self.times, self.extras = state
+        self.label = intern_text(label)
+        self.stops = tuple(intern_text(stop) for stop in stops)
+
+    @property
+    def n_stops(self):
+        return len(self.stops)
+
+    @property
+    def n_trips(self):
+        return len(self.times) // self.n_stops if self.stops else 0
+
+    @property
+    def nbytes(self):
+        """Rough size of the block's own data, not counting shared text
+        """
+        return len(self.times) * self.times.itemsize + sum(len(text) for text in self.extras.values())
+
+    def time(self, trip, stop):
+        """Minutes since midnight that trip calls at stop, or None
+        """
+        minutes = self.times[trip * self.n_stops + stop]
+        return None if minutes == NO_STOP else minutes
+
+    def trip_times(self, trip):
+        """Array of times for every stop on a trip (NO_STOP where it doesn't call)
+        """
+        start = trip * self.n_stops
+        return self.times[start:start + self.n_stops]
+
+    def trip_calls(self, trip):
+        """
+        Yields (stop, minutes) for every stop a trip calls at, adding a day
+        to each time which comes before the trip's previous call, so that
+        trips running past midnight carry on beyond 1440
+        """
+        days = 0
+        previous = None
+        for stop, minutes in enumerate(self.trip_times(trip)):
+            if minutes == NO_STOP:
+                continue
+            minutes += days
+            if previous is not None and minutes < previous:
+                days += 1440
+                minutes += 1440
+            previous = minutes
+            yield stop, minutes
+
+    def stop_times(self, stop):
+        """Array of times at a stop for every trip (NO_STOP where it doesn't call)
+        """
+        return self.times[stop::self.n_stops]
+
+    def cell(self, trip, stop):
+        """The original text of a timetable cell
+        """
+        minutes = self.times[trip * self.n_stops + stop]
+        if minutes != NO_STOP:
+            return format_time(minutes)
+        return self.extras.get((trip, stop), '')
+
+    def to_dataset(self):
+        """Convert to the tablib.Dataset (one row per trip, one column per
+        stop) that Timetable.times has always returned.
+        """
+        # tablib pulls in every format backend it has, so only import it
+        # when someone actually wants a dataset
+        import tablib
+        dataset = tablib.Dataset()
+        for trip in range(self.n_trips):
+            dataset.append([self.cell(trip, stop) for stop in range(self.n_stops)])
+        dataset.headers = list(self.stops)
+        return dataset
+
+    def content_hash(self):
+        """
+        A hex digest of the label, stops and every cell of the block, which
+        only changes when the timetable itself does
+        """
+        digest = hashlib.sha1()
+        digest.update(json.dumps([self.label, list(self.stops), sorted(
+            [trip, stop, text] for (trip, stop), text in self.extras.items())]).encode('utf-8'))
+        digest.update(times_to_bytes(self.times))
+        return digest.hexdigest()
+
+    def trip_signature(self, trip):
+        """
+        Returns ((first stop, departure minutes), digest) for a trip: a key
+        which identifies the trip from one version of the timetable to the
+        next, and a digest of every call it makes. Trips which never call
+        anywhere have a key of None.
+        """
+        calls = [(self.stops[stop], minutes) for stop, minutes in enumerate(self.trip_times(trip)) if minutes != NO_STOP]
+        key = calls[0] if calls else None
+        digest = hashlib.sha1(json.dumps(calls).encode('utf-8')).hexdigest()
+        return key, digest
+
+    def as_numpy(self):
+        """
+        The times as a (trips x stops) uint16 NumPy array sharing memory with
+        this block, for vectorised queries. Requires NumPy.
+        """
+        import numpy
+        return numpy.frombuffer(self.times, dtype=numpy.uint16).reshape(self.n_trips, self.n_stops)
+
+    def __repr__(self):
+        return '<opentranslink.TimetableBlock-{0} {1}x{2}>'.format(self.label, self.n_trips, self.n_stops)
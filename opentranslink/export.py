@@ -0,0 +1,277 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import csv
+import io
+import itertools
+import os
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+# local imports
+from .query import day_type_for_label
+from .query import normalise_stop_name
+from .routes import Timetable
+
+
+DEFAULT_BATCH_SIZE = 65536
+
+# GTFS route_type for bus services
+GTFS_BUS = 3
+
+
+def fetch_blocks(route):
+    """
+    Returns the compact timetable of a route without keeping it on the route,
+    unless it was already fetched, so exporting a service doesn't hold every
+    timetable in memory.
+    """
+    if route._timetable is not None:
+        return route.compact_timetable
+    return Timetable(route.url).blocks
+
+
+def iter_route_blocks(routes, max_workers=8, errors=None):
+    """
+    Fetches and parses the timetables of routes in a pool of max_workers
+    threads, yielding (route, blocks) as each finishes. Only a couple of
+    routes per worker are in flight at once however many routes there are.
+
+    Routes that fail are skipped, recording the exception under the route's
+    url (codes can be shared) in errors if given.
+    """
+    routes = iter(routes)
+    max_pending = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        while True:
+            for route in itertools.islice(routes, max_pending - len(pending)):
+                pending[executor.submit(fetch_blocks, route)] = route
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                route = pending.pop(future)
+                error = future.exception()
+                if error is not None:
+                    if errors is not None:
+                        errors[route.url] = error
+                    continue
+                yield route, future.result()
+
+
+def iter_stop_times(block):
+    """Yields (trip, stop, minutes) for every call in a TimetableBlock, with
+    times after midnight carried on past 1440 (see TimetableBlock.trip_calls)
+    """
+    for trip in range(block.n_trips):
+        for stop, minutes in block.trip_calls(trip):
+            yield trip, stop, minutes
+
+
+class RouteIds(object):
+    """
+    Assigns each route (told apart by url) an id unique within an export:
+    its code, or for later routes sharing a code (e.g. the other direction)
+    the code with -2, -3 and so on appended.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._taken = set()
+
+    def __call__(self, route):
+        try:
+            return self._ids[route.url]
+        except KeyError:
+            route_id = route.code
+            n = 1
+            while route_id in self._taken:
+                n += 1
+                route_id = '{0}-{1}'.format(route.code, n)
+            self._taken.add(route_id)
+            self._ids[route.url] = route_id
+            return route_id
+
+
+def trip_id(route_id, block_no, trip):
+    return '{0}-{1}-{2}'.format(route_id, block_no, trip)
+
+
+def gtfs_time(minutes):
+    # GTFS times carry on past 24:00:00 for trips running after midnight
+    return '{0:02d}:{1:02d}:00'.format(minutes // 60, minutes % 60)
+
+
+class GTFSWriter(object):
+    """
+    Writes timetables into a directory as a GTFS-style bundle: trips.txt and
+    stop_times.txt are streamed out block by block, routes.txt and stops.txt
+    (which are small) are written on close().
+
+    Stops are identified by name alone and have no coordinates, and each day
+    type becomes a service_id without a calendar, so the bundle needs filling
+    in before a strict GTFS consumer will take it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._route_ids = RouteIds()
+        self._routes = {}
+        self._stop_ids = {}
+        self._stop_names = []
+
+        self._trips_file = self._open('trips.txt')
+        self._trips = csv.writer(self._trips_file)
+        self._trips.writerow(['route_id', 'service_id', 'trip_id', 'trip_headsign'])
+        self._stop_times_file = self._open('stop_times.txt')
+        self._stop_times = csv.writer(self._stop_times_file)
+        self._stop_times.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+
+    def _open(self, name):
+        return io.open(os.path.join(self.directory, name), 'w', encoding='utf-8', newline='')
+
+    def _stop_id(self, stop_name):
+        key = normalise_stop_name(stop_name)
+        try:
+            return self._stop_ids[key]
+        except KeyError:
+            stop_id = self._stop_ids[key] = len(self._stop_names) + 1
+            self._stop_names.append(stop_name)
+            return stop_id
+
+    def write_block(self, route, block_no, block):
+        route_id = self._route_ids(route)
+        self._routes[route_id] = (route.code, route.name)
+        service_id = day_type_for_label(block.label)
+        stop_ids = [self._stop_id(stop_name) for stop_name in block.stops]
+
+        # each trip is signed for the last stop it calls at
+        headsigns = {}
+        rows = []
+        for trip, stop, minutes in iter_stop_times(block):
+            headsigns[trip] = block.stops[stop]
+            time = gtfs_time(minutes)
+            rows.append([trip_id(route_id, block_no, trip), time, time, stop_ids[stop], stop + 1])
+        self._stop_times.writerows(rows)
+        self._trips.writerows(
+            [route_id, service_id, trip_id(route_id, block_no, trip), headsign]
+            for trip, headsign in sorted(headsigns.items()))
+
+    def close(self):
+        self._trips_file.close()
+        self._stop_times_file.close()
+        with self._open('routes.txt') as f:
+            writer = csv.writer(f)
+            writer.writerow(['route_id', 'route_short_name', 'route_long_name', 'route_type'])
+            writer.writerows([route_id, code, name, GTFS_BUS] for route_id, (code, name) in sorted(self._routes.items()))
+        with self._open('stops.txt') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stop_id', 'stop_name'])
+            writer.writerows(enumerate(self._stop_names, 1))
+
+
+class ArrowWriter(object):
+    """
+    Writes one row per call (route, day type, trip, stop, time) to a Parquet
+    file, or an Arrow IPC file for any other extension, in record batches of
+    batch_size rows so only one batch is ever held in memory. Requires
+    pyarrow.
+    """
+
+    columns = ('route_code', 'route_name', 'label', 'day_type', 'trip_id', 'stop_sequence', 'stop_name', 'minutes')
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        import pyarrow
+        self._pyarrow = pyarrow
+        self.path = path
+        self.batch_size = batch_size
+        self.schema = pyarrow.schema([
+            ('route_code', pyarrow.string()),
+            ('route_name', pyarrow.string()),
+            ('label', pyarrow.string()),
+            ('day_type', pyarrow.string()),
+            ('trip_id', pyarrow.string()),
+            ('stop_sequence', pyarrow.uint16()),
+            ('stop_name', pyarrow.string()),
+            ('minutes', pyarrow.uint16()),
+        ])
+        if path.endswith('.parquet'):
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc
+            self._writer = pyarrow.ipc.new_file(path, self.schema)
+        self._route_ids = RouteIds()
+        self._batch = dict((column, []) for column in self.columns)
+        self._rows = 0
+
+    def write_block(self, route, block_no, block):
+        batch = self._batch
+        day_type = day_type_for_label(block.label)
+        route_id = self._route_ids(route)
+        for trip, stop, minutes in iter_stop_times(block):
+            batch['route_code'].append(route.code)
+            batch['route_name'].append(route.name)
+            batch['label'].append(block.label)
+            batch['day_type'].append(day_type)
+            batch['trip_id'].append(trip_id(route_id, block_no, trip))
+            batch['stop_sequence'].append(stop + 1)
+            batch['stop_name'].append(block.stops[stop])
+            batch['minutes'].append(minutes)
+            self._rows += 1
+            if self._rows >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        arrays = [self._pyarrow.array(self._batch[column], type=self.schema.field(column).type)
+                  for column in self.columns]
+        record_batch = self._pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if hasattr(self._writer, 'write_batch'):
+            self._writer.write_batch(record_batch)
+        else:
+            self._writer.write_table(self._pyarrow.Table.from_batches([record_batch]))
+        for values in self._batch.values():
+            del values[:]
+        self._rows = 0
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def export_service(service, writers, routes=None, max_workers=8, progress=None):
+    """
+    Streams the timetables of the given routes (or every route provided by
+    service) into each writer, fetching and parsing them concurrently. Each
+    timetable is written out and dropped as soon as it's parsed, so memory
+    use doesn't grow with the size of the service. The writers are closed
+    once done.
+
+    Returns a dict mapping the url of each route that failed to the
+    exception it raised. If given, progress is called as progress(done,
+    route) as each route is written.
+    """
+    if routes is None:
+        routes = service.routes()
+
+    errors = {}
+    try:
+        for done, (route, blocks) in enumerate(iter_route_blocks(routes, max_workers, errors), 1):
+            for block_no, block in enumerate(blocks):
+                for writer in writers:
+                    writer.write_block(route, block_no, block)
+            if progress is not None:
+                progress(done, route)
+    finally:
+        for writer in writers:
+            writer.close()
+    return errors
@@ -0,0 +1,233 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import bisect
+import collections
+import threading
+import timeit
+
+
+# upper bounds of the histogram buckets for timings (seconds) and sizes (bytes)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# operation reported for events emitted outside of any operation() block
+DEFAULT_OPERATION = 'request'
+
+
+# Events emitted by the library, by name:
+#
+#     fetch_seconds        time taken by an HTTP request, including retries
+#     fetch_bytes          size of a response body
+#     parse_seconds        time taken to parse a page into a soup
+#     transform_seconds    time taken to turn a soup into routes, timetables etc
+#     cache_hits           a request served from the response cache
+#     cache_misses         a request which had to go upstream
+#     cache_revalidations  a stale cached response confirmed unchanged upstream
+#     retries              a failed request being tried again
+#     parsed_cache_hits    a page whose parsed form was already cached
+#     parsed_cache_misses  a page which had to be parsed
+#
+# Each is tagged with the operation it happened during, e.g. 'routes',
+# 'timetable', 'nir_stations' or 'nir_departures'.
+Event = collections.namedtuple('Event', ['name', 'value', 'operation'])
+
+
+_observers = ()
+_observers_lock = threading.Lock()
+_local = threading.local()
+
+
+def add_observer(observer):
+    """Call observer with every Event the library emits from now on, from
+    whichever thread emitted it.
+    """
+    global _observers
+    with _observers_lock:
+        _observers = _observers + (observer,)
+
+
+def remove_observer(observer):
+    global _observers
+    with _observers_lock:
+        _observers = tuple(o for o in _observers if o is not observer)
+
+
+def current_operation():
+    stack = getattr(_local, 'operations', None)
+    return stack[-1] if stack else DEFAULT_OPERATION
+
+
+def emit(name, value=1):
+    """Pass an Event to every observer, a no-op when there aren't any.
+    """
+    observers = _observers
+    if not observers:
+        return
+    event = Event(name, value, current_operation())
+    for observer in observers:
+        observer(event)
+
+
+class operation(object):
+    """Tags every event emitted by this thread inside the block with name
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        try:
+            _local.operations.append(self.name)
+        except AttributeError:
+            _local.operations = [self.name]
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.operations.pop()
+
+
+class timed(object):
+    """Emits the time spent inside the block as phase + '_seconds'
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        if _observers:
+            self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            emit(self.phase + '_seconds', timeit.default_timer() - self.start)
+
+
+class Histogram(object):
+    """Counts observed values into fixed buckets, Prometheus style.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # the extra count at the end is for values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / float(self.count) if self.count else 0.0
+
+    def cumulative_counts(self):
+        """Returns [(upper bound, count of values <= it)], ending with infinity
+        """
+        bounds = self.buckets + (float('inf'),)
+        total = 0
+        cumulative = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class MetricsAggregator(object):
+    """
+    An observer keeping in-process totals of everything emitted: a Histogram
+    per (name, operation) for timings and sizes and a counter for the rest.
+
+        >>> aggregator = MetricsAggregator()
+        >>> add_observer(aggregator)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.defaultdict(int)
+
+    def __call__(self, event):
+        key = (event.name, event.operation)
+        with self._lock:
+            if event.name.endswith('_seconds') or event.name.endswith('_bytes'):
+                try:
+                    histogram = self.histograms[key]
+                except KeyError:
+                    buckets = SECONDS_BUCKETS if event.name.endswith('_seconds') else BYTES_BUCKETS
+                    histogram = self.histograms[key] = Histogram(buckets)
+                histogram.observe(event.value)
+            else:
+                self.counters[key] += event.value
+
+    def summary(self):
+        """Returns {(name, operation): count} for counters and {(name,
+        operation): (count, sum, mean)} for histograms
+        """
+        with self._lock:
+            summary = dict(self.counters)
+            for key, histogram in self.histograms.items():
+                summary[key] = (histogram.count, histogram.sum, histogram.mean)
+        return summary
+
+    def prometheus(self, prefix='opentranslink'):
+        """Render everything in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for (name, op), value in sorted(self.counters.items()):
+                lines.append('{0}_{1}_total{{operation="{2}"}} {3}'.format(prefix, name, op, value))
+            for (name, op), histogram in sorted(self.histograms.items()):
+                metric = '{0}_{1}'.format(prefix, name)
+                for bound, count in histogram.cumulative_counts():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{0}_bucket{{operation="{1}",le="{2}"}} {3}'.format(metric, op, le, count))
+                lines.append('{0}_sum{{operation="{1}"}} {2!r}'.format(metric, op, histogram.sum))
+                lines.append('{0}_count{{operation="{1}"}} {2}'.format(metric, op, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+class StatsDExporter(object):
+    """
+    An observer forwarding every event to a StatsD server over UDP: timings
+    in milliseconds, sizes as histograms and everything else as counters.
+    Send failures are ignored, metrics shouldn't break scraping.
+
+        >>> add_observer(StatsDExporter('localhost', 8125))
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='opentranslink'):
+        self.address = (host, port)
+        self.prefix = prefix
+        import socket
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, event):
+        name = '{0}.{1}.{2}'.format(self.prefix, event.operation, event.name)
+        if event.name.endswith('_seconds'):
+            return '{0}:{1:.3f}|ms'.format(name, event.value * 1000)
+        if event.name.endswith('_bytes'):
+            return '{0}:{1}|h'.format(name, event.value)
+        return '{0}:{1}|c'.format(name, event.value)
+
+    def __call__(self, event):
+        try:
+            self.socket.sendto(self.format(event).encode('utf-8'), self.address)
+        except (IOError, OSError):
+            # socket.error is one of these
+            pass
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,162 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import bisect
+import collections
+import itertools
+from array import array
+
+# local imports
+from .compact import NO_STOP
+from .query import day_type_for_day
+from .query import day_types_for_label
+from .query import normalise_stop_name
+from .query import to_minutes
+
+
+DEFAULT_TRANSFER_TIME = 2
+
+Leg = collections.namedtuple('Leg', ['route', 'from_stop', 'departs', 'to_stop', 'arrives'])
+
+
+class ConnectionTable(object):
+    """
+    Every elementary connection (one trip travelling between two consecutive
+    calling points) for a single day type, held in parallel arrays sorted by
+    departure time.
+    """
+
+    def __init__(self, blocks):
+        self.stop_ids = {}
+        self.stop_names = []
+        self.trips = []
+
+        connections = []
+        for route, block in blocks:
+            stop_ids = [self._stop_id(stop_name) for stop_name in block.stops]
+            for trip in range(block.n_trips):
+                trip_id = len(self.trips)
+                self.trips.append(route)
+                # times after midnight carry on past 1440, see TimetableBlock.trip_calls
+                calls = list(block.trip_calls(trip))
+                for (from_stop, departs), (to_stop, arrives) in zip(calls, calls[1:]):
+                    connections.append((departs, arrives, stop_ids[from_stop], stop_ids[to_stop], trip_id))
+        connections.sort()
+
+        self.departs = array(str('H'), [c[0] for c in connections])
+        self.arrives = array(str('H'), [c[1] for c in connections])
+        self.from_stops = array(str('i'), [c[2] for c in connections])
+        self.to_stops = array(str('i'), [c[3] for c in connections])
+        self.trip_ids = array(str('i'), [c[4] for c in connections])
+
+    def _stop_id(self, stop_name):
+        key = normalise_stop_name(stop_name)
+        try:
+            return self.stop_ids[key]
+        except KeyError:
+            stop_id = self.stop_ids[key] = len(self.stop_names)
+            self.stop_names.append(stop_name)
+            return stop_id
+
+    def __len__(self):
+        return len(self.departs)
+
+
+class JourneyPlanner(object):
+    """
+    Plans journeys across the timetables of any number of routes using the
+    Connection Scan Algorithm, entirely from timetables already in memory.
+
+    A connection table is compiled for each day type the first time it's
+    queried. Stops are matched by name across routes, which is where
+    transfers happen, each taking at least transfer_time minutes.
+    """
+
+    def __init__(self, routes, transfer_time=DEFAULT_TRANSFER_TIME):
+        self.transfer_time = transfer_time
+        self._blocks = collections.defaultdict(list)
+        for route in routes:
+            for block in route.compact_timetable:
+                for day_type in day_types_for_label(block.label):
+                    self._blocks[day_type].append((route, block))
+        self._tables = {}
+
+    @classmethod
+    def from_services(cls, services, **kwargs):
+        """Build a planner covering every route of the given services
+        """
+        return cls(itertools.chain.from_iterable(service.routes() for service in services), **kwargs)
+
+    def connections(self, day_type):
+        try:
+            return self._tables[day_type]
+        except KeyError:
+            table = self._tables[day_type] = ConnectionTable(self._blocks.get(day_type, []))
+            return table
+
+    def earliest_arrival(self, from_stop, to_stop, depart_after, day):
+        """
+        Returns the list of Legs making up the journey from from_stop to
+        to_stop which arrives earliest, leaving at or after depart_after
+        (minutes since midnight, 'HHMM' or a time) on the given day (see
+        query.day_type_for_day). Times on trips running past midnight carry
+        on beyond 1440. Returns an empty list if from_stop and to_stop are the
+        same stop, or None if no journey exists.
+        """
+        day_type = day_type_for_day(day)
+        table = self.connections(day_type)
+        try:
+            source = table.stop_ids[normalise_stop_name(from_stop)]
+            target = table.stop_ids[normalise_stop_name(to_stop)]
+        except KeyError:
+            return None
+        if source == target:
+            return []
+
+        departs, arrives = table.departs, table.arrives
+        from_stops, to_stops, trip_ids = table.from_stops, table.to_stops, table.trip_ids
+
+        infinity = NO_STOP
+        earliest = [infinity] * len(table.stop_names)
+        earliest[source] = to_minutes(depart_after)
+        # connection each trip was boarded at, and the (boarded, alighted)
+        # connections of the best leg into each stop
+        boarded = {}
+        legs_into = {}
+
+        for i in range(bisect.bisect_left(departs, earliest[source]), len(departs)):
+            if departs[i] >= earliest[target]:
+                # connections are sorted, nothing later can improve on this
+                break
+            trip_id = trip_ids[i]
+            if trip_id not in boarded:
+                from_stop_id = from_stops[i]
+                ready = earliest[from_stop_id]
+                if from_stop_id != source and ready != infinity:
+                    ready += self.transfer_time
+                if ready > departs[i]:
+                    continue
+                boarded[trip_id] = i
+            to_stop_id = to_stops[i]
+            if arrives[i] < earliest[to_stop_id]:
+                earliest[to_stop_id] = arrives[i]
+                legs_into[to_stop_id] = (boarded[trip_id], i)
+
+        if earliest[target] == infinity:
+            return None
+
+        legs = []
+        stop_id = target
+        while stop_id != source:
+            first, last = legs_into[stop_id]
+            legs.append(Leg(
+                table.trips[trip_ids[first]],
+                table.stop_names[from_stops[first]], departs[first],
+                table.stop_names[to_stops[last]], arrives[last],
+            ))
+            stop_id = from_stops[first]
+        legs.reverse()
+        return legs
@@ -0,0 +1,200 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import bisect
+import collections
+import datetime
+import logging
+import re
+from array import array
+
+try:
+    string_types = basestring
+except NameError:
+    # python 3+
+    string_types = str
+
+# local imports
+from .compact import parse_time
+
+
+log = logging.getLogger(__name__)
+
+WEEKDAYS = 'weekdays'
+SATURDAY = 'saturday'
+SUNDAY = 'sunday'
+DAY_TYPES = (WEEKDAYS, SATURDAY, SUNDAY)
+
+# timetable labels seen on translink.co.uk (see normalise_label) and the day
+# types they cover
+DAY_TYPE_LABELS = {
+    'mondays to fridays': WEEKDAYS,
+    'monday to friday': WEEKDAYS,
+    'mondays fridays': WEEKDAYS,
+    'monday friday': WEEKDAYS,
+    'weekdays': WEEKDAYS,
+    'saturdays': SATURDAY,
+    'saturday': SATURDAY,
+    'sundays': SUNDAY,
+    'sunday': SUNDAY,
+}
+
+# names of days, as a query might give them, and the day types they fall on
+DAY_NAMES = {
+    'monday': WEEKDAYS, 'mon': WEEKDAYS,
+    'tuesday': WEEKDAYS, 'tue': WEEKDAYS, 'tues': WEEKDAYS,
+    'wednesday': WEEKDAYS, 'wed': WEEKDAYS,
+    'thursday': WEEKDAYS, 'thu': WEEKDAYS, 'thur': WEEKDAYS, 'thurs': WEEKDAYS,
+    'friday': WEEKDAYS, 'fri': WEEKDAYS,
+    'sat': SATURDAY,
+    'sun': SUNDAY,
+}
+
+# labels already warned about
+_unknown_labels = set()
+
+
+Departure = collections.namedtuple('Departure', ['minutes', 'route', 'block', 'trip', 'stop'])
+
+
+def normalise_stop_name(name):
+    return ' '.join(name.lower().split())
+
+
+def normalise_label(label):
+    """Reduce a label to its lower case words, so that e.g. 'Monday - Friday'
+    and 'monday friday' are the same label.
+    """
+    return ' '.join(re.findall(r'[a-z]+', label.lower()))
+
+
+def day_type_for_label(label):
+    """Map a timetable block label to a day type, falling back to the
+    normalised label itself for anything unrecognised.
+    """
+    label = normalise_label(label)
+    return DAY_TYPE_LABELS.get(label, label)
+
+
+def day_types_for_label(label):
+    """The day types a timetable block label covers. Unrecognised labels are
+    logged (once each) and taken to cover every day type, so that their trips
+    aren't lost to a day type nobody asks for.
+    """
+    day_type = DAY_TYPE_LABELS.get(normalise_label(label))
+    if day_type is not None:
+        return (day_type,)
+    if label not in _unknown_labels:
+        _unknown_labels.add(label)
+        log.warning('unrecognised timetable label %r, assuming it runs every day', label)
+    return DAY_TYPES
+
+
+def day_type_for_date(day):
+    """Map a weekday number (0 is Monday), date or datetime to a day type.
+    """
+    if isinstance(day, (datetime.date, datetime.datetime)):
+        day = day.weekday()
+    if day == 5:
+        return SATURDAY
+    if day == 6:
+        return SUNDAY
+    return WEEKDAYS
+
+
+def day_type_for_day(day):
+    """
+    Map the day of a query to a day type: a weekday number (0 is Monday),
+    date or datetime, or a string naming a day type, timetable label or day
+    of the week (e.g. 'weekdays', 'Mondays to Fridays', 'Monday' or 'sat').
+    Raises ValueError for strings that are none of those.
+    """
+    if not isinstance(day, string_types):
+        return day_type_for_date(day)
+    label = normalise_label(day)
+    day_type = DAY_TYPE_LABELS.get(label) or DAY_NAMES.get(label)
+    if day_type is None:
+        raise ValueError('{0!r} is not a day type or day of the week'.format(day))
+    return day_type
+
+
+def to_minutes(when):
+    """Accept minutes since midnight, a 'HHMM' string or a time/datetime.
+    """
+    if isinstance(when, int):
+        return when
+    if isinstance(when, datetime.datetime):
+        when = when.time()
+    if isinstance(when, datetime.time):
+        return when.hour * 60 + when.minute
+    minutes = parse_time(when.replace(':', ''))
+    if minutes is None:
+        raise ValueError('{0!r} is not a valid time'.format(when))
+    return minutes
+
+
+class DepartureIndex(object):
+    """
+    Answers "what leaves stop X after time T" across every route of a
+    service. Departures from every route are merged per (stop, day type) into
+    one array sorted by time, so a query is a single binary search.
+
+    Building the index reads each route's compact timetable, so fetch them
+    first (e.g. with prefetch_timetables) to avoid fetching serially.
+    """
+
+    def __init__(self, routes):
+        # (normalised stop name, day type) -> (sorted times, departures)
+        self._departures = {}
+        # normalised stop name -> [(route, day type, block, column)]
+        self.stops = collections.defaultdict(list)
+        self._stop_names = {}
+        self._build(routes)
+
+    def _build(self, routes):
+        unsorted = collections.defaultdict(list)
+        for route in routes:
+            for block in route.compact_timetable:
+                day_types = day_types_for_label(block.label)
+                for column, stop_name in enumerate(block.stops):
+                    key = normalise_stop_name(stop_name)
+                    self._stop_names.setdefault(key, stop_name)
+                    for day_type in day_types:
+                        self.stops[key].append((route, day_type, block, column))
+
+                for trip in range(block.n_trips):
+                    # times after midnight carry on past 1440, see TimetableBlock.trip_calls
+                    calls = list(block.trip_calls(trip))
+                    # nothing departs from the last stop a trip calls at
+                    for stop, minutes in calls[:-1]:
+                        departure = Departure(minutes, route, block, trip, stop)
+                        for day_type in day_types:
+                            unsorted[(normalise_stop_name(block.stops[stop]), day_type)].append(departure)
+
+        for key, departures in unsorted.items():
+            departures.sort(key=lambda departure: departure.minutes)
+            self._departures[key] = (array(str('H'), [departure.minutes for departure in departures]), departures)
+
+    def stop_names(self):
+        """All stop names in the index, as they appear on the timetables
+        """
+        return list(self._stop_names.values())
+
+    def next_departures(self, stop_name, after, day, limit=5):
+        """
+        Returns up to limit Departures from stop_name at or after the given
+        time (minutes since midnight, 'HHMM' or a time) on the given day
+        (see day_type_for_day), earliest first. Departures after midnight
+        on trips which set off the evening before come last, with minutes
+        past 1440.
+        """
+        day = day_type_for_day(day)
+        try:
+            times, departures = self._departures[(normalise_stop_name(stop_name), day)]
+        except KeyError:
+            return []
+        start = bisect.bisect_left(times, to_minutes(after))
+        return departures[start:start + limit]
@@ -0,0 +1,108 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+# local imports
+from .cache import configure_parsed_cache
+from .routes import Timetable
+from .services import Service
+from .utils import SharedRateLimiter
+from .utils import configure_session
+
+
+# the services with scrapeable timetables
+DEFAULT_SERVICES = ('metro', 'ulsterbus', 'goldline')
+DEFAULT_SHARD_SIZE = 16
+
+
+def _init_worker(rate_limiter, parsed_cache_path):
+    # each page is fetched exactly once, so caching responses (or parsed
+    # pages) in memory would only cost memory. Parsed pages shared on disk
+    # spare later refreshes from parsing timetables that haven't changed.
+    configure_session(rate_limit=rate_limiter, cache=False)
+    configure_parsed_cache(max_bytes=0, path=parsed_cache_path)
+
+
+def _fetch_shard(shard):
+    """
+    Fetch and parse the timetable of every (service name, position, code,
+    url) in a shard, returning (service name, position, url, blocks, error)
+    for each. Runs in a worker process, so only compact blocks are sent
+    back, never soups.
+    """
+    results = []
+    for service_name, position, code, url in shard:
+        try:
+            blocks = Timetable(url).blocks
+        except Exception as e:
+            results.append((service_name, position, url, None, e))
+        else:
+            results.append((service_name, position, url, blocks, None))
+    return results
+
+
+def refresh_snapshot(store, service_names=DEFAULT_SERVICES, processes=None, shard_size=DEFAULT_SHARD_SIZE,
+                     rate_limit=None, resume=False, progress=None, parsed_cache_path=None, allow_failures=False):
+    """
+    Refresh the given services in a SnapshotStore, fetching and parsing
+    their timetables in a pool of worker processes (one per CPU by
+    default), shard_size routes at a time. Route lists are still fetched
+    in this process, since each page of a list needs the one before it.
+
+    rate_limit caps the requests per second sent upstream by all of the
+    workers together. Every timetable is stored as soon as it arrives, so
+    with resume=True an interrupted refresh carries on where it stopped,
+    retrying routes which failed and skipping services already finished.
+    While a service is being refreshed its previous snapshot is still
+    served, and each new snapshot is only swapped in once every one of its
+    routes has been stored (or has failed, with allow_failures).
+
+    If parsed_cache_path is given the workers share parsed timetables
+    through that directory (see ParsedCache), so pages which haven't
+    changed since an earlier refresh aren't parsed again.
+
+    Returns {service name: {route url: exception}} for any routes that
+    failed. Unless allow_failures is set, those services are left
+    unfinished, keeping their previous snapshots, for a later resume to
+    retry. If given, progress is called as progress(done, total) as each
+    shard finishes.
+    """
+    work = []
+    refreshing = []
+    for service_name in service_names:
+        pending = store.pending_routes(service_name) if resume else None
+        if pending is None:
+            if resume and store.has_service(service_name):
+                continue
+            service = Service(service_name)
+            store.begin_service(service_name, service.service_url, service.routes())
+            pending = store.pending_routes(service_name)
+        refreshing.append(service_name)
+        work.extend((service_name, position, code, url) for position, code, url in pending)
+
+    shards = [work[i:i + shard_size] for i in range(0, len(work), shard_size)]
+    rate_limiter = SharedRateLimiter(rate_limit) if rate_limit else None
+    errors = {}
+    if shards:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(rate_limiter, parsed_cache_path)) as executor:
+            futures = [executor.submit(_fetch_shard, shard) for shard in shards]
+            for done, future in enumerate(as_completed(futures), 1):
+                for service_name, position, url, blocks, error in future.result():
+                    if error is not None:
+                        errors.setdefault(service_name, {})[url] = error
+                        store.add_failure(service_name, position, error)
+                    else:
+                        store.add_timetable(service_name, position, blocks)
+                if progress is not None:
+                    progress(done, len(shards))
+
+    for service_name in refreshing:
+        if service_name not in errors or allow_failures:
+            store.finish_service(service_name, allow_failures=allow_failures)
+    return errors
@@ -3,23 +3,59 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-# third-party imports
-import tablib
+# stdlib imports
+import bisect
 
 # local imports
-from .utils import make_request
+from . import metrics
+from .cache import content_hash
+from .cache import get_parsed_cache
+from .compact import TimetableBlock
+from .compact import intern_text
+from .utils import LazyStrainer
+from .utils import fetch
+from .utils import parse_html
+
+
+# the only parts of a timetable page we need to parse
+TIMETABLE_STRAINER = LazyStrainer(attrs={'class': ['weekdayTable', 'ttbM', 'ttbCo']})
 
 
 class Timetable(object):
+    """
+    A route's timetable, fetched from url unless the page (or its soup) is
+    given. Pages already parsed by any Timetable in this process (or sharing
+    the parsed cache's directory) aren't parsed again.
+    """
 
-    def __init__(self, url):
+    def __init__(self, url, soup=None, page=None):
         self.url = url
-        self.soup = make_request('get', self.url)
+        self.page_hash = None
+        self._blocks = None
         self._times = None
+        if soup is None:
+            with metrics.operation('timetable'):
+                if page is None:
+                    page = fetch('get', self.url).text
+                soup = self._load(page)
+        self.soup = soup
 
-    def _parse_timetable(self):
+    def _load(self, page):
+        """Use the blocks cached for this page if there are any, otherwise
+        parse it
+        """
+        self.page_hash = content_hash(page)
+        blocks = get_parsed_cache().get(self.url, self.page_hash)
+        if blocks is not None:
+            metrics.emit('parsed_cache_hits')
+            self._blocks = tuple(blocks)
+            return None
+        metrics.emit('parsed_cache_misses')
+        return parse_html(page, TIMETABLE_STRAINER)
 
-        times = []
+    def _parse_blocks(self):
+
+        blocks = []
 
         weekday_tds = self.soup.find_all('td', attrs={'class': 'weekdayTable'})
         header_tables = self.soup.find_all('table', attrs={'class': 'ttbM'})
@@ -27,13 +63,33 @@ class Timetable(object):
 
         for weekday_td, header_table, body_table in zip(weekday_tds, header_tables, body_tables):
             weekday = weekday_td.text
-            dataset = tablib.Dataset()
             columns = [[x.text for x in col.find_all('td')] for col in body_table.find_all('tr')[0:-1]]
-            for column in columns:
-                dataset.append_col(column)
-            dataset.headers = [x.text.strip() for x in header_table.find_all('tr')[0:-1]]
-            times.append((weekday, dataset))
-        return times
+            stops = [x.text.strip() for x in header_table.find_all('tr')[0:-1]]
+            blocks.append(TimetableBlock.from_columns(weekday, stops, columns))
+        return blocks
+
+    def _parse_timetable(self):
+        blocks = self.blocks
+        with metrics.operation('timetable'), metrics.timed('transform'):
+            return [(block.label, block.to_dataset()) for block in blocks]
+
+    @property
+    def blocks(self):
+        """
+        The timetable as a tuple of compact TimetableBlocks, one per weekday
+        block, which is shared through the parsed cache with every other
+        Timetable of the same page. Once parsed the page itself is no longer
+        kept in memory.
+        """
+        if self._blocks is not None:
+            return self._blocks
+        with metrics.operation('timetable'), metrics.timed('transform'):
+            self._blocks = tuple(self._parse_blocks())
+        self.soup = None
+        if self.page_hash is not None:
+            get_parsed_cache().set(self.url, self.page_hash, self._blocks,
+                                   sum(block.nbytes for block in self._blocks))
+        return self._blocks
 
     @property
     def times(self):
@@ -44,19 +100,86 @@ class Timetable(object):
 
 
 class Route(object):
+    """
+    A route of a service. There are thousands of these, so they have no
+    __dict__, share their code and name text with everything else, and keep
+    the part of the url before the query (the same for every route of a
+    service) only once.
+    """
+
+    __slots__ = ('code', 'name', '_url_base', '_url_query', '_timetable')
 
     def __init__(self, code, name, url):
-        self.code = code
-        self.name = name
+        self.code = intern_text(code)
+        self.name = intern_text(name)
         self.url = url
         self._timetable = None
 
+    @property
+    def url(self):
+        if self._url_query is None:
+            return self._url_base
+        return self._url_base + '?' + self._url_query
+
+    @url.setter
+    def url(self, url):
+        base, sep, query = url.partition('?')
+        self._url_base = intern_text(base)
+        self._url_query = query if sep else None
+
+    def _get_timetable(self):
+        if self._timetable is None:
+            self._timetable = Timetable(self.url)
+        return self._timetable
+
     @property
     def timetable(self):
-        if self._timetable is not None:
-            return self._timetable.times
-        self._timetable = Timetable(self.url)
-        return self._timetable.times
+        return self._get_timetable().times
+
+    @property
+    def compact_timetable(self):
+        """The route's timetable as a tuple of compact TimetableBlocks
+        """
+        return self._get_timetable().blocks
 
     def __repr__(self):
         return '<opentranslink.Route-{0}>'.format(self.code)
+
+
+class RouteIndex(object):
+    """
+    Case-insensitive lookup of a list of routes by code or name, plus prefix
+    search over both for autocompletion. Where codes or names repeat the
+    first route wins.
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.by_code = {}
+        self.by_name = {}
+        keys = []
+        for position, route in enumerate(routes):
+            code, name = route.code.lower(), route.name.lower()
+            self.by_code.setdefault(code, route)
+            self.by_name.setdefault(name, route)
+            keys.append((code, position))
+            keys.append((name, position))
+        keys.sort()
+        self._keys = [key for key, _ in keys]
+        self._positions = [position for _, position in keys]
+
+    def search(self, prefix, limit=10):
+        """Routes whose code or name starts with prefix, ordered by the
+        matching code or name
+        """
+        prefix = prefix.lower()
+        found = []
+        seen = set()
+        i = bisect.bisect_left(self._keys, prefix)
+        while i < len(self._keys) and len(found) < limit and self._keys[i].startswith(prefix):
+            position = self._positions[i]
+            if position not in seen:
+                seen.add(position)
+                found.append(self.routes[position])
+            i += 1
+        return found
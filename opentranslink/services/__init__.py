@@ -4,49 +4,204 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 # stdlib imports
-import urllib
-try:
-    # python 3+
-    from urllib.parse import parse_qsl
-    from urllib.parse import urlparse
-except ImportError:
-    # python 2+
-    from urlparse import parse_qsl
-    from urlparse import urlparse
+import collections
+import hashlib
+import io
+import json
+import os
+import re
+import threading
 
 # local imports
+from .. import metrics
 from ..routes import Route
+from ..routes import RouteIndex
+from ..utils import LazyStrainer
+from ..utils import fetch
 from ..utils import make_request
+from ..utils import parse_html
 
 from . import nir
 
+# route list pages are one big ASP.NET form holding the route table, pager
+# and the postback fields, so anything outside it can be skipped
+ROUTES_STRAINER = LazyStrainer(id='aspnetForm')
+
+# location URIs of a whole service, e.g. translink-northern-ireland:/metro,
+# and of an NI Railways station
+SERVICE_URI = 'translink-northern-ireland:/{0}'
+NIR_STATION_URI = 'translink-northern-ireland:/nir/stations/{0}'
+
+# the outputFormat parameter of a timetable link, 0 asks for the HTML page
+OUTPUT_FORMAT_RE = re.compile(r'([?&])outputFormat=[^&#]*')
+
+RouteDiff = collections.namedtuple('RouteDiff', ['added', 'removed', 'changed'])
+
+def route_page_fingerprint(markup):
+    """
+    Hash the parts of a route list page that matter (the pager and the route
+    table), ignoring the viewstate and anything else that changes between
+    requests
+    """
+    parts = []
+    for start_marker, end_marker in (('rgNumPart', '</div>'), ('rgMasterTable', '</table>')):
+        start = markup.find(start_marker)
+        if start != -1:
+            end = markup.find(end_marker, start)
+            # a truncated page still fingerprints everything after the marker
+            parts.append(markup[start:end if end != -1 else len(markup)])
+    fingerprinted = '\n'.join(parts) if parts else markup
+    return hashlib.sha1(fingerprinted.encode('utf-8')).hexdigest()
+
 class InvalidServiceError(Exception):
     pass
 
-class ServiceRegistry(object):
+def uri_segments(uri):
+    """
+    Split a location URI into the segments its prefixes are made of, e.g.
+    translink-northern-ireland:/nir/stations/GVA gives
+    ['translink-northern-ireland:', 'nir', 'stations', 'GVA']
+    """
+    scheme, sep, path = uri.partition(':')
+    if not sep:
+        raise ValueError('{0} is not a location URI'.format(uri))
+    return [scheme + sep] + [segment for segment in path.split('/') if segment]
+
+class _UriTrie(object):
+    """
+    Location URI prefixes, one node per segment, each holding {name: score}
+    for the providers registered at that prefix
+    """
+
+    __slots__ = ('children', 'services')
+
     def __init__(self):
-        self._service_name_to_provider_map = {}
-        self._uri_prefix_to_provider_map = {}
+        self.children = {}
+        self.services = {}
+
+    def add(self, uri, name, score):
+        node = self
+        for segment in uri_segments(uri):
+            node = node.children.setdefault(segment, _UriTrie())
+        node.services[name] = score
+
+    def remove(self, name):
+        self.services.pop(name, None)
+        for segment, child in list(self.children.items()):
+            child.remove(name)
+            if not child.services and not child.children:
+                del self.children[segment]
+
+    def matches(self, uri):
+        """
+        Returns [(depth, score, name)] for every provider registered at a
+        prefix of uri, depth being the number of segments matched
+        """
+        found = []
+        node = self
+        for depth, segment in enumerate(uri_segments(uri), 1):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            found.extend((depth, score, name) for name, score in node.services.items())
+        return found
 
-    def register(self, service_name, service_info_provider):
-        assert service_name not in self._service_name_to_class_map
+class _Registration(object):
 
-        self._service_name_to_provider_map[service_name] = service_info_provider
-        self._uri_prefix_to_provider_map[uri_prefix] = service_info_provider
+    __slots__ = ('provider_class', 'loc_uris_provided', 'kwargs', 'provider')
 
-    def deregister(self, service_name):
-        assert service_name in self._service_name_to_class_map
-        del self._service_name_to_provider_map[service_name]
-        del self._uri_prefix_to_provider_map[service_name]
+    def __init__(self, provider_class, loc_uris_provided, kwargs):
+        self.provider_class = provider_class
+        self.loc_uris_provided = loc_uris_provided
+        self.kwargs = kwargs
+        self.provider = None
 
-    def all_services_for_uri_prefix(self, uri_prefix):
-        raise NotImplementedError()
+class ServiceRegistry(object):
+    """
+    Finds the providers serving location URIs such as
+    translink-northern-ireland:/metro. Providers are registered under a
+    name with the URI prefixes they serve, and are only built the first time
+    they're used, after which every caller shares the same instance (and so
+    its route lists, timetables and station lists).
+
+    Where several providers serve a URI, those registered for the longest
+    matching prefix win, then those with the highest score.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._registrations = {}
+        self._trie = _UriTrie()
+
+    def register(self, name, provider_class, loc_uris_provided, **kwargs):
+        """
+        Register provider_class as name, serving everything under each URI
+        prefix in loc_uris_provided with the score it maps to. The provider
+        is built as provider_class(loc_uris_provided=..., **kwargs) on
+        first use.
+        """
+        with self._lock:
+            if name in self._registrations:
+                raise ValueError('{0} is already registered.'.format(name))
+            self._registrations[name] = _Registration(provider_class, dict(loc_uris_provided), kwargs)
+            for uri_prefix, score in loc_uris_provided.items():
+                self._trie.add(uri_prefix, name, score)
+
+    def deregister(self, name):
+        with self._lock:
+            if name not in self._registrations:
+                raise InvalidServiceError('{0} is not registered.'.format(name))
+            del self._registrations[name]
+            self._trie.remove(name)
+
+    def names(self):
+        with self._lock:
+            return sorted(self._registrations)
+
+    def provider(self, name):
+        """Returns the provider registered as name, building it if this is
+        the first time it's been asked for
+        """
+        with self._lock:
+            registration = self._registrations.get(name)
+            if registration is None:
+                raise InvalidServiceError('{0} is not registered.'.format(name))
+            if registration.provider is None:
+                registration.provider = registration.provider_class(
+                    loc_uris_provided=registration.loc_uris_provided, **registration.kwargs)
+            return registration.provider
+
+    def names_for_uri_prefix(self, uri_prefix, provider_class=None):
+        """
+        Names of the providers serving uri_prefix, best first, optionally
+        only those whose providers are provider_class (or a subclass). No
+        providers are built.
+        """
+        with self._lock:
+            matches = []
+            for depth, score, name in self._trie.matches(uri_prefix):
+                registered_class = self._registrations[name].provider_class
+                if provider_class is None or issubclass(registered_class, provider_class):
+                    matches.append((-depth, -score, name))
+        return [name for _, _, name in sorted(matches)]
+
+    def all_services_for_uri_prefix(self, uri_prefix, provider_class=None):
+        """The providers serving uri_prefix, best first
+        """
+        return [self.provider(name) for name in self.names_for_uri_prefix(uri_prefix, provider_class)]
 
-    def preferred_service_for_uri_prefix(self, uri_prefix):
-        return all_services_for_uri_prefix(self, uri_prefix)[0]
+    def preferred_service_for_uri_prefix(self, uri_prefix, provider_class=None):
+        """
+        The best provider for uri_prefix, raising InvalidServiceError if
+        nothing serves it. Only this provider is built.
+        """
+        names = self.names_for_uri_prefix(uri_prefix, provider_class)
+        if not names:
+            raise InvalidServiceError('Nothing is registered for {0}.'.format(uri_prefix))
+        return self.provider(names[0])
 
 class TransportServiceInfoProvider(object):
-    def __init__(self, service_name, loc_uri_provided):
+    def __init__(self, service_name, loc_uris_provided):
         """
         Creates a new TransportService object, with the given service_name.
         For each loc_uri in loc_uris_provided dictionary's keys, the
@@ -60,7 +215,7 @@ class TransportServiceInfoProvider(object):
         self.loc_uris_provided = loc_uris_provided
  
 class TransportServiceTimetableProvider(TransportServiceInfoProvider):
-   def route(self, code):
+    def route(self, code):
         """
         Returns the route that matches the given service code or None if not found
         """
@@ -81,26 +236,87 @@ class TransportLiveInfoService(TransportServiceInfoProvider):
         """
         raise NotImplementedError()
 
+class NIRailwaysLiveInfoProvider(TransportLiveInfoService):
+    """
+    Upcoming NI Railways trains from journeycheck, between stations given
+    as URIs such as translink-northern-ireland:/nir/stations/GVA. The
+    station list is loaded on first use.
+    """
+    valid_services = ['nir']
+
+    def __init__(self, *args, **kwargs):
+        super(NIRailwaysLiveInfoProvider, self).__init__(*args, **kwargs)
+        self._station_mapper = None
+        self._station_mapper_lock = threading.Lock()
+
+    @property
+    def station_mapper(self):
+        with self._station_mapper_lock:
+            if self._station_mapper is None:
+                self._station_mapper = nir.load_station_mapper()
+            return self._station_mapper
+
+    def station_id(self, loc_uri):
+        """The station id of a translink-northern-ireland:/nir/stations/... URI
+        """
+        segments = uri_segments(loc_uri)
+        if len(segments) != 4 or segments[:3] != uri_segments(NIR_STATION_URI.format('')):
+            raise nir.InvalidStationIdExcept(loc_uri)
+        return segments[-1]
+
+    def next_journeys_between(self, src_loc_uri, dst_loc_uri, limit=None):
+        """
+        Returns a list of upcoming (train, waypoints) departures from
+        src_loc_uri which call at dst_loc_uri
+        """
+        return list(nir.get_departures_by_station_ids(
+            self.station_id(src_loc_uri), self.station_id(dst_loc_uri), self.station_mapper, limit))
+
 class TranslinkServiceOfficialTimeTableProvider(TransportServiceTimetableProvider):
     base_url = 'http://www.translink.co.uk/Routes-and-Timetables/{0}/'
     valid_services = ['metro', 'ulsterbus', 'goldline', 'nir', 'enterprise']
 
-    def __init__(self, *args, subservice, **kwargs):
+    def __init__(self, *args, subservice, snapshot=None, **kwargs):
         super(TranslinkServiceOfficialTimeTableProvider, self).__init__(*args, **kwargs)
 
         assert subservice in self.__class__.valid_services
 
         self.subservice = subservice
         self.service_url = self.base_url.format(subservice)
+        # routes and timetables are served from this SnapshotStore instead of
+        # translink.co.uk when given
+        self.snapshot = snapshot
         self._routes = None
+        self._route_index = None
+
+    def _get_route_index(self):
+        # rebuilt whenever the route list is replaced, e.g. by sync_routes()
+        routes = self.routes()
+        route_index = self._route_index
+        if route_index is None or route_index.routes is not routes:
+            route_index = self._route_index = RouteIndex(routes)
+        return route_index
 
     def route(self, code):
         """returns the route that matches the given code or None if not found
         """
-        for route in self.routes():
-            if route.code.lower() == code.lower():
-                return route
-        return None
+        return self._get_route_index().by_code.get(code.lower())
+
+    def route_many(self, codes):
+        """returns the routes matching each of the given codes, None for any not found
+        """
+        by_code = self._get_route_index().by_code
+        return [by_code.get(code.lower()) for code in codes]
+
+    def route_by_name(self, name):
+        """returns the route with the given name or None if not found
+        """
+        return self._get_route_index().by_name.get(name.lower())
+
+    def search_routes(self, prefix, limit=10):
+        """returns up to limit routes whose code or name starts with prefix
+        """
+        return self._get_route_index().search(prefix, limit)
 
     def routes(self):
         """
@@ -111,40 +327,173 @@ class TranslinkServiceOfficialTimeTableProvider(TransportServiceTimetableProvide
         if self._routes is not None:
             return self._routes
 
+        if self.snapshot is not None:
+            self._routes = self.snapshot.load_routes(self.service_name)
+            return self._routes
+
+        with metrics.operation('routes'):
+            self._routes = self._fetch_routes()
+        return self._routes
+
+    def _fetch_routes(self):
+
         # fetch the first page of results, pagination's done with POST requests so
         # we'll do any subsequent pages in a loop after parsing
-        soup = make_request('get', self.service_url)
+        soup = make_request('get', self.service_url, parse_only=ROUTES_STRAINER)
 
         # if this is a train service the call a different parser (for some reason
         # the page has a different layout)
         if self.service_name in ['nir', 'enterprise']:
-            self._routes = self._parse_train_routes_page(soup)
-            return self._routes
+            return self._parse_train_routes_page(soup)
 
         # loop until we hit the last page, adding all possible routes
-        routes, last_page = self._parse_routes_page(soup)
+        with metrics.timed('transform'):
+            routes, last_page = self._parse_routes_page(soup)
         while not last_page:
-            soup = make_request('post', self.service_url, data=self._parse_next_page_data(soup))
-            new_routes, last_page = self._parse_routes_page(soup)
+            soup = make_request('post', self.service_url, data=self._parse_next_page_data(soup),
+                                parse_only=ROUTES_STRAINER)
+            with metrics.timed('transform'):
+                new_routes, last_page = self._parse_routes_page(soup)
             routes.extend(new_routes)
 
-        self._routes = routes
         return routes
 
-    def _fix_url_format(self, url):
+    def sync_routes(self, state_path, check_pages=1):
         """
-        Simple method to create a query string changing only
-        one parameter in the request
+        Refresh the route list incrementally against the state saved at
+        state_path by a previous sync, returning a RouteDiff of the routes
+        added, removed and changed (same code, new name or url) since then.
+
+        Pages are still walked in order (each postback needs the page before
+        it) but only pages whose fingerprint changed are re-parsed for routes.
+        Once the first check_pages pages all match the saved state the rest of
+        the list is assumed unchanged and paging stops, pass None to always
+        walk every page.
         """
 
-        # we can't modify the request params in place so
-        # we need to make a copy of the dict
-        qs = urlparse(url).query
-        temp = dict(parse_qsl(qs))
-        temp['outputFormat'] = 0
+        old_pages = self._load_route_state(state_path)
+        old_routes = self._routes if self._routes is not None else [
+            Route(*route) for page in old_pages for route in page['routes']]
+
+        pages = []
+        unchanged = True
+        # always ask upstream, a cached first page would hide any change
+        markup = fetch('get', self.service_url, cache_ttl=0).text
+        while True:
+            page_no = len(pages)
+            fingerprint = route_page_fingerprint(markup)
+            old_page = old_pages[page_no] if page_no < len(old_pages) else None
+
+            if old_page is not None and old_page['fingerprint'] == fingerprint:
+                pages.append(old_page)
+                if unchanged and check_pages is not None and len(pages) >= check_pages:
+                    pages.extend(old_pages[len(pages):])
+                    break
+                if old_page['last_page']:
+                    break
+                soup = parse_html(markup, ROUTES_STRAINER)
+            else:
+                unchanged = False
+                soup = parse_html(markup, ROUTES_STRAINER)
+                routes, last_page = self._parse_routes_page(soup)
+                pages.append({
+                    'fingerprint': fingerprint,
+                    'last_page': last_page,
+                    'routes': [(route.code, route.name, route.url) for route in routes],
+                })
+                if last_page:
+                    break
+
+            markup = fetch('post', self.service_url, data=self._parse_next_page_data(soup)).text
+
+        self._save_route_state(state_path, pages)
+        self._routes = [Route(*route) for page in pages for route in page['routes']]
+        return self._diff_routes(old_routes, self._routes)
+
+    def _load_route_state(self, state_path):
+        try:
+            with io.open(state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return []
+        if state.get('service_url') != self.service_url:
+            return []
+        return state['pages']
+
+    def _save_route_state(self, state_path, pages):
+        # write to a temporary file first so a crash never leaves a half written state
+        tmp_path = state_path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'service_url': self.service_url, 'pages': pages}, ensure_ascii=False))
+        # os.replace is python 3+, os.rename replaces atomically on posix
+        getattr(os, 'replace', os.rename)(tmp_path, state_path)
+
+    def _diff_routes(self, old_routes, new_routes):
+        old = dict((route.code, route) for route in old_routes)
+        new = dict((route.code, route) for route in new_routes)
+        return RouteDiff(
+            added=[route for code, route in new.items() if code not in old],
+            removed=[route for code, route in old.items() if code not in new],
+            changed=[route for code, route in new.items()
+                     if code in old and (old[code].name, old[code].url) != (route.name, route.url)],
+        )
+
+    def save_snapshot(self, store, max_workers=8, progress=None, allow_failures=False):
+        """
+        Fetch every route and timetable of this service and save them to the
+        given SnapshotStore, see SnapshotStore.save_service
+        """
+        return store.save_service(self, max_workers=max_workers, progress=progress, allow_failures=allow_failures)
 
-        # return encoded query string
-        return url.replace(qs, urllib.urlencode(temp))
+    def prefetch_timetables(self, routes=None, max_workers=8, progress=None):
+        """
+        Fetch and parse the timetables for the given routes (or every route
+        provided by this service) concurrently, using a pool of at most
+        max_workers threads.
+
+        Failures don't stop the sweep, instead a dict mapping the url of each
+        route that failed (codes can be shared) to the exception it raised is
+        returned. If given,
+        progress is called as progress(done, total, route, error) each time a
+        route finishes.
+        """
+
+        if routes is None:
+            routes = self.routes()
+
+        # drop duplicates so two workers never race on the same route
+        unique_routes = []
+        seen = set()
+        for route in routes:
+            if id(route) in seen:
+                continue
+            seen.add(id(route))
+            unique_routes.append(route)
+
+        errors = {}
+        total = len(unique_routes)
+        from concurrent.futures import ThreadPoolExecutor
+        from concurrent.futures import as_completed
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict((executor.submit(lambda r: r.timetable, route), route) for route in unique_routes)
+            for done, future in enumerate(as_completed(futures), 1):
+                route = futures[future]
+                error = future.exception()
+                if error is not None:
+                    errors[route.url] = error
+                if progress is not None:
+                    progress(done, total, route, error)
+        return errors
+
+    def _fix_url_format(self, url):
+        """
+        Point a timetable link at the HTML version of the page (outputFormat=0),
+        leaving the rest of the url as it is
+        """
+        url, replaced = OUTPUT_FORMAT_RE.subn(r'\g<1>outputFormat=0', url)
+        if replaced:
+            return url
+        return url + ('&' if '?' in url else '?') + 'outputFormat=0'
 
     def _parse_routes_page(self, soup):
         """
@@ -217,14 +566,50 @@ class TranslinkServiceOfficialTimeTableProvider(TransportServiceTimetableProvide
         form_data['ctl00$MainRegion$rptPageListCurrent$ctl00$ctl03$ctl01$ctl12'] = ''
         return form_data
 
-def register_services(service_registry):
-    # register main timetable services by creating them in a loop based on service names
-    for subservice in TranslinkServiceOfficialTimeTableProvider.valid_services:
-        tt_service_info_provider = TranslinkServiceOfficialTimeTableProvider("official_translink_" + subservice + "_timetable_provider", subservice)
-        service_registry.register("translink-northern-ireland:/" + subservice, tt_service_info_provider)
+def Service(service_name, snapshot=None):
+    """
+    Returns the official Translink timetable provider for the given service
+    name, raising InvalidServiceError if the name isn't recognised.
 
-    # register nir next trains service directly
-    nir_live_info_provider = NotImplementedError()
-    raise nir_live_info_provider
-    service_registry.register("translink-northern-ireland:/nir", nir_live_info_provider)
+    Given a SnapshotStore the provider works offline, serving routes and
+    timetables from the store alone.
+    """
+    return TranslinkServiceOfficialTimeTableProvider(service_name, {}, subservice=service_name, snapshot=snapshot)
 
+def register_services(service_registry):
+    """
+    Register the official Translink timetables for every service and NI
+    Railways live departures with service_registry. Nothing is fetched, or
+    even built, until a provider is first used.
+    """
+    for subservice in TranslinkServiceOfficialTimeTableProvider.valid_services:
+        # there are no scrapeable timetables for trains, so prefer the live departures
+        score = -1 if subservice in ['nir', 'enterprise'] else 0
+        service_registry.register(
+            'official_translink_' + subservice + '_timetable_provider',
+            TranslinkServiceOfficialTimeTableProvider,
+            {SERVICE_URI.format(subservice): score},
+            service_name=subservice, subservice=subservice,
+        )
+
+    service_registry.register(
+        'nir_live_info_provider',
+        NIRailwaysLiveInfoProvider,
+        {SERVICE_URI.format('nir'): 0},
+        service_name='nir',
+    )
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    """
+    Return the registry shared by the library, with register_services()
+    already run on it. Created the first time it's asked for, not on import.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ServiceRegistry()
+            register_services(_registry)
+        return _registry
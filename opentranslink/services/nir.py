@@ -2,11 +2,38 @@ from __future__ import print_function
 
 import sys
 import os
-import shelve
+import codecs
+import copy
 import datetime
+import bisect
+import collections
+import io
+import json
+import re
+import threading
+import unicodedata
 import time
-
-import bs4
+try:
+    # python 3+
+    from html.entities import name2codepoint
+    from html.parser import HTMLParser
+except ImportError:
+    # python 2+
+    from htmlentitydefs import name2codepoint
+    from HTMLParser import HTMLParser
+
+from .. import metrics
+from ..compact import intern_text
+from ..utils import SingleFlight
+from ..utils import get_session
+from ..utils import parse_html
+
+try:
+    unicode
+except NameError:
+    # python 3+
+    unicode = str
+    unichr = chr
 
 nir_stations_url = "http://www.journeycheck.com/nirailways/route?from=GVA&to=CLA&action=search&savedRoute="
 nir_departures_url_template = "http://www.journeycheck.com/nirailways/route?from=%(src)s&to=%(dst)s&action=search&savedRoute="
@@ -15,6 +42,14 @@ MAX_STATION_ID_LEN = 3
 MIN_STATION_ID_LEN = 3
 
 MAX_CACHE_TIME = datetime.timedelta(hours=12)
+DEPARTURES_CACHE_TIME = datetime.timedelta(seconds=30)
+
+STATION_SNAPSHOT_VERSION = 1
+# written by load_station_mapper after scraping, and checked first
+DEFAULT_STATION_SNAPSHOT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "opentranslink", "nir_stations.json")
+
+# shared by every batch so identical in-flight requests are only made once
+_departures_flight = SingleFlight()
 
 
 class InvalidStationExcept(KeyError):
@@ -31,10 +66,177 @@ def datetime_from_nir_time(nir_time):
     dt = datetime.datetime.strptime(nir_time, "%H:%M")
     return dt
 
+def normalise_station_name(station_name):
+    """
+    Reduces a station name to lower case ascii words, so that user typed
+    names match regardless of case, accents, punctuation or spacing
+    """
+    station_name = unicodedata.normalize("NFKD", unicode(station_name))
+    station_name = u"".join(c for c in station_name if not unicodedata.combining(c))
+    return u" ".join(re.split(u"[^a-z0-9]+", station_name.lower())).strip()
+
+def _trigrams(normalised_name):
+    padded = u"  " + normalised_name + u" "
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class StationSearchIndex(object):
+    """
+    Resolves user typed station names: exact matches on the normalised name
+    first, then names containing a word starting with the query, then fuzzy
+    matches ranked by trigram similarity.
+    """
+
+    MIN_FUZZY_SCORE = 0.3
+
+    def __init__(self, ids_and_names):
+        self._exact = {}
+        self._trigrams = {}
+        self._postings = collections.defaultdict(set)
+        prefix_keys = []
+        for station_id, station_name in ids_and_names:
+            normalised = normalise_station_name(station_name)
+            self._exact.setdefault(normalised, station_id)
+            # index every word onwards so "victoria" finds "Great Victoria Street"
+            words = normalised.split()
+            for i in range(len(words)):
+                prefix_keys.append((u" ".join(words[i:]), i, station_id))
+            trigrams = self._trigrams[station_id] = _trigrams(normalised)
+            for trigram in trigrams:
+                self._postings[trigram].add(station_id)
+        prefix_keys.sort()
+        self._prefix_keys = [key for key, _, _ in prefix_keys]
+        self._prefix_entries = [(word, station_id) for _, word, station_id in prefix_keys]
+
+    def search(self, query, limit=5):
+        """
+        Returns up to limit (station_id, score) pairs for the query, best
+        first, scoring 1.0 for an exact match
+        """
+        normalised = normalise_station_name(query)
+        if not normalised:
+            return []
+
+        scores = {}
+        if normalised in self._exact:
+            scores[self._exact[normalised]] = 1.0
+
+        i = bisect.bisect_left(self._prefix_keys, normalised)
+        while i < len(self._prefix_keys) and self._prefix_keys[i].startswith(normalised):
+            word, station_id = self._prefix_entries[i]
+            # prefer matches on the first word of the name
+            score = 0.9 if word == 0 else 0.8
+            if scores.get(station_id, 0) < score:
+                scores[station_id] = score
+            i += 1
+
+        if len(scores) < limit:
+            query_trigrams = _trigrams(normalised)
+            counts = collections.Counter()
+            for trigram in query_trigrams:
+                counts.update(self._postings.get(trigram, ()))
+            for station_id, shared in counts.items():
+                # dice coefficient, scaled to rank below any prefix match
+                score = 0.7 * 2.0 * shared / (len(query_trigrams) + len(self._trigrams[station_id]))
+                if score >= 0.7 * self.MIN_FUZZY_SCORE and scores.get(station_id, 0) < score:
+                    scores[station_id] = score
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit]
+
+class _Stations(object):
+    """
+    Everything a StationMapper knows about its stations, replaced as a whole
+    so that a reader never sees one map from before a refresh next to
+    another (or the search index) from after it
+    """
+
+    __slots__ = ('ids_to_names', 'names_to_ids', 'search_index')
+
+    def __init__(self, ids_to_names, names_to_ids):
+        self.ids_to_names = ids_to_names
+        self.names_to_ids = names_to_ids
+        self.search_index = None
+
+
 class StationMapper(object):
     def __init__(self):
-        self._ids_to_names = {}
-        self._names_to_ids = {}
+        self._stations = _Stations({}, {})
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Builds a mapper from (station_id, station_name) pairs already known to
+        be valid, e.g. from a snapshot, skipping add_mapping's checks
+        """
+        station_mapper = cls()
+        # both dicts share the same (interned) strings, as do timetables
+        # naming the same stations and every mapper loaded in this process
+        ids_to_names = dict((intern_text(k), intern_text(v)) for k, v in pairs)
+        station_mapper._stations = _Stations(ids_to_names, dict((v, k) for k, v in ids_to_names.items()))
+        return station_mapper
+
+    def search(self, query, limit=5):
+        """
+        Returns up to limit (station_id, station_name, score) tuples best
+        matching a user typed station name, see StationSearchIndex
+        """
+        stations = self._stations
+        search_index = stations.search_index
+        if search_index is None:
+            search_index = stations.search_index = StationSearchIndex(stations.ids_to_names.items())
+        return [(station_id, stations.ids_to_names[station_id], score)
+                for station_id, score in search_index.search(query, limit)]
+
+    def resolve_name(self, query):
+        """
+        Returns the id of the station best matching a user typed name, raising
+        InvalidStationNameExcept if nothing matches
+        """
+        results = self.search(query, limit=1)
+        if not results:
+            raise InvalidStationNameExcept(query)
+        return results[0][0]
+
+    def update_from(self, other):
+        """
+        Replaces this mapper's stations with those of another, e.g. after a
+        background refresh, in a single step so that readers on other threads
+        see either all of the old stations or all of the new ones
+        """
+        stations = other._stations
+        self._stations = _Stations(dict(stations.ids_to_names), dict(stations.names_to_ids))
+
+    def save(self, path):
+        """
+        Writes the mapping to a versioned snapshot file, for load() to read back
+        """
+        snapshot = {
+            "version": STATION_SNAPSHOT_VERSION,
+            "created": time.time(),
+            "stations": sorted(self._stations.ids_to_names.items()),
+        }
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = path + ".tmp"
+        with io.open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(unicode(json.dumps(snapshot, ensure_ascii=False, separators=(",", ":"))))
+        getattr(os, "replace", os.rename)(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a snapshot written by save(), returning (station_mapper, created)
+        or None if the file is missing, unreadable or from another version
+        """
+        try:
+            with io.open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if snapshot.get("version") != STATION_SNAPSHOT_VERSION:
+            return None
+        return cls.from_pairs((unicode(k), unicode(v)) for k, v in snapshot["stations"]), snapshot["created"]
 
     def add_mapping(self, station_id, station_name):
         assert station_name != "All Stations"
@@ -43,50 +245,55 @@ class StationMapper(object):
         assert isinstance(station_name, unicode)
         assert len(station_id) <= MAX_STATION_ID_LEN # if this happens, you may have given a name instead of an id
         assert len(station_id) >= MIN_STATION_ID_LEN
-        assert station_id not in self._ids_to_names
-        assert station_name not in self._names_to_ids
+        stations = self._stations
+        assert station_id not in stations.ids_to_names
+        assert station_name not in stations.names_to_ids
 
-        self._ids_to_names[station_id] = station_name
-        self._names_to_ids[station_name] = station_id
+        station_id, station_name = intern_text(station_id), intern_text(station_name)
+        stations.ids_to_names[station_id] = station_name
+        stations.names_to_ids[station_name] = station_id
+        stations.search_index = None
 
-        assert station_name in self._names_to_ids
-        assert station_id in self._ids_to_names
+        assert station_name in stations.names_to_ids
+        assert station_id in stations.ids_to_names
 
-        assert self._ids_to_names[station_id] == station_name
-        assert self._names_to_ids[station_name] == station_id
+        assert stations.ids_to_names[station_id] == station_name
+        assert stations.names_to_ids[station_name] == station_id
 
     def remove_mapping(self, station_id, station_name):
         assert len(station_id) <= MAX_STATION_ID_LEN # if this happens, you may have given a name instead of an id
         assert len(station_id) >= MIN_STATION_ID_LEN
-        assert station_id in self._ids_to_names
-        assert station_name in self._names_to_ids
+        stations = self._stations
+        assert station_id in stations.ids_to_names
+        assert station_name in stations.names_to_ids
 
-        del self._ids_to_names[station_id]
-        del self._names_to_ids[station_name]
+        del stations.ids_to_names[station_id]
+        del stations.names_to_ids[station_name]
+        stations.search_index = None
 
     def name_for_id(self, station_id):
         if len(station_id) > MAX_STATION_ID_LEN or len(station_id) < MIN_STATION_ID_LEN:
-            raise InvalidStationId(station_id)
+            raise InvalidStationIdExcept(station_id)
 
         try:
-            return self._ids_to_names[station_id]
+            return self._stations.ids_to_names[station_id]
         except KeyError as e:
-            raise InvalidStationId(station_id)
+            raise InvalidStationIdExcept(station_id)
 
     def id_for_name(self, station_name):
         assert isinstance(station_name, unicode)
 
         try:
-            return self._names_to_ids[station_name]
-        except KeyError, e:
+            return self._stations.names_to_ids[station_name]
+        except KeyError as e:
             raise InvalidStationNameExcept(station_name)
 
     def all_ids(self):
-        for station_id in self._ids_to_names.keys():
+        for station_id in self._stations.ids_to_names.keys():
             yield station_id
 
     def all_names(self):
-        for station_name in self._names_to_ids.keys():
+        for station_name in self._stations.names_to_ids.keys():
             yield station_name
 
     def id_is_valid(self, station_id):
@@ -95,63 +302,43 @@ class StationMapper(object):
         if len(station_id) < MIN_STATION_ID_LEN or len(station_id) > MAX_STATION_ID_LEN:
             return False
 
-        return station_id in self._ids_to_names
+        return station_id in self._stations.ids_to_names
 
     def name_is_valid(self, station_name):
         assert isinstance(station_name, unicode)
-        return station_name in self._names_to_ids
+        return station_name in self._stations.names_to_ids
 
     def ids_and_names(self):
-        for k,v in self._ids_to_names.items():
+        for k,v in self._stations.ids_to_names.items():
             yield (k,v)
 
-def build_browser():
-    import mechanize
-    from functools import partial
-
-    br = mechanize.Browser()
-    br.set_handle_robots(False)
-    br.set_handle_refresh(False)
-    br.addheaders = [ ('User-Agent', 'Firefox') ]
-
-    def get_raw_page(br, url):
-        br.open(url)
-        res = br.response()
-        return res.read()
-
-    def cached_get_page(br, url):
-        escaped_url = escape_url(url)
-        cache_path = os.path.join("/tmp", escaped_url)
-
-        now = datetime.datetime.now()
-
-        page_dat = None
-        need_new_page_dat = True
-
-        if os.path.exists(cache_path):
-            page_shelf = shelve.open(cache_path)
-            cache_date = page_shelf["page_retrieval_date"]
+class Browser(object):
+    """
+    Fetches journeycheck pages over the HTTP session shared with the rest of
+    the library
+    """
 
-            assert page_shelf["page_url"] == url # TODO: treat this as a runtime error, not an assertion
+    headers = {'User-Agent': 'Firefox'}
 
-            if cache_date - now > MAX_CACHE_TIME:
-                need_new_page_dat = True
-            else:
-                page_dat = page_shelf["page_dat"]
-                need_new_page_dat = False
+    def __init__(self, session=None):
+        self.session = session if session is not None else get_session()
 
-        if need_new_page_dat:
-            page_dat = get_raw_page(br, url)
-            shelf = shelve.open(cache_path)
-            shelf["page_url"] = url
-            shelf["page_dat"] = page_dat
-            shelf["page_retrieval_date"] = now
+    def get_raw_page(self, url, cache_ttl=None):
+        return self.session.request('get', url, headers=self.headers, cache_ttl=cache_ttl).content
 
-        return bs4.BeautifulSoup(page_dat)
+    def cached_get_page(self, url, max_age=MAX_CACHE_TIME):
+        page_dat = self.get_raw_page(url, cache_ttl=max_age.total_seconds())
+        return parse_html(page_dat)
 
-    br.cached_get_page = partial(cached_get_page, br)
+    def iter_page(self, url, max_age=MAX_CACHE_TIME):
+        """
+        Yields the raw page in chunks as it arrives, close the generator to
+        abandon the transfer
+        """
+        return self.session.iter_content('get', url, headers=self.headers, cache_ttl=max_age.total_seconds())
 
-    return br
+def build_browser(session=None):
+    return Browser(session)
 
 def escape_url(url):
     import urllib
@@ -167,8 +354,57 @@ def get_station_mapper():
     Returns a StationMapper, which provides a mapping of all station ids and names
     """
 
-    br = build_browser()
-    page = br.cached_get_page(nir_stations_url)
+    with metrics.operation('nir_stations'):
+        br = build_browser()
+        page = br.cached_get_page(nir_stations_url)
+        with metrics.timed('transform'):
+            return parse_station_mapper(page)
+
+def load_station_mapper(snapshot_path=DEFAULT_STATION_SNAPSHOT_PATH, max_age=MAX_CACHE_TIME, background_refresh=True):
+    """
+    Returns a StationMapper without touching the network where possible,
+    loading the snapshot at snapshot_path. If the snapshot is older than max_age it's refreshed in a
+    background thread, updating the returned mapper in place once done. With
+    no usable snapshot the station list is scraped and saved to snapshot_path.
+    """
+
+    loaded = StationMapper.load(snapshot_path)
+    if loaded is None:
+        station_mapper = get_station_mapper()
+        _save_station_snapshot(station_mapper, snapshot_path)
+        return station_mapper
+
+    station_mapper, created = loaded
+    if time.time() - created > max_age.total_seconds():
+        if background_refresh:
+            thread = threading.Thread(target=_refresh_station_mapper, args=(station_mapper, snapshot_path))
+            thread.daemon = True
+            thread.start()
+        else:
+            _refresh_station_mapper(station_mapper, snapshot_path)
+    return station_mapper
+
+def _refresh_station_mapper(station_mapper, snapshot_path):
+    try:
+        fresh_station_mapper = get_station_mapper()
+    except Exception:
+        # keep using the snapshot, we'll try again next time
+        return
+    station_mapper.update_from(fresh_station_mapper)
+    _save_station_snapshot(fresh_station_mapper, snapshot_path)
+
+def _save_station_snapshot(station_mapper, snapshot_path):
+    try:
+        station_mapper.save(snapshot_path)
+    except (IOError, OSError):
+        # a read-only home directory shouldn't stop us working
+        pass
+
+def parse_station_mapper(page):
+    """
+    Builds a StationMapper from the station list on a journeycheck page
+    """
+
     stationSelect = page.find('select', id='fromSelectBox')
 
     station_mapper = StationMapper()
@@ -182,15 +418,74 @@ def get_station_mapper():
 
     return station_mapper
 
-def get_departures_by_station_ids(src_station_id, dst_station_id, station_mapper):
+def get_departures_by_station_ids(src_station_id, dst_station_id, station_mapper, limit=None):
     """
     Yields upcoming departures from the given src_station_name, to the given dst_station_name
+
+    Departures are parsed as the page downloads, and once limit departures
+    have been yielded the rest of the page isn't fetched. Otherwise the rest
+    of the page is read once the departures list ends, so that the page is
+    cached.
     """
 
     br = build_browser()
+    chunks = br.iter_page(departures_url(src_station_id, dst_station_id), DEPARTURES_CACHE_TIME)
+    departures = iter_departures(chunks, src_station_id, station_mapper, limit)
+    count = 0
+    try:
+        while True:
+            # tag our own work only, not whatever the caller does between yields
+            with metrics.operation('nir_departures'):
+                departure = next(departures, None)
+                if departure is None and (limit is None or count < limit):
+                    for _ in chunks:
+                        pass
+            if departure is None:
+                return
+            count += 1
+            yield departure
+    finally:
+        chunks.close()
+
+def get_departures_for_pairs(pairs, station_mapper, max_workers=8, limit=None):
+    """
+    Fetches upcoming departures for many (src_station_id, dst_station_id)
+    pairs concurrently, returning (departures, errors): dicts keyed by pair
+    holding the list of departures, or the exception raised, for each pair.
 
-    station_departures_url = nir_departures_url_template % { 'src': src_station_id, 'dst': dst_station_id }
-    page = br.cached_get_page(station_departures_url)
+    Duplicate pairs are fetched once, and so is any pair already being
+    fetched by another thread (in this or another batch) at the same time.
+    """
+
+    def fetch_pair(pair):
+        src_station_id, dst_station_id = pair
+        shared = _departures_flight.do(
+            (src_station_id, dst_station_id, limit),
+            lambda: tuple(get_departures_by_station_ids(src_station_id, dst_station_id, station_mapper, limit)))
+        # everyone sharing the fetch gets their own copy to change as they like
+        return copy.deepcopy(list(shared))
+
+    unique_pairs = list(set(tuple(pair) for pair in pairs))
+    departures = {}
+    errors = {}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(pair, executor.submit(fetch_pair, pair)) for pair in unique_pairs]
+        for pair, future in futures:
+            error = future.exception()
+            if error is not None:
+                errors[pair] = error
+            else:
+                departures[pair] = future.result()
+    return departures, errors
+
+def departures_url(src_station_id, dst_station_id):
+    return nir_departures_url_template % { 'src': src_station_id, 'dst': dst_station_id }
+
+def parse_departures(page, src_station_id, station_mapper):
+    """
+    Yields the departures listed on a journeycheck departures page
+    """
 
     departuresList = page.find('div', id='portletDivBodyliveDepartures')
     assert departuresList is not None
@@ -240,6 +535,153 @@ def get_departures_by_station_ids(src_station_id, dst_station_id, station_mapper
     if train is not None:
         yield (train, waypoints)
 
+class DeparturesParser(HTMLParser):
+    """
+    Incremental parser for journeycheck departures pages: feed it the page a
+    chunk at a time and collect each (train, waypoints) with pop_departures()
+    as soon as it's complete, i.e. once the next train's row (or the end of
+    the departures list) has been seen.
+    """
+
+    def __init__(self, src_station_id, station_mapper):
+        HTMLParser.__init__(self)
+        self.src_station_id = src_station_id
+        self.station_mapper = station_mapper
+        self.finished = False
+
+        self._departures = []
+        self._div_depth = 0
+        self._row_type = None
+        self._cells = []
+        self._cell = None
+
+        self._train = None
+        self._waypoints = []
+
+    def pop_departures(self):
+        departures, self._departures = self._departures, []
+        return departures
+
+    def handle_starttag(self, tag, attrs):
+        if self.finished:
+            return
+        if tag == 'div':
+            if self._div_depth:
+                self._div_depth += 1
+            elif dict(attrs).get('id') == 'portletDivBodyliveDepartures':
+                self._div_depth = 1
+            return
+        if not self._div_depth:
+            return
+
+        if tag == 'tr':
+            attrs = dict(attrs)
+            if 'onclick' in attrs:
+                self._start_row('train')
+            elif 'callingPatternRow' in (attrs.get('class') or '').split():
+                self._start_row('waypoint')
+        elif tag == 'td' and self._row_type is not None:
+            self._end_cell()
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if not self._div_depth or self.finished:
+            return
+        if tag == 'div':
+            self._div_depth -= 1
+            if not self._div_depth:
+                self._end_row()
+                self._end_train()
+                self.finished = True
+        elif tag == 'td':
+            self._end_cell()
+        elif tag == 'tr':
+            self._end_row()
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    # only called on python 2, python 3 converts references to data for us
+    def handle_entityref(self, name):
+        self.handle_data(unichr(name2codepoint.get(name, 0x3f)))
+
+    def handle_charref(self, name):
+        if name.lower().startswith('x'):
+            self.handle_data(unichr(int(name[1:], 16)))
+        else:
+            self.handle_data(unichr(int(name)))
+
+    def _start_row(self, row_type):
+        self._end_row()
+        if row_type == 'train':
+            self._end_train()
+        self._row_type = row_type
+        self._cells = []
+
+    def _end_cell(self):
+        if self._cell is not None:
+            self._cells.append(u"".join(self._cell))
+            self._cell = None
+
+    def _end_row(self):
+        if self._row_type is None:
+            return
+        self._end_cell()
+        row_type, cells = self._row_type, self._cells
+        self._row_type, self._cells = None, []
+
+        if row_type == 'train':
+            train_departure_time = datetime_from_nir_time(cells[1].strip())
+            train_departure_status = cells[2].strip()
+            train_dst_id = self.station_mapper.id_for_name(cells[3].strip())
+            self._train = (self.src_station_id, train_dst_id, train_departure_time, train_departure_status)
+            self._waypoints = []
+        elif self._train is not None:
+            waypoint_time = datetime_from_nir_time(cells[0].strip()[:len(u" Dep.")])
+            waypoint_status = cells[1].strip()
+            waypoint_station_name = cells[2].replace(u"\xa0", u" ").strip()
+            waypoint_station_id = self.station_mapper.id_for_name(waypoint_station_name)
+            self._waypoints.append( (waypoint_time, waypoint_station_id, waypoint_status) )
+
+    def _end_train(self):
+        if self._train is not None:
+            self._departures.append((self._train, self._waypoints))
+        self._train = None
+        self._waypoints = []
+
+def iter_departures(chunks, src_station_id, station_mapper, limit=None, encoding='utf-8'):
+    """
+    Yields departures from a journeycheck departures page given as an
+    iterable of byte chunks, as soon as each is complete and stopping after
+    limit departures if given
+    """
+
+    parser = DeparturesParser(src_station_id, station_mapper)
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    count = 0
+
+    for chunk in chunks:
+        with metrics.timed('parse'):
+            parser.feed(decoder.decode(chunk))
+        for departure in parser.pop_departures():
+            yield departure
+            count += 1
+            if limit is not None and count >= limit:
+                return
+        if parser.finished:
+            return
+
+    with metrics.timed('parse'):
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+    assert parser.finished, 'no departures list found'
+    for departure in parser.pop_departures():
+        yield departure
+        count += 1
+        if limit is not None and count >= limit:
+            return
+
 def get_departures_by_station_names(src_station_name, dst_station_name, station_mapper):
     """
     Yields upcoming departures from the given src_station_id, to the given dst_station_id
@@ -0,0 +1,308 @@
+"""
+Keeps NI Railways departures for a set of station pairs up to date by
+polling journeycheck on an adaptive schedule, pushing only the trains whose
+status changed to subscribers.
+"""
+from __future__ import print_function
+
+import collections
+import datetime
+import json
+import threading
+import time
+try:
+    # python 3+
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+    import queue
+except ImportError:
+    # python 2+
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from urlparse import urlparse
+    import Queue as queue
+
+from . import nir
+
+
+# poll at least this often (seconds) while anything changes or a train is due
+# soon, and back off to at most max_interval while nothing does. Departures
+# pages are cached for nir.DEPARTURES_CACHE_TIME, so polling faster than that
+# gains nothing.
+DEFAULT_MIN_INTERVAL = 30
+DEFAULT_MAX_INTERVAL = 300
+DEFAULT_SOON = datetime.timedelta(minutes=20)
+
+NEW = 'new'
+CHANGED = 'changed'
+GONE = 'gone'
+
+DepartureUpdate = collections.namedtuple('DepartureUpdate', ['src', 'dst', 'change', 'train', 'waypoints'])
+
+
+def train_key(train):
+    # (src station id, dst station id, departure time) identifies a train
+    return train[:3]
+
+
+def minutes_until(departure_time, now):
+    """Minutes from now until a departure's time of day, wrapping past midnight
+    """
+    departs = departure_time.hour * 60 + departure_time.minute
+    return (departs - (now.hour * 60 + now.minute)) % (24 * 60)
+
+
+class _PairState(object):
+
+    __slots__ = ('next_poll', 'interval', 'departures')
+
+    def __init__(self, next_poll, interval):
+        self.next_poll = next_poll
+        self.interval = interval
+        # train key -> (train, waypoints)
+        self.departures = collections.OrderedDict()
+
+
+class DeparturePoller(object):
+    """
+    Polls upcoming departures for every tracked (src_station_id,
+    dst_station_id) pair, each on its own schedule: every min_interval
+    seconds while departures keep changing or a train leaves within soon,
+    backing off (doubling up to max_interval) while nothing changes.
+
+    Subscribers are called with a DepartureUpdate for each train which is
+    new, changed status or has gone since the last poll. Call poll() from
+    your own loop, or start() to poll from a background thread.
+    """
+
+    def __init__(self, station_mapper, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 soon=DEFAULT_SOON, max_workers=8, clock=time.time):
+        self.station_mapper = station_mapper
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.soon = soon
+        self.max_workers = max_workers
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._pairs = {}
+        self._subscribers = []
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def track(self, src_station_id, dst_station_id):
+        with self._lock:
+            if (src_station_id, dst_station_id) not in self._pairs:
+                self._pairs[(src_station_id, dst_station_id)] = _PairState(self.clock(), self.min_interval)
+        self._wakeup.set()
+
+    def untrack(self, src_station_id, dst_station_id):
+        with self._lock:
+            self._pairs.pop((src_station_id, dst_station_id), None)
+
+    def subscribe(self, callback, src_station_id=None, dst_station_id=None):
+        """
+        Call callback(update) for every DepartureUpdate, or only those for
+        the given src and/or dst station. Callbacks run on the polling
+        thread, so should hand anything slow off elsewhere.
+        """
+        with self._lock:
+            self._subscribers.append((callback, src_station_id, dst_station_id))
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            # compared with == so bound methods (e.g. queue.put) can be unsubscribed
+            self._subscribers = [s for s in self._subscribers if s[0] != callback]
+
+    def departures(self, src_station_id, dst_station_id):
+        """The latest known departures for a tracked pair
+        """
+        with self._lock:
+            return list(self._pairs[(src_station_id, dst_station_id)].departures.values())
+
+    def next_poll_time(self):
+        with self._lock:
+            return min([state.next_poll for state in self._pairs.values()] or [None])
+
+    def poll(self):
+        """
+        Fetch every pair that's due, notify subscribers of what changed and
+        reschedule each pair. Returns the list of DepartureUpdates.
+        """
+        now = self.clock()
+        with self._lock:
+            due = [pair for pair, state in self._pairs.items() if state.next_poll <= now]
+        if not due:
+            return []
+
+        departures, errors = nir.get_departures_for_pairs(due, self.station_mapper, max_workers=self.max_workers)
+
+        updates = []
+        with self._lock:
+            for pair in due:
+                state = self._pairs.get(pair)
+                if state is None:
+                    # untracked while we were fetching
+                    continue
+                if pair in errors:
+                    # try again later rather than hammering a failing upstream
+                    self._reschedule(state, now, changed=False, due_soon=False)
+                    continue
+                pair_updates = self._update(pair, state, departures[pair])
+                updates.extend(pair_updates)
+                self._reschedule(state, now, bool(pair_updates), self._due_soon(state, now))
+            subscribers = list(self._subscribers)
+
+        for update in updates:
+            for callback, src_station_id, dst_station_id in subscribers:
+                if src_station_id not in (None, update.src) or dst_station_id not in (None, update.dst):
+                    continue
+                try:
+                    callback(update)
+                except Exception:
+                    # one broken subscriber mustn't stop the others hearing
+                    pass
+        return updates
+
+    def _update(self, pair, state, departures):
+        src_station_id, dst_station_id = pair
+        latest = collections.OrderedDict((train_key(train), (train, waypoints)) for train, waypoints in departures)
+        updates = []
+        for key, (train, waypoints) in latest.items():
+            previous = state.departures.get(key)
+            if previous is None:
+                updates.append(DepartureUpdate(src_station_id, dst_station_id, NEW, train, waypoints))
+            elif previous != (train, waypoints):
+                updates.append(DepartureUpdate(src_station_id, dst_station_id, CHANGED, train, waypoints))
+        for key, (train, waypoints) in state.departures.items():
+            if key not in latest:
+                updates.append(DepartureUpdate(src_station_id, dst_station_id, GONE, train, waypoints))
+        state.departures = latest
+        return updates
+
+    def _due_soon(self, state, now):
+        soon = self.soon.total_seconds() / 60
+        now = datetime.datetime.fromtimestamp(now)
+        return any(minutes_until(train[2], now) <= soon for train, waypoints in state.departures.values())
+
+    def _reschedule(self, state, now, changed, due_soon):
+        if changed or due_soon:
+            state.interval = self.min_interval
+        else:
+            state.interval = min(state.interval * 2, self.max_interval)
+        state.next_poll = now + state.interval
+
+    def run(self):
+        """Poll until stop() is called
+        """
+        while not self._stopped.is_set():
+            self.poll()
+            next_poll = self.next_poll_time()
+            timeout = None if next_poll is None else max(0, next_poll - self.clock())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def start(self):
+        """Poll from a background (daemon) thread
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def update_as_json(update):
+    train, waypoints = update.train, update.waypoints
+    return json.dumps({
+        'src': update.src,
+        'dst': update.dst,
+        'change': update.change,
+        'train': {
+            'src': train[0],
+            'dst': train[1],
+            'departs': train[2].strftime('%H:%M'),
+            'status': train[3],
+        },
+        'waypoints': [{'time': waypoint_time.strftime('%H:%M'), 'station': station_id, 'status': status}
+                      for waypoint_time, station_id, status in waypoints],
+    })
+
+
+class _SSEHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/events':
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        updates = queue.Queue()
+        self.server.poller.subscribe(updates.put, query.get('src', [None])[0], query.get('dst', [None])[0])
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            while not self.server.closing:
+                try:
+                    update = updates.get(timeout=self.server.keepalive)
+                except queue.Empty:
+                    # comments keep proxies from timing the stream out
+                    self.wfile.write(b': keepalive\n\n')
+                else:
+                    self.wfile.write(('event: departure\ndata: ' + update_as_json(update) + '\n\n').encode('utf-8'))
+                self.wfile.flush()
+        except (IOError, OSError):
+            # client went away
+            pass
+        finally:
+            self.server.poller.unsubscribe(updates.put)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SSEServer(object):
+    """
+    Serves a poller's updates as Server-Sent Events from /events on a local
+    port, optionally filtered with ?src=...&dst=..., so any number of clients
+    can follow departures without each polling upstream.
+
+        >>> with SSEServer(poller, port=8080) as server:
+        ...     poller.run()
+    """
+
+    def __init__(self, poller, host='127.0.0.1', port=0, keepalive=15):
+        self.httpd = _ThreadingHTTPServer((host, port), _SSEHandler)
+        self.httpd.poller = poller
+        self.httpd.keepalive = keepalive
+        self.httpd.closing = False
+        self.url = 'http://%s:%d/events' % self.httpd.server_address[:2]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.closing = True
+        self.httpd.shutdown()
+        self.httpd.server_close()
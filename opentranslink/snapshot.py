@@ -0,0 +1,270 @@
+# marty mcfly imports
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# stdlib imports
+import json
+import sqlite3
+import threading
+import time
+
+# local imports
+from .compact import TimetableBlock
+from .compact import intern_text
+from .compact import times_from_bytes
+from .compact import times_to_bytes
+from .export import iter_route_blocks
+from .routes import Route
+from .routes import Timetable
+
+
+class MissingSnapshotError(Exception):
+    pass
+
+
+class MissingTimetableError(MissingSnapshotError):
+    """Raised when a route whose timetable couldn't be fetched is used
+    """
+    pass
+
+
+class IncompleteSnapshotError(Exception):
+    """Raised when finishing a snapshot some of whose routes aren't stored
+    """
+    pass
+
+
+def _staging(service_name):
+    # a new snapshot is built under this name, out of sight of readers of
+    # the current one, until finish_service() swaps it in
+    return service_name + '#staging'
+
+
+class StoredTimetable(Timetable):
+    """
+    A Timetable read from a SnapshotStore instead of translink.co.uk, its
+    blocks are only decoded the first time they're used.
+    """
+
+    def __init__(self, url, store, service_name, position):
+        self.url = url
+        self.soup = None
+        self.page_hash = None
+        self._blocks = None
+        self._times = None
+        self.store = store
+        self.service_name = service_name
+        self.position = position
+
+    def _parse_blocks(self):
+        return self.store.load_blocks(self.service_name, self.position)
+
+
+class SnapshotStore(object):
+    """
+    Keeps the routes and compact timetables of any number of services in a
+    single SQLite file, so they can be served without touching the network.
+
+        >>> store = SnapshotStore('/var/lib/opentranslink/snapshot.sqlite')
+        >>> store.save_service(Service('ulsterbus'))
+        >>> ulsterbus = Service('ulsterbus', snapshot=store)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            # created_at stays NULL until every route of the service is stored
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS services ('
+                'service TEXT PRIMARY KEY, service_url TEXT, created_at REAL)'
+            )
+            # error holds why a route's timetable couldn't be fetched, if it couldn't
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS routes ('
+                'service TEXT, position INTEGER, code TEXT, name TEXT, url TEXT, fetched INTEGER, error TEXT, '
+                'PRIMARY KEY (service, position))'
+            )
+            if 'error' not in [row[1] for row in self._db.execute('PRAGMA table_info(routes)')]:
+                # stores written before failures were recorded
+                self._db.execute('ALTER TABLE routes ADD COLUMN error TEXT')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS blocks ('
+                'service TEXT, position INTEGER, block_no INTEGER, label TEXT, stops TEXT, '
+                'times BLOB, extras TEXT, PRIMARY KEY (service, position, block_no))'
+            )
+
+    def save_service(self, service, max_workers=8, progress=None, allow_failures=False):
+        """
+        Fetch every route and timetable of service (concurrently, using at
+        most max_workers threads) and store them, replacing anything stored
+        for the service before. The new snapshot is built alongside the old
+        one, which keeps being served until every route has been stored.
+
+        Returns a dict mapping the url of each route that failed to the
+        exception it raised. If any did the old snapshot is kept, unless
+        allow_failures is set, in which case the new one is used and the
+        failed routes raise MissingTimetableError when their timetables are.
+        If given, progress is called as progress(done, route) as each route
+        is written.
+        """
+        routes = service.routes()
+        positions = dict((id(route), position) for position, route in enumerate(routes))
+        name = service.service_name
+        self.begin_service(name, service.service_url, routes)
+
+        # only writes take the lock, reads carry on while we're fetching
+        errors = {}
+        stored = set()
+        for done, (route, blocks) in enumerate(iter_route_blocks(routes, max_workers, errors), 1):
+            self.add_timetable(name, positions[id(route)], blocks)
+            stored.add(positions[id(route)])
+            if progress is not None:
+                progress(done, route)
+        for position, route in enumerate(routes):
+            if position not in stored:
+                self.add_failure(name, position, errors.get(route.url))
+
+        if not errors or allow_failures:
+            self.finish_service(name, allow_failures=allow_failures)
+        return errors
+
+    def begin_service(self, service_name, service_url, routes):
+        """
+        Start a new snapshot of a service, to be filled in a route at a time
+        with add_timetable() (or add_failure()) and swapped in for the
+        current one by finish_service(). Until then the current snapshot, if
+        any, is served as before, and pending_routes() lists the routes
+        still to be stored so an interrupted snapshot can be picked up where
+        it left off. Any unfinished snapshot of the service is discarded.
+        """
+        with self._lock:
+            with self._db:
+                self._delete_service(_staging(service_name))
+                self._db.execute('INSERT INTO services VALUES (?, ?, NULL)', (_staging(service_name), service_url))
+                self._db.executemany(
+                    'INSERT INTO routes VALUES (?, ?, ?, ?, ?, 0, NULL)',
+                    [(_staging(service_name), position, route.code, route.name, route.url)
+                     for position, route in enumerate(routes)]
+                )
+
+    def add_timetable(self, service_name, position, blocks):
+        """Store the timetable blocks of the route at position in the new snapshot's route list
+        """
+        service_name = _staging(service_name)
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM blocks WHERE service = ? AND position = ?', (service_name, position))
+                self._db.executemany(
+                    'INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(service_name, position, block_no, block.label, json.dumps(block.stops),
+                      sqlite3.Binary(times_to_bytes(block.times)),
+                      json.dumps(sorted((t, s, c) for (t, s), c in block.extras.items())))
+                     for block_no, block in enumerate(blocks)]
+                )
+                self._db.execute('UPDATE routes SET fetched = 1, error = NULL WHERE service = ? AND position = ?',
+                                 (service_name, position))
+
+    def add_failure(self, service_name, position, error):
+        """
+        Record that the timetable of the route at position couldn't be
+        fetched. The route stays pending, so resuming tries it again.
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute('UPDATE routes SET error = ? WHERE service = ? AND position = ?',
+                                 (repr(error), _staging(service_name), position))
+
+    def finish_service(self, service_name, allow_failures=False):
+        """
+        Swap the new snapshot of a service in for the current one, in a
+        single transaction. Raises IncompleteSnapshotError if any route
+        hasn't been stored, or has failed unless allow_failures is set.
+        """
+        staging = _staging(service_name)
+        with self._lock:
+            with self._db:
+                if self._db.execute('SELECT 1 FROM services WHERE service = ?', (staging,)).fetchone() is None:
+                    raise MissingSnapshotError('no new snapshot of {0} in {1}'.format(service_name, self.path))
+                missing, failed = self._db.execute(
+                    'SELECT COALESCE(SUM(error IS NULL), 0), COALESCE(SUM(error IS NOT NULL), 0) '
+                    'FROM routes WHERE service = ? AND NOT fetched', (staging,)).fetchone()
+                if missing or (failed and not allow_failures):
+                    raise IncompleteSnapshotError('{0} routes of {1} not stored, {2} failed'.format(
+                        missing + failed, service_name, failed))
+                self._delete_service(service_name)
+                for table in ('services', 'routes', 'blocks'):
+                    self._db.execute('UPDATE {0} SET service = ? WHERE service = ?'.format(table),
+                                     (service_name, staging))
+                self._db.execute('UPDATE services SET created_at = ? WHERE service = ?', (time.time(), service_name))
+
+    def pending_routes(self, service_name):
+        """
+        Returns [(position, code, url)] for every route of the new snapshot
+        of the service whose timetable hasn't been stored (including those
+        that failed), or None if no new snapshot has been started
+        """
+        staging = _staging(service_name)
+        with self._lock:
+            if self._db.execute('SELECT 1 FROM services WHERE service = ?', (staging,)).fetchone() is None:
+                return None
+            return self._db.execute(
+                'SELECT position, code, url FROM routes WHERE service = ? AND NOT fetched ORDER BY position',
+                (staging,)
+            ).fetchall()
+
+    def _delete_service(self, service_name):
+        self._db.execute('DELETE FROM services WHERE service = ?', (service_name,))
+        self._db.execute('DELETE FROM routes WHERE service = ?', (service_name,))
+        self._db.execute('DELETE FROM blocks WHERE service = ?', (service_name,))
+
+    def has_service(self, service_name):
+        return self.created_at(service_name) is not None
+
+    def created_at(self, service_name):
+        """When the service was last saved, or None if it never has been (or
+        is still being saved)
+        """
+        with self._lock:
+            row = self._db.execute('SELECT created_at FROM services WHERE service = ?', (service_name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def load_routes(self, service_name):
+        """
+        Returns the stored routes of a service, each with a timetable which
+        is decoded from the store the first time it's used
+        """
+        if not self.has_service(service_name):
+            raise MissingSnapshotError('no snapshot of {0} in {1}'.format(service_name, self.path))
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT position, code, name, url FROM routes WHERE service = ? ORDER BY position', (service_name,)
+            ).fetchall()
+        routes = []
+        for position, code, name, url in rows:
+            route = Route(code, name, url)
+            route._timetable = StoredTimetable(url, self, service_name, position)
+            routes.append(route)
+        return routes
+
+    def load_blocks(self, service_name, position):
+        with self._lock:
+            row = self._db.execute('SELECT error FROM routes WHERE service = ? AND position = ?',
+                                   (service_name, position)).fetchone()
+            if row is not None and row[0] is not None:
+                raise MissingTimetableError('route {0} of {1} was stored without a timetable: {2}'.format(
+                    position, service_name, row[0]))
+            rows = self._db.execute(
+                'SELECT label, stops, times, extras FROM blocks WHERE service = ? AND position = ? ORDER BY block_no',
+                (service_name, position)
+            ).fetchall()
+        return tuple(
+            TimetableBlock(intern_text(label), tuple(intern_text(stop) for stop in json.loads(stops)),
+                           times_from_bytes(times), dict(((t, s), c) for t, s, c in json.loads(extras)))
+            for label, stops, times, extras in rows
+        )
+
+    def close(self):
+        self._db.close()
@@ -3,17 +3,385 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-# third-party imports
-import requests
-from bs4 import BeautifulSoup
+# stdlib imports
+import threading
+import time
 
+# local imports
+from . import metrics
+from .cache import ResponseCache
 
-def make_request(method, url, **kwargs):
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+
+# upstream errors worth trying again, anything else in the 4xx/5xx range is
+# raised straight away
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+
+class RateLimiter(object):
+    """Blocks callers so that no more than `rate` calls per second are let
+    through, shared across threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def reserve(self):
+        """Take the next slot, returning how many seconds the caller must wait
+        for it (for callers which can't block, e.g. coroutines).
+        """
+        with self._lock:
+            now = time.time()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        return delay
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedRateLimiter(RateLimiter):
+    """A RateLimiter shared by every process it's handed to when they're
+    started, e.g. through a process pool's initargs.
+    """
+
+    def __init__(self, rate):
+        import multiprocessing
+        self.interval = 1.0 / rate
+        self._lock = multiprocessing.Lock()
+        self._shared_next_slot = multiprocessing.Value('d', 0.0, lock=False)
+
+    def reserve(self):
+        with self._lock:
+            now = time.time()
+            delay = self._shared_next_slot.value - now
+            self._shared_next_slot.value = max(now, self._shared_next_slot.value) + self.interval
+        return delay
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key: the first caller runs the
+    function and everyone else asking for that key meanwhile waits for and
+    shares its result (or exception). The very same result is handed to every
+    caller, so it should be immutable or copied before being changed.
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if leader:
+            try:
+                call.result = func(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class HTTPSession(object):
+    """A pooled, keep-alive HTTP session which retries failed requests with
+    exponential backoff, optionally rate limits requests upstream and serves
+    repeated requests from a ResponseCache.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 rate_limit=None, cache=None):
+        self.timeout = timeout
+        # sessions get an in-memory cache unless told otherwise, pass
+        # cache=False to turn caching off completely
+        self.cache = ResponseCache() if cache is None else (cache or None)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # rate_limit is requests per second, or a (Shared)RateLimiter to use
+        if hasattr(rate_limit, 'wait'):
+            self.rate_limiter = rate_limit
+        else:
+            self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        # requests is only imported once a session is needed, sparing
+        # anything that never makes a request the cost
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _backoff(self, attempt):
+        time.sleep(self.backoff_factor * (2 ** attempt))
+
+    def request(self, method, url, cache_ttl=None, **kwargs):
+        """Make HTTP request, raising an exception if it fails.
+
+        Responses are served from and stored in the session's cache (if it has
+        one), cache_ttl overrides how long this response stays fresh.
+        """
+        cache = self.cache
+        if cache is None or not cache.is_cacheable(method):
+            return self._request(method, url, **kwargs)
+
+        ttl = cache.ttl_for(url, cache_ttl)
+        if ttl <= 0:
+            return self._request(method, url, **kwargs)
+
+        key = cache.key(method, url, kwargs.get('params'), kwargs.get('data'))
+        entry = cache.get(key)
+        if entry is not None and entry.is_fresh(ttl):
+            cache.stats.incr('hits')
+            metrics.emit('cache_hits')
+            return self._cached_response(entry)
+
+        headers = cache.conditional_headers(entry, kwargs.get('headers'))
+        if headers is not None:
+            # stale, but we can ask upstream whether it's changed
+            kwargs['headers'] = headers
+            response = self._request(method, url, **kwargs)
+            if response.status_code == 304:
+                cache.stats.incr('revalidations')
+                metrics.emit('cache_revalidations')
+                return self._cached_response(cache.refresh(key, entry))
+        else:
+            response = self._request(method, url, **kwargs)
+
+        cache.stats.incr('misses')
+        metrics.emit('cache_misses')
+        cache.store(key, response)
+        return response
+
+    def iter_content(self, method, url, cache_ttl=None, chunk_size=8192, **kwargs):
+        """Make HTTP request, yielding the body in chunks as it arrives.
+
+        Fresh cached responses are yielded in one piece. Responses read to the
+        end are cached, closing the generator early abandons the transfer.
+        """
+        cache = self.cache
+        ttl = 0
+        if cache is not None and cache.is_cacheable(method):
+            ttl = cache.ttl_for(url, cache_ttl)
+        if ttl > 0:
+            key = cache.key(method, url, kwargs.get('params'), kwargs.get('data'))
+            entry = cache.get(key)
+            if entry is not None and entry.is_fresh(ttl):
+                cache.stats.incr('hits')
+                metrics.emit('cache_hits')
+                yield entry.body
+                return
+
+        response = self._request(method, url, stream=True, **kwargs)
+        body = []
+        try:
+            for chunk in response.iter_content(chunk_size):
+                body.append(chunk)
+                yield chunk
+        finally:
+            response.close()
+            metrics.emit('fetch_bytes', sum(len(chunk) for chunk in body))
+
+        if ttl > 0:
+            cache.stats.incr('misses')
+            metrics.emit('cache_misses')
+            cache.store(key, response, body=b''.join(body))
+
+    def _cached_response(self, entry):
+        import requests
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry.url
+        response.headers.update(entry.headers)
+        response._content = entry.body
+        return response
+
+    def _request(self, method, url, **kwargs):
+        """Make HTTP request, retrying connection errors and 5xx responses and
+        raising an exception if it ultimately fails.
+
+        Streamed responses are timed until their headers arrive, and their
+        size is left for the caller reading the body to report.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        with metrics.timed('fetch'):
+            response = self._request_with_retries(method, url, **kwargs)
+        if not kwargs.get('stream'):
+            metrics.emit('fetch_bytes', len(response.content))
+
+        # raise an exception if request is not successful
+        if not response.status_code == 200:
+            response.raise_for_status()
+        return response
+
+    def _request_with_retries(self, method, url, **kwargs):
+        import requests
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    break
+            metrics.emit('retries')
+            self._backoff(attempt)
+            attempt += 1
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_session(**kwargs):
+    """Replace the HTTP session shared by every request the library makes, see
+    HTTPSession for the available options.
+    """
+    global _session
+    with _session_lock:
+        old_session, _session = _session, HTTPSession(**kwargs)
+    if old_session is not None:
+        old_session.close()
+    return _session
+
+
+def get_session():
+    """Return the shared HTTP session, creating it with the default settings if
+    needed.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = HTTPSession()
+        return _session
+
+
+def fetch(method, url, **kwargs):
+    """Make HTTP request over the shared session, returning the response.
+    """
+    return get_session().request(method, url, **kwargs)
+
+
+def _default_parser():
+    try:
+        import lxml
+    except ImportError:
+        return 'html.parser'
+    return 'lxml'
+
+
+def available_parsers():
+    """The tree builders set_parser can choose from here, html.parser
+    always and lxml and html5lib if they're installed.
+    """
+    parsers = ['html.parser']
+    for features, module in [('lxml', 'lxml'), ('html5lib', 'html5lib')]:
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        parsers.append(features)
+    return parsers
+
+
+# picked the first time something is parsed, not on import
+_parser = None
+
+
+def set_parser(features):
+    """Choose the BeautifulSoup tree builder used to parse every page, e.g.
+    'lxml' (the default when installed), 'html.parser' or 'html5lib'.
+    """
+    global _parser
+    _parser = features
+
+
+def get_parser():
+    global _parser
+    if _parser is None:
+        _parser = _default_parser()
+    return _parser
+
+
+class LazyStrainer(object):
+    """
+    A SoupStrainer which is only built (importing bs4) the first time it's
+    used, so that modules can define the strainers they parse with without
+    slowing down import. Stands in for the SoupStrainer anywhere one is
+    expected.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._strainer = None
+
+    @property
+    def strainer(self):
+        if self._strainer is None:
+            from bs4 import SoupStrainer
+            self._strainer = SoupStrainer(*self._args, **self._kwargs)
+        return self._strainer
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            # e.g. copy and pickle probing for hooks before __init__ has run
+            raise AttributeError(name)
+        return getattr(self.strainer, name)
+
+
+def parse_html(markup, parse_only=None):
+    """Parse a page into a soup, keeping only the elements matched by the
+    parse_only SoupStrainer (or LazyStrainer) if one is given.
+    """
+    from bs4 import BeautifulSoup
+    parser = get_parser()
+    if parser == 'html5lib':
+        # html5lib always builds the whole tree and warns if asked not to
+        parse_only = None
+    if isinstance(parse_only, LazyStrainer):
+        parse_only = parse_only.strainer
+    with metrics.timed('parse'):
+        return BeautifulSoup(markup, parser, parse_only=parse_only)
+
+
+def make_request(method, url, parse_only=None, **kwargs):
     """Make HTTP request, raising an exception if it fails.
     """
-    request_func = getattr(requests, method)
-    response = request_func(url, **kwargs)
-    # raise an exception if request is not successful
-    if not response.status_code == requests.codes.ok:
-        response.raise_for_status()
-    return BeautifulSoup(response.text)
+    response = fetch(method, url, **kwargs)
+    return parse_html(response.text, parse_only)
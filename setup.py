@@ -16,14 +16,20 @@ setup(
     url='https://github.com/paddycarey/opentranslink',
     packages=[
         'opentranslink',
+        'opentranslink.services',
     ],
     package_dir={'opentranslink': 'opentranslink'},
     include_package_data=True,
     install_requires=[
         'beautifulsoup4>=4',
+        'futures; python_version < "3"',
         'requests>=2',
         'tablib',
     ],
+    extras_require={
+        'async': ['aiohttp>=3'],
+        'arrow': ['pyarrow'],
+    },
     license="MIT",
     zip_safe=False,
     keywords='opentranslink',
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_aio
+----------------------------------
+
+Tests for `opentranslink.aio` module.
+"""
+# stdlib imports
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+try:
+    import asyncio
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from opentranslink import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+# local imports
+from opentranslink.cache import ResponseCache
+from tests.test_services import load_fixture
+
+
+class FakeAsyncSession(object):
+    """Serves fixture pages in place of AsyncHTTPSession
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    async def request(self, method, url, cache_ttl=None, **kwargs):
+        self.requests.append((method, url))
+        if 'journeycheck' in url:
+            return load_fixture('journeycheck_departures.html').encode('utf-8')
+        if '/Timetable/' in url:
+            return load_fixture('timetable.html').encode('utf-8')
+        return load_fixture('routes_page1.html' if method == 'get' else 'routes_page2.html').encode('utf-8')
+
+    async def close(self):
+        pass
+
+
+@unittest.skipIf(aio is None, 'aiohttp is not installed')
+class TestAsyncService(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.session = FakeAsyncSession()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_routes_pages_through_results(self):
+        """Concurrent routes() calls share a single walk of the paged route list
+        """
+        service = aio.AsyncService('goldline', session=self.session)
+
+        async def fetch_twice():
+            return await asyncio.gather(service.routes(), service.routes())
+
+        first, second = self.run_async(fetch_twice())
+        self.assertIs(first, second)
+        self.assertEqual(['212', '251', '261', '273', '274'], [route.code for route in first])
+        self.assertEqual(['get', 'post'], [method for method, _ in self.session.requests])
+
+    def test_route_timetable(self):
+        """Timetables fetched asynchronously are shared with the synchronous Route
+        """
+        service = aio.AsyncService('goldline', session=self.session)
+        route = self.run_async(service.route('273'))
+        times = self.run_async(service.timetable(route))
+        self.assertEqual(['Mondays to Fridays', 'Saturdays'], [label for label, _ in times])
+        self.assertIs(times, route.timetable)
+
+    def test_departures(self):
+        """Departures are parsed from journeycheck pages
+        """
+        station_mapper = self.run_async(aio.get_station_mapper(self.session))
+        departures = self.run_async(aio.get_departures_by_station_ids('GVA', 'PDN', station_mapper, self.session))
+        self.assertEqual(['PDN', 'NRY', 'LBN'], [train[1] for train, _ in departures])
+        self.assertEqual(['CLA', 'LBN', 'PDN'], [waypoint[1] for waypoint in departures[0][1]])
+
+
+@unittest.skipIf(aio is None, 'aiohttp is not installed')
+class TestAsyncHTTPSession(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.cache = ResponseCache(default_ttl=60)
+        self.rate_limiter = mock.Mock()
+        self.rate_limiter.reserve.return_value = 0
+        self.session = aio.AsyncHTTPSession(cache=self.cache, rate_limit=self.rate_limiter)
+        self.conditions = []
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.session.close())
+        self.loop.close()
+
+    async def handle(self, request):
+        self.conditions.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=b'page', headers={'ETag': '"v1"'})
+
+    def test_cached_and_revalidated(self):
+        """Responses are cached, revalidated once stale and every request is rate limited
+        """
+        app = web.Application()
+        app.router.add_get('/', self.handle)
+
+        async def fetch():
+            async with TestServer(app) as server:
+                url = str(server.make_url('/'))
+                bodies = [await self.session.request('get', url), await self.session.request('get', url)]
+                # age the entry past its ttl
+                self.cache.get(self.cache.key('get', url)).stored_at -= 120
+                bodies.append(await self.session.request('get', url))
+                return bodies
+
+        self.assertEqual([b'page'] * 3, self.loop.run_until_complete(fetch()))
+        self.assertEqual([None, '"v1"'], self.conditions)
+        self.assertEqual(1, self.cache.stats.revalidations)
+        self.assertEqual(2, self.rate_limiter.reserve.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cache
+----------------------------------
+
+Tests for `opentranslink.cache` module.
+"""
+# stdlib imports
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from opentranslink.cache import CacheEntry
+from opentranslink.cache import MemoryCache
+from opentranslink.cache import ResponseCache
+from opentranslink.cache import SQLiteCache
+from opentranslink.utils import HTTPSession
+from opentranslink.utils import configure_session
+from opentranslink.utils import fetch
+from tests.test_utils import fake_response
+
+
+def make_entry(body):
+    return CacheEntry('http://example.com/', body, {}, 0)
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted once over max_bytes
+        """
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', make_entry(b'1234'))
+        cache.set('b', make_entry(b'1234'))
+        cache.get('a')
+        cache.set('c', make_entry(b'1234'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(8, cache.size)
+        self.assertEqual(1, cache.stats.evictions)
+
+
+class TestSQLiteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = SQLiteCache(os.path.join(self.tmp_dir, 'cache.sqlite'), max_bytes=10)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip_and_eviction(self):
+        """Entries survive a round trip to disk and are evicted once over max_bytes
+        """
+        self.cache.set('a', CacheEntry('http://example.com/a', b'1234', {'ETag': '"x"'}, 5))
+        entry = self.cache.get('a')
+        self.assertEqual(b'1234', entry.body)
+        self.assertEqual('"x"', entry.etag)
+        self.assertEqual(5, entry.stored_at)
+
+        self.cache.set('b', make_entry(b'1234'))
+        self.cache.set('c', make_entry(b'1234'))
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual(1, self.cache.stats.evictions)
+
+
+class TestSessionCaching(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(ttls=[(r'/timetables/', 60)])
+        self.session = HTTPSession(cache=self.cache, backoff_factor=0)
+
+    def test_fresh_entries_are_served_from_cache(self):
+        """Repeated requests within the ttl only hit the network once
+        """
+        with mock.patch.object(self.session.session, 'request', return_value=fake_response(200, 'page')) as request:
+            self.session.request('get', 'http://example.com/timetables/1')
+            response = self.session.request('get', 'http://example.com/timetables/1')
+        self.assertEqual('page', response.text)
+        self.assertEqual(1, request.call_count)
+        self.assertEqual(1, self.cache.stats.hits)
+        self.assertEqual(1, self.cache.stats.misses)
+
+    def test_uncached_endpoints(self):
+        """Requests without a ttl always go to the network
+        """
+        with mock.patch.object(self.session.session, 'request', return_value=fake_response(200, 'page')) as request:
+            self.session.request('get', 'http://example.com/other')
+            self.session.request('get', 'http://example.com/other')
+        self.assertEqual(2, request.call_count)
+
+    def test_stale_entries_are_revalidated(self):
+        """Stale entries with an ETag are revalidated with a conditional request
+        """
+        first = fake_response(200, 'page')
+        first.headers['ETag'] = '"v1"'
+        with mock.patch.object(self.session.session, 'request', side_effect=[first, fake_response(304)]) as request:
+            self.session.request('get', 'http://example.com/timetables/1')
+            # age the entry past its ttl
+            self.cache.get(self.cache.key('get', 'http://example.com/timetables/1')).stored_at -= 120
+            response = self.session.request('get', 'http://example.com/timetables/1')
+        self.assertEqual('page', response.text)
+        self.assertEqual('"v1"', request.call_args_list[1][1]['headers']['If-None-Match'])
+        self.assertEqual(1, self.cache.stats.revalidations)
+
+    def test_streamed_responses(self):
+        """Streamed responses are cached only when read to the end
+        """
+        url = 'http://example.com/timetables/2'
+        with mock.patch.object(self.session.session, 'request', return_value=fake_response(200, 'a' * 100)) as request:
+            chunks = self.session.iter_content('get', url, chunk_size=10)
+            next(chunks)
+            chunks.close()
+            self.assertIsNone(self.cache.get(self.cache.key('get', url)))
+
+            self.assertEqual(b'a' * 100, b''.join(self.session.iter_content('get', url, chunk_size=10)))
+            self.assertEqual([b'a' * 100], list(self.session.iter_content('get', url)))
+        self.assertEqual(2, request.call_count)
+        self.assertTrue(request.call_args[1]['stream'])
+
+
+class TestDefaultSession(unittest.TestCase):
+
+    def tearDown(self):
+        configure_session()
+
+    def test_timetables_cached_by_default(self):
+        """The default session serves repeated timetable fetches from its cache
+        """
+        session = configure_session()
+        url = 'http://www.translink.co.uk/Services/Goldline-Service-Page/Timetable/?routeId=1&outputFormat=0'
+        with mock.patch.object(session.session, 'request', return_value=fake_response(200, 'page')) as request:
+            fetch('get', url)
+            self.assertEqual('page', fetch('get', url).text)
+        self.assertEqual(1, request.call_count)
+        self.assertEqual(1, session.cache.stats.hits)
+
+    def test_default_ttls(self):
+        """Timetables stay fresh longest, then route lists, then live departures
+        """
+        cache = ResponseCache()
+        self.assertEqual(24 * 60 * 60, cache.ttl_for('http://www.translink.co.uk/Timetable/?routeId=1'))
+        self.assertEqual(60 * 60, cache.ttl_for('http://www.translink.co.uk/Routes-and-Timetables/Metro/'))
+        self.assertEqual(30, cache.ttl_for('http://www.journeycheck.com/nirailways/route?from=GVA&to=PDN'))
+        self.assertEqual(0, cache.ttl_for('http://example.com/'))
+        self.assertEqual(0, ResponseCache(ttls=[]).ttl_for('http://www.translink.co.uk/Timetable/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
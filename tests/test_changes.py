@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_changes
+----------------------------------
+
+Tests for `opentranslink.changes` module.
+"""
+# stdlib imports
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from opentranslink.changes import ADDED
+from opentranslink.changes import MODIFIED
+from opentranslink.changes import REMOVED
+from opentranslink.changes import ChangeLog
+from opentranslink.compact import TimetableBlock
+from tests.test_planner import make_route
+
+
+STOPS = ['Belfast', 'Moira', 'Lurgan']
+
+
+class TestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.changelog = ChangeLog(os.path.join(self.tmp_dir, 'changes.sqlite'))
+        self.routes = [
+            make_route('273', 'Saturdays', STOPS, [['0700', '0800'], ['0720', '0820'], ['0740', '0840']]),
+            make_route('212', 'Saturdays', ['Lisburn', 'Hillsborough'], [['0831'], ['0845']]),
+        ]
+        self.version = self.changelog.record('goldline', self.routes)
+
+    def tearDown(self):
+        self.changelog.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_first_record_adds_every_trip(self):
+        """The first version lists every trip as added
+        """
+        self.assertEqual(1, self.version)
+        changes = self.changelog.changes_since(0)
+        self.assertEqual(3, len(changes))
+        self.assertEqual(set([ADDED]), set(change.change for change in changes))
+
+    def test_unchanged_timetables(self):
+        """Recording identical timetables creates no new version, without diffing any trips
+        """
+        with mock.patch.object(self.changelog, '_diff_block') as diff_block:
+            self.assertEqual(self.version, self.changelog.record('goldline', self.routes))
+        self.assertFalse(diff_block.called)
+        self.assertEqual([], self.changelog.changes_since(self.version))
+
+    def test_trip_changes(self):
+        """Trips are reported as added, removed or modified, only for the routes that changed
+        """
+        self.routes[0] = make_route('273', 'Saturdays', STOPS,
+                                    [['0700', '0900'], ['0725', '0920'], ['0740', '0940']])
+        version = self.changelog.record('goldline', self.routes[:1])
+        changes = [(c.route, c.change, c.stop, c.departs) for c in self.changelog.changes_since(self.version)]
+        self.assertEqual([
+            ('273', MODIFIED, 'Belfast', 420),
+            ('273', ADDED, 'Belfast', 540),
+            ('273', REMOVED, 'Belfast', 480),
+            ('212', REMOVED, 'Lisburn', 511),
+        ], changes)
+        self.assertEqual(self.version + 1, version)
+        self.assertEqual([], self.changelog.block_hashes('goldline', '212'))
+
+    def test_inserted_block(self):
+        """A block inserted ahead of others only reports its own trips
+        """
+        sunday = TimetableBlock.from_columns('Sundays', list(STOPS), [['1000'], ['1020'], ['1040']])
+        self.routes[0]._timetable._blocks = [sunday] + list(self.routes[0].compact_timetable)
+        self.changelog.record('goldline', self.routes[::-1])
+        changes = [(c.route, c.change, c.label, c.departs) for c in self.changelog.changes_since(self.version)]
+        self.assertEqual([('273', ADDED, 'Sundays', 600)], changes)
+
+    def test_content_hash(self):
+        """Block hashes depend on the cells of the timetable, not how the block was built
+        """
+        block = self.routes[0].compact_timetable[0]
+        same = TimetableBlock.from_columns('Saturdays', list(STOPS), [['0700', '0800'], ['0720', '0820'], ['0740', '0840']])
+        other = TimetableBlock.from_columns('Saturdays', list(STOPS), [['0700', '0800'], ['0720', 'a'], ['0740', '0840']])
+        self.assertEqual(block.content_hash(), same.content_hash())
+        self.assertNotEqual(block.content_hash(), other.content_hash())
+        self.assertEqual([block.content_hash()], self.changelog.block_hashes('goldline', '273'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_export
+----------------------------------
+
+Tests for `opentranslink.export` module.
+"""
+# stdlib imports
+import csv
+import io
+import shutil
+import tempfile
+import unittest
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from opentranslink.export import ArrowWriter
+from opentranslink.export import GTFSWriter
+from opentranslink.export import export_service
+from opentranslink.routes import Route
+from tests.test_planner import make_route
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.routes = [
+            make_route('1', 'Mondays to Fridays', ['Belfast', 'Lisburn', 'Lurgan'],
+                       [['0800', '2350'], ['', '2420'], ['0850', '2440']]),
+            make_route('2', 'Saturdays', ['Lisburn', 'Hillsborough'], [['0831'], ['0845']]),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_gtfs(self, name):
+        with io.open(os.path.join(self.tmp_dir, name), encoding='utf-8', newline='') as f:
+            return list(csv.reader(f))
+
+    def test_gtfs_bundle(self):
+        """Every call becomes a stop_times row, with times past midnight kept over 24:00
+        """
+        errors = export_service(None, [GTFSWriter(self.tmp_dir)], routes=self.routes, max_workers=2)
+        self.assertEqual({}, errors)
+
+        stop_times = self.read_gtfs('stop_times.txt')
+        self.assertIn(['1-0-0', '08:00:00', '08:00:00', '1', '1'], stop_times)
+        self.assertIn(['1-0-1', '24:20:00', '24:20:00', '2', '2'], stop_times)
+        # trip 0 of route 1 doesn't call at Lisburn
+        self.assertEqual(['1', '3'], [row[3] for row in stop_times if row[0] == '1-0-0'])
+
+        trips = self.read_gtfs('trips.txt')
+        self.assertIn(['1', 'weekdays', '1-0-0', 'Lurgan'], trips)
+        self.assertIn(['2', 'saturday', '2-0-0', 'Hillsborough'], trips)
+        # Lisburn is shared between both routes
+        self.assertEqual([['stop_id', 'stop_name'], ['1', 'Belfast'], ['2', 'Lisburn'],
+                          ['3', 'Lurgan'], ['4', 'Hillsborough']],
+                         sorted(self.read_gtfs('stops.txt'), key=lambda row: row[0] != 'stop_id'))
+        self.assertEqual(3, len(self.read_gtfs('routes.txt')))
+
+    def test_gtfs_times_unwrapped_after_midnight(self):
+        """Times which step back past midnight within a trip are carried on over 24:00
+        """
+        late = make_route('3', 'Mondays to Fridays', ['Belfast', 'Lisburn', 'Lurgan'],
+                          [['2350'], ['0000'], ['0010']])
+        export_service(None, [GTFSWriter(self.tmp_dir)], routes=[late])
+        stop_times = self.read_gtfs('stop_times.txt')
+        self.assertEqual(['23:50:00', '24:00:00', '24:10:00'], [row[1] for row in stop_times[1:]])
+
+    def test_routes_sharing_a_code(self):
+        """Routes sharing a code (e.g. each direction) get their own route and trip ids
+        """
+        outbound = make_route('5', 'Mondays to Fridays', ['Belfast', 'Lisburn'], [['0800'], ['0830']])
+        inbound = make_route('5', 'Mondays to Fridays', ['Lisburn', 'Belfast'], [['0900'], ['0930']])
+        inbound.url += '?direction=inbound'
+        inbound.name = 'Lisburn - Belfast'
+        export_service(None, [GTFSWriter(self.tmp_dir)], routes=[outbound, inbound], max_workers=1)
+
+        trips = self.read_gtfs('trips.txt')[1:]
+        self.assertEqual(2, len(set(row[2] for row in trips)))
+        routes = self.read_gtfs('routes.txt')[1:]
+        self.assertEqual(['5', '5-2'], sorted(row[0] for row in routes))
+        self.assertEqual(['5', 'Lisburn - Belfast'], sorted(row[2] for row in routes))
+
+    def test_failed_routes_reported(self):
+        """Routes whose timetable can't be fetched are skipped and reported
+        """
+        broken = Route('X', 'X', 'not a url')
+        errors = export_service(None, [GTFSWriter(self.tmp_dir)], routes=self.routes + [broken])
+        self.assertEqual(['not a url'], list(errors))
+        self.assertEqual(4, len(self.read_gtfs('trips.txt')))
+
+    def test_arrow_batches(self):
+        """Rows are written in batches and read back intact
+        """
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise unittest.SkipTest('pyarrow is not installed')
+        path = os.path.join(self.tmp_dir, 'stop_times.parquet')
+        export_service(None, [ArrowWriter(path, batch_size=2)], routes=self.routes)
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(7, table.num_rows)
+        self.assertEqual({'Belfast', 'Lisburn', 'Lurgan', 'Hillsborough'}, set(table.column('stop_name').to_pylist()))
+
+
+if __name__ == '__main__':
+    unittest.main()
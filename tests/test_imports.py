@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_imports
+----------------------------------
+
+Tests that importing `opentranslink` stays cheap.
+"""
+# stdlib imports
+import subprocess
+import sys
+import unittest
+
+import os
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+
+
+# only imported once the code needing them runs
+DEFERRED_MODULES = ['requests', 'urllib3', 'bs4', 'lxml', 'html5lib', 'tablib', 'aiohttp', 'numpy', 'pyarrow']
+
+# far more than import opentranslink takes, but far less than it did when it
+# imported everything up front
+IMPORT_TIME_BUDGET = 0.5
+
+
+def import_times(statement):
+    """
+    Run statement in a fresh interpreter with -X importtime, returning
+    {module: cumulative seconds} for every module it imported
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=PARENT_DIR, stderr=subprocess.STDOUT).decode('utf-8')
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(cumulative) / 1000000.0
+    return times
+
+
+@unittest.skipIf(sys.version_info < (3, 7), '-X importtime needs Python 3.7+')
+class TestImportTime(unittest.TestCase):
+
+    def test_heavy_dependencies_deferred(self):
+        """Importing the package doesn't import requests, bs4, tablib and friends
+        """
+        times = import_times('import opentranslink')
+        self.assertIn('opentranslink', times)
+        imported = set(module.split('.')[0] for module in times)
+        self.assertEqual([], [module for module in DEFERRED_MODULES if module in imported])
+
+    def test_import_time_budget(self):
+        """Importing the package takes well under IMPORT_TIME_BUDGET seconds
+        """
+        # best of a few runs, so a busy machine doesn't fail the build
+        best = min(import_times('import opentranslink')['opentranslink'] for _ in range(3))
+        self.assertLess(best, IMPORT_TIME_BUDGET)
+
+    def test_no_providers_built(self):
+        """Importing the package doesn't build the service registry or any provider
+        """
+        times = import_times(
+            'import opentranslink, sys; '
+            'sys.exit(opentranslink.services._registry is not None)')
+        self.assertIn('opentranslink', times)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_metrics
+----------------------------------
+
+Tests for `opentranslink.metrics` module.
+"""
+# stdlib imports
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from opentranslink import metrics
+from opentranslink.cache import configure_parsed_cache
+from opentranslink.routes import Timetable
+from opentranslink.utils import HTTPSession
+from tests.test_services import load_fixture
+from tests.test_utils import fake_response
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = metrics.MetricsAggregator()
+        metrics.add_observer(self.aggregator)
+        self.session = HTTPSession(max_retries=2, backoff_factor=0)
+        configure_parsed_cache()
+
+    def tearDown(self):
+        metrics.remove_observer(self.aggregator)
+
+    def test_fetch_events(self):
+        """Requests report their timing, size, retries and cache hits and misses
+        """
+        responses = [fake_response(503), fake_response(200, 'hello')]
+        with mock.patch.object(self.session.session, 'request', side_effect=responses):
+            with metrics.operation('routes'):
+                self.session.request('get', 'http://example.com/', cache_ttl=60)
+                self.session.request('get', 'http://example.com/', cache_ttl=60)
+
+        summary = self.aggregator.summary()
+        self.assertEqual(1, summary[('retries', 'routes')])
+        self.assertEqual(1, summary[('cache_misses', 'routes')])
+        self.assertEqual(1, summary[('cache_hits', 'routes')])
+        self.assertEqual((1, 5, 5.0), summary[('fetch_bytes', 'routes')])
+        self.assertEqual(1, summary[('fetch_seconds', 'routes')][0])
+
+    def test_timetable_phases(self):
+        """Fetching and parsing a timetable reports each phase under the timetable operation
+        """
+        response = fake_response(200, load_fixture('timetable.html'))
+        with mock.patch('opentranslink.routes.fetch', return_value=response):
+            Timetable('http://example.com/').times
+
+        summary = self.aggregator.summary()
+        self.assertEqual(1, summary[('parse_seconds', 'timetable')][0])
+        self.assertEqual(2, summary[('transform_seconds', 'timetable')][0])
+
+    def test_prometheus_format(self):
+        """Histograms are rendered with cumulative buckets, counters as totals
+        """
+        for value in (0.002, 0.002, 60):
+            self.aggregator(metrics.Event('parse_seconds', value, 'timetable'))
+        self.aggregator(metrics.Event('cache_hits', 1, 'routes'))
+        lines = self.aggregator.prometheus().splitlines()
+        self.assertIn('opentranslink_cache_hits_total{operation="routes"} 1', lines)
+        self.assertIn('opentranslink_parse_seconds_bucket{operation="timetable",le="0.001"} 0', lines)
+        self.assertIn('opentranslink_parse_seconds_bucket{operation="timetable",le="0.005"} 2', lines)
+        self.assertIn('opentranslink_parse_seconds_bucket{operation="timetable",le="+Inf"} 3', lines)
+        self.assertIn('opentranslink_parse_seconds_count{operation="timetable"} 3', lines)
+
+    def test_no_observers(self):
+        """Nothing is timed once every observer is removed
+        """
+        metrics.remove_observer(self.aggregator)
+        with metrics.timed('parse') as timer:
+            pass
+        self.assertIsNone(timer.start)
+        self.assertEqual({}, self.aggregator.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_nir
+----------------------------------
+
+Tests for `opentranslink.services.nir` module.
+"""
+# stdlib imports
+import datetime
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# third-party imports
+from bs4 import BeautifulSoup
+
+# local imports
+from opentranslink.cache import ResponseCache
+from opentranslink.services import nir
+from opentranslink.utils import HTTPSession
+from tests.test_services import load_fixture
+from tests.test_utils import fake_response
+
+
+def departures_page():
+    return load_fixture('journeycheck_departures.html').encode('utf-8')
+
+
+def station_mapper():
+    return nir.parse_station_mapper(BeautifulSoup(departures_page(), 'html.parser'))
+
+
+class TestStreamingDepartures(unittest.TestCase):
+
+    def setUp(self):
+        self.page = departures_page()
+        self.station_mapper = station_mapper()
+        self.chunks_read = 0
+
+    def chunks(self, size=64):
+        for i in range(0, len(self.page), size):
+            self.chunks_read += 1
+            yield self.page[i:i + size]
+
+    def test_matches_soup_parser(self):
+        """The incremental parser gives the same departures as parsing the whole page
+        """
+        expected = list(nir.parse_departures(BeautifulSoup(self.page, 'html.parser'), 'GVA', self.station_mapper))
+        self.assertEqual(3, len(expected))
+        self.assertEqual(expected, list(nir.iter_departures(self.chunks(), 'GVA', self.station_mapper)))
+
+    def test_limit_stops_reading(self):
+        """Only as much of the page as needed for limit departures is read
+        """
+        departures = list(nir.iter_departures(self.chunks(), 'GVA', self.station_mapper, limit=1))
+        self.assertEqual(['PDN'], [train[1] for train, _ in departures])
+        self.assertLess(self.chunks_read, len(list(self.chunks())) - 1)
+
+    def test_split_entities(self):
+        """Chunks split in the middle of an entity or multi-byte character still parse
+        """
+        self.page = self.page.replace(b'Lisburn', u'Lisburné'.encode('utf-8'))
+        self.station_mapper.remove_mapping(u'LBN', u'Lisburn')
+        self.station_mapper.add_mapping(u'LBN', u'Lisburné')
+        for size in (1, 7, 8):
+            departures = list(nir.iter_departures(self.chunks(size), 'GVA', self.station_mapper))
+            self.assertEqual(['PDN', 'NRY', 'LBN'], [train[1] for train, _ in departures])
+
+    def test_trailing_markup_still_cached(self):
+        """A page with markup after the departures list is read to the end and cached
+        """
+        self.page += b'<div>footer</div>' * 2000
+        session = HTTPSession(cache=ResponseCache())
+        with mock.patch('opentranslink.services.nir.get_session', return_value=session):
+            with mock.patch.object(session.session, 'request',
+                                   side_effect=lambda *args, **kwargs: fake_response(200, self.page.decode('utf-8'))) as request:
+                for _ in range(3):
+                    departures = list(nir.get_departures_by_station_ids('GVA', 'PDN', self.station_mapper))
+                    self.assertEqual(['PDN', 'NRY', 'LBN'], [train[1] for train, _ in departures])
+        self.assertEqual(1, request.call_count)
+        self.assertEqual((2, 1), (session.cache.stats.hits, session.cache.stats.misses))
+
+
+class TestStationSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.station_mapper = station_mapper()
+
+    def search_ids(self, query):
+        return [station_id for station_id, _, _ in self.station_mapper.search(query)]
+
+    def test_exact_and_prefix_matches(self):
+        """Names match ignoring case and spacing, and on the start of any word
+        """
+        self.assertEqual([u'LBN'], self.search_ids(u'  LISBURN '))
+        self.assertEqual([u'GVA'], self.search_ids(u'great vic'))
+        self.assertEqual([u'GVA'], self.search_ids(u'victoria'))
+        self.assertEqual(1.0, self.station_mapper.search(u'Great Victoria Street')[0][2])
+
+    def test_fuzzy_matches(self):
+        """Misspelt names still resolve to the closest station
+        """
+        self.assertEqual(u'PDN', self.station_mapper.resolve_name(u'Portadwn'))
+        self.assertEqual(u'DRY', self.station_mapper.resolve_name(u'londonderr'))
+        with self.assertRaises(nir.InvalidStationNameExcept):
+            self.station_mapper.resolve_name(u'zzz')
+
+    def test_update_replaces_everything_at_once(self):
+        """Updating from another mapper swaps in its maps and a fresh index together
+        """
+        self.search_ids(u'lisburn')
+        fresh = nir.StationMapper.from_pairs([(u'NEW', u'Newtown'), (u'LBN', u'Lisburn')])
+        self.station_mapper.update_from(fresh)
+        self.assertEqual([u'NEW'], self.search_ids(u'newtown'))
+        self.assertEqual(u'NEW', self.station_mapper.id_for_name(u'Newtown'))
+        self.assertFalse(self.station_mapper.id_is_valid(u'GVA'))
+        # later changes to the other mapper aren't shared
+        fresh.add_mapping(u'OTH', u'Other')
+        self.assertFalse(self.station_mapper.id_is_valid(u'OTH'))
+
+    def test_index_follows_changes(self):
+        """The index is rebuilt when mappings change
+        """
+        self.assertEqual([], self.search_ids(u'Whitehead'))
+        self.station_mapper.add_mapping(u'WHD', u'Whitehead')
+        self.assertEqual([u'WHD'], self.search_ids(u'white'))
+
+
+class TestStationSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.tmp_dir, 'stations', 'nir.json')
+        self.station_mapper = station_mapper()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        """Snapshots load back into an identical mapper
+        """
+        self.station_mapper.save(self.snapshot_path)
+        loaded, created = nir.StationMapper.load(self.snapshot_path)
+        self.assertEqual(sorted(self.station_mapper.ids_and_names()), sorted(loaded.ids_and_names()))
+        self.assertEqual(u'LBN', loaded.id_for_name(u'Lisburn'))
+
+    def test_loaded_names_are_shared(self):
+        """Mappers loaded from the same snapshot share their station names
+        """
+        self.station_mapper.save(self.snapshot_path)
+        first, _ = nir.StationMapper.load(self.snapshot_path)
+        second, _ = nir.StationMapper.load(self.snapshot_path)
+        self.assertIs(first.name_for_id(u'LBN'), second.name_for_id(u'LBN'))
+
+    def test_other_versions_ignored(self):
+        """Snapshots from other versions, or missing snapshots, aren't loaded
+        """
+        self.station_mapper.save(self.snapshot_path)
+        with open(self.snapshot_path) as f:
+            snapshot = json.load(f)
+        snapshot['version'] += 1
+        with open(self.snapshot_path, 'w') as f:
+            json.dump(snapshot, f)
+        self.assertIsNone(nir.StationMapper.load(self.snapshot_path))
+        self.assertIsNone(nir.StationMapper.load(os.path.join(self.tmp_dir, 'missing.json')))
+
+    def test_load_station_mapper(self):
+        """Fresh snapshots are used as is, otherwise the station list is scraped and saved
+        """
+        with mock.patch('opentranslink.services.nir.get_station_mapper', return_value=self.station_mapper) as scrape:
+            nir.load_station_mapper(self.snapshot_path)
+            self.assertEqual(1, scrape.call_count)
+            self.assertTrue(os.path.exists(self.snapshot_path))
+
+            loaded = nir.load_station_mapper(self.snapshot_path)
+            self.assertEqual(1, scrape.call_count)
+            self.assertEqual(u'Lisburn', loaded.name_for_id(u'LBN'))
+
+    def test_stale_snapshot_refreshed(self):
+        """Stale snapshots are refreshed, updating the mapper already handed out
+        """
+        nir.StationMapper.from_pairs([(u'LBN', u'Lisburn')]).save(self.snapshot_path)
+        with mock.patch('opentranslink.services.nir.get_station_mapper', return_value=self.station_mapper):
+            loaded = nir.load_station_mapper(self.snapshot_path, max_age=datetime.timedelta(0),
+                                             background_refresh=False)
+        self.assertEqual(u'PDN', loaded.id_for_name(u'Portadown'))
+        self.assertEqual(8, len(list(nir.StationMapper.load(self.snapshot_path)[0].all_ids())))
+
+
+class TestBatchDepartures(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def fake_departures(self, src_station_id, dst_station_id, station_mapper, limit=None):
+        with self.lock:
+            self.calls.append((src_station_id, dst_station_id))
+        # stay in flight long enough for other callers to pile up behind us
+        time.sleep(0.1)
+        if dst_station_id == 'XXX':
+            raise nir.InvalidStationNameExcept('XXX')
+        return iter([('train', dst_station_id)])
+
+    def test_pairs_fetched_once(self):
+        """Duplicate pairs, within and across concurrent batches, are fetched once
+        """
+        pairs = [('GVA', 'PDN'), ('GVA', 'PDN'), ('GVA', 'LBN'), ('GVA', 'XXX')]
+        results = []
+
+        def run_batch():
+            results.append(nir.get_departures_for_pairs(pairs, None))
+
+        with mock.patch('opentranslink.services.nir.get_departures_by_station_ids', self.fake_departures):
+            threads = [threading.Thread(target=run_batch) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(3, len(self.calls))
+        for departures, errors in results:
+            self.assertEqual({('GVA', 'PDN'): [('train', 'PDN')], ('GVA', 'LBN'): [('train', 'LBN')]}, departures)
+            self.assertEqual([('GVA', 'XXX')], list(errors.keys()))
+
+        # batches sharing a fetch can't change each other's results
+        results[0][0][('GVA', 'PDN')].append('mine')
+        self.assertEqual([('train', 'PDN')], results[1][0][('GVA', 'PDN')])
+
+
+if __name__ == '__main__':
+    unittest.main()
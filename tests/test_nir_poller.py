@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_nir_poller
+----------------------------------
+
+Tests for `opentranslink.services.nir_poller` module.
+"""
+# stdlib imports
+import datetime
+import json
+import time
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+try:
+    import asyncio
+    from opentranslink import aio
+except (ImportError, SyntaxError):
+    aio = None
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from opentranslink.services import nir_poller
+from opentranslink.services.nir_poller import DeparturePoller
+from opentranslink.services.nir_poller import SSEServer
+
+
+def train(departs, status='On time'):
+    return ('GVA', 'PDN', datetime.datetime.strptime(departs, '%H:%M'), status)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        # 06:00 local time, well away from the trains below
+        self.now = time.mktime(datetime.datetime.combine(datetime.date.today(), datetime.time(6, 0)).timetuple())
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeparturePoller(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.poller = DeparturePoller(None, min_interval=30, max_interval=120, clock=self.clock)
+        self.poller.track('GVA', 'PDN')
+        self.departures = [(train('10:00'), []), (train('11:00'), [])]
+        patcher = mock.patch('opentranslink.services.nir.get_departures_for_pairs',
+                             side_effect=lambda pairs, mapper, max_workers: (
+                                 dict((pair, list(self.departures)) for pair in pairs), {}))
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_changes_pushed(self):
+        """Subscribers hear about new, changed and departed trains, and nothing else
+        """
+        updates = []
+        self.poller.subscribe(updates.append)
+        self.poller.poll()
+        self.assertEqual([nir_poller.NEW, nir_poller.NEW], [u.change for u in updates])
+
+        del updates[:]
+        self.departures = [(train('10:00', 'Delayed'), []), (train('12:00'), [])]
+        self.clock.now += 30
+        self.poller.poll()
+        self.assertEqual([(nir_poller.CHANGED, 'Delayed'), (nir_poller.NEW, 'On time'), (nir_poller.GONE, 'On time')],
+                         [(u.change, u.train[3]) for u in updates])
+
+    def test_backoff_while_unchanged(self):
+        """Unchanged pairs are polled less and less often, down to max_interval
+        """
+        self.poller.poll()
+        intervals = []
+        for _ in range(4):
+            self.clock.now = self.poller.next_poll_time()
+            previous = self.clock.now
+            self.poller.poll()
+            intervals.append(self.poller.next_poll_time() - previous)
+        self.assertEqual([60, 120, 120, 120], intervals)
+        self.assertEqual(5, self.fetch.call_count)
+
+    def test_fast_polling_near_departure(self):
+        """Pairs with a train leaving soon keep being polled every min_interval
+        """
+        self.departures = [(train('06:10'), [])]
+        self.poller.poll()
+        self.clock.now = self.poller.next_poll_time()
+        self.poller.poll()
+        self.assertEqual(self.clock.now + 30, self.poller.next_poll_time())
+
+    def test_server_sent_events(self):
+        """Updates are streamed to SSE clients as JSON
+        """
+        with SSEServer(self.poller, keepalive=0.1) as server:
+            response = urlopen(server.url + '?src=GVA', timeout=5)
+            while not self.poller._subscribers:
+                time.sleep(0.01)
+            self.poller.poll()
+            lines = [response.readline().decode('utf-8') for _ in range(2)]
+            response.close()
+        self.assertEqual('event: departure\n', lines[0])
+        data = json.loads(lines[1][len('data: '):])
+        self.assertEqual(('new', '10:00'), (data['change'], data['train']['departs']))
+
+    @unittest.skipIf(aio is None, 'aiohttp is not installed')
+    def test_async_iterator(self):
+        """Updates can be consumed from an event loop
+        """
+        async def first_two():
+            updates = aio.departure_updates(self.poller, 'GVA')
+            first = asyncio.ensure_future(updates.__anext__())
+            await asyncio.sleep(0)
+            self.poller.poll()
+            first = await first
+            second = await updates.__anext__()
+            await updates.aclose()
+            return [first, second]
+
+        loop = asyncio.new_event_loop()
+        try:
+            updates = loop.run_until_complete(first_two())
+        finally:
+            loop.close()
+        self.assertEqual(['10:00', '11:00'], [u.train[2].strftime('%H:%M') for u in updates])
+        self.assertEqual([], self.poller._subscribers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_planner
+----------------------------------
+
+Tests for `opentranslink.planner` module.
+"""
+# stdlib imports
+import unittest
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from opentranslink.compact import TimetableBlock
+from opentranslink.planner import JourneyPlanner
+from opentranslink.routes import Route
+from opentranslink.routes import Timetable
+
+
+def make_route(code, label, stops, columns):
+    route = Route(code, code, 'http://example.com/' + code)
+    route._timetable = Timetable(route.url, soup=object())
+    route._timetable._blocks = [TimetableBlock.from_columns(label, stops, columns)]
+    return route
+
+
+class TestJourneyPlanner(unittest.TestCase):
+
+    def setUp(self):
+        # 1: Belfast -> Lisburn -> Lurgan, 2: Lisburn -> Hillsborough,
+        # 3: a slow direct Belfast -> Hillsborough bus
+        self.planner = JourneyPlanner([
+            make_route('1', 'Mondays to Fridays', ['Belfast', 'Lisburn', 'Lurgan'],
+                       [['0800', '0900'], ['0830', '0930'], ['0850', '0950']]),
+            make_route('2', 'Mondays to Fridays', ['Lisburn', 'Hillsborough'],
+                       [['0831', '0835', '0940'], ['0845', '0849', '0954']]),
+            make_route('3', 'Mondays to Fridays', ['Belfast', 'Hillsborough'],
+                       [['0805'], ['0915']]),
+        ], transfer_time=2)
+
+    def test_transfer_beats_direct_route(self):
+        """The earliest arrival may involve changing buses, allowing for the transfer time
+        """
+        legs = self.planner.earliest_arrival('Belfast', 'hillsborough', '0755', 0)
+        self.assertEqual([('1', 'Belfast', 480, 'Lisburn', 510), ('2', 'Lisburn', 515, 'Hillsborough', 529)],
+                         [(leg.route.code, leg.from_stop, leg.departs, leg.to_stop, leg.arrives) for leg in legs])
+
+    def test_direct_route_when_transfer_missed(self):
+        """Later departures use the direct bus when no connection beats it
+        """
+        legs = self.planner.earliest_arrival('Belfast', 'Hillsborough', '0801', 'weekdays')
+        self.assertEqual(['3'], [leg.route.code for leg in legs])
+
+    def test_unreachable(self):
+        """No journey is found on days, stops or times without service
+        """
+        self.assertIsNone(self.planner.earliest_arrival('Belfast', 'Hillsborough', '0800', 'saturday'))
+        self.assertIsNone(self.planner.earliest_arrival('Belfast', 'Newry', '0800', 0))
+        self.assertIsNone(self.planner.earliest_arrival('Belfast', 'Hillsborough', '1000', 0))
+
+    def test_same_stop(self):
+        """Planning from a stop to itself needs no legs
+        """
+        self.assertEqual([], self.planner.earliest_arrival('Lisburn', 'lisburn', '0800', 0))
+
+    def test_trips_past_midnight(self):
+        """Calls after midnight on a late trip carry on past 1440 rather than being dropped
+        """
+        planner = JourneyPlanner([
+            make_route('4', 'Mondays to Fridays', ['Belfast', 'Lisburn', 'Lurgan'],
+                       [['2340'], ['2355'], ['0015']]),
+        ])
+        legs = planner.earliest_arrival('Belfast', 'Lurgan', '2330', 0)
+        self.assertEqual([('4', 'Belfast', 1420, 'Lurgan', 1455)],
+                         [(leg.route.code, leg.from_stop, leg.departs, leg.to_stop, leg.arrives) for leg in legs])
+
+
+if __name__ == '__main__':
+    unittest.main()
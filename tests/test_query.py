@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_query
+----------------------------------
+
+Tests for `opentranslink.query` module.
+"""
+# stdlib imports
+import datetime
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# third-party imports
+from bs4 import BeautifulSoup
+
+# local imports
+from opentranslink.query import DepartureIndex
+from opentranslink.routes import Route
+from opentranslink.routes import Timetable
+from tests.test_planner import make_route
+from tests.test_services import load_fixture
+
+
+def fixture_route(code='273'):
+    route = Route(code, 'Belfast - Lurgan', 'http://example.com/' + code)
+    route._timetable = Timetable(route.url, BeautifulSoup(load_fixture('timetable.html'), 'html.parser'))
+    return route
+
+
+class TestDepartureIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = DepartureIndex([fixture_route('273'), fixture_route('273a')])
+
+    def test_next_departures(self):
+        """Departures after a time are returned in order across every route
+        """
+        departures = self.index.next_departures('Moira, Main Street', '0800', 0, limit=3)
+        self.assertEqual([8 * 60 + 30] * 2 + [14 * 60 + 30], [d.minutes for d in departures])
+        self.assertEqual(['273', '273a'], sorted(d.route.code for d in departures[:2]))
+
+    def test_day_types(self):
+        """Saturday departures come from the Saturday blocks
+        """
+        saturday = datetime.date(2026, 10, 17)
+        departures = self.index.next_departures('belfast city centre,  europa buscentre', datetime.time(12, 0), saturday)
+        self.assertEqual([13 * 60, 13 * 60], [d.minutes for d in departures])
+        self.assertEqual([], self.index.next_departures('Moira, Main Street', '0800', 'Sundays'))
+
+    def test_no_departures_from_last_stop(self):
+        """Trips don't depart from the last stop they call at
+        """
+        self.assertEqual([], self.index.next_departures('Lurgan, Loughview Park and Ride Lough Road', '0000', 0))
+        # but the stop is still indexed, once per route and weekday block
+        self.assertEqual(4, len(self.index.stops['lurgan, loughview park and ride lough road']))
+
+    def test_day_names(self):
+        """Days of the week are accepted by name, anything else that isn't a day raises ValueError
+        """
+        self.assertEqual(self.index.next_departures('Moira, Main Street', '0800', 0),
+                         self.index.next_departures('Moira, Main Street', '0800', 'Monday'))
+        self.assertEqual([13 * 60, 13 * 60], [d.minutes for d in self.index.next_departures(
+            'belfast city centre, europa buscentre', '1200', 'sat')])
+        self.assertRaises(ValueError, self.index.next_departures, 'Moira, Main Street', '0800', 'someday')
+
+    def test_trips_past_midnight(self):
+        """Calls after midnight on a late trip are indexed past 1440, after the evening's departures
+        """
+        index = DepartureIndex([make_route('1', 'Saturdays', ['Belfast', 'Lisburn', 'Lurgan'],
+                                           [['2300', '2350'], ['2330', '0010'], ['2340', '0030']])])
+        self.assertEqual([1410, 1450], [d.minutes for d in index.next_departures('Lisburn', '2300', 'saturday')])
+
+    def test_label_variants(self):
+        """Labels written differently, e.g. 'Monday - Friday', map to their day type
+        """
+        index = DepartureIndex([make_route('1', 'Monday - Friday', ['Belfast', 'Lisburn'], [['0800'], ['0830']])])
+        self.assertEqual([480], [d.minutes for d in index.next_departures('Belfast', '0700', 0)])
+        self.assertEqual([], index.next_departures('Belfast', '0700', 'saturday'))
+
+    def test_unknown_labels_cover_every_day(self):
+        """Blocks with labels we don't recognise are logged and indexed under every day type
+        """
+        route = make_route('1', 'Schooldays Only', ['Belfast', 'Lisburn'], [['0800'], ['0830']])
+        with mock.patch('opentranslink.query.log') as log:
+            index = DepartureIndex([route])
+        self.assertEqual(1, log.warning.call_count)
+        for day in (0, 5, 6):
+            self.assertEqual([480], [d.minutes for d in index.next_departures('Belfast', '0700', day)])
+
+
+if __name__ == '__main__':
+    unittest.main()
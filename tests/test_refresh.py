@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_refresh
+----------------------------------
+
+Tests for `opentranslink.refresh` module.
+"""
+# stdlib imports
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from benchmarks.server import FixtureServer
+from opentranslink import Service
+from opentranslink.refresh import refresh_snapshot
+from opentranslink.routes import Route
+from opentranslink.snapshot import SnapshotStore
+
+
+class TestRefreshSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = SnapshotStore(os.path.join(self.tmp_dir, 'snapshot.sqlite'))
+        self.server = FixtureServer().__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume_in_worker_processes(self):
+        """An interrupted refresh fetches only the routes it hasn't stored, in worker processes
+        """
+        routes = [Route(code, code, self.server.url + '/Timetable/?routeId=' + code) for code in ('212', '251', '261')]
+        self.store.begin_service('goldline', 'http://example.com/', routes)
+        self.store.add_timetable('goldline', 0, [])
+
+        progress = mock.Mock()
+        errors = refresh_snapshot(self.store, ['goldline'], processes=2, shard_size=1,
+                                  rate_limit=100, resume=True, progress=progress)
+        self.assertEqual({}, errors)
+        self.assertEqual(2, progress.call_count)
+
+        stored = Service('goldline', snapshot=self.store).routes()
+        self.assertEqual([], stored[0].timetable)
+        self.assertEqual(['Mondays to Fridays', 'Saturdays'], [label for label, _ in stored[2].timetable])
+
+    def test_failed_routes_retried_on_resume(self):
+        """Failed routes stay pending and the previous snapshot is kept until they're stored
+        """
+        self.store.begin_service('goldline', 'http://example.com/', [])
+        self.store.finish_service('goldline')
+        routes = [Route('212', '212', self.server.url + '/Timetable/?routeId=212'), Route('251', '251', 'nope://x')]
+        self.store.begin_service('goldline', 'http://example.com/', routes)
+
+        errors = refresh_snapshot(self.store, ['goldline'], processes=1, resume=True)
+        self.assertEqual(['nope://x'], list(errors['goldline']))
+        self.assertEqual([], self.store.load_routes('goldline'))
+        self.assertEqual([(1, '251', 'nope://x')], list(self.store.pending_routes('goldline')))
+
+        progress = mock.Mock()
+        errors = refresh_snapshot(self.store, ['goldline'], processes=1, resume=True,
+                                  progress=progress, allow_failures=True)
+        self.assertEqual(['nope://x'], list(errors['goldline']))
+        self.assertEqual(1, progress.call_count)
+        self.assertIsNone(self.store.pending_routes('goldline'))
+        self.assertEqual(['212', '251'], [route.code for route in self.store.load_routes('goldline')])
+
+    def test_finished_services_skipped_on_resume(self):
+        """Resuming doesn't touch services whose snapshot is already complete
+        """
+        self.store.begin_service('goldline', 'http://example.com/', [])
+        self.store.finish_service('goldline')
+        with mock.patch('opentranslink.refresh.Service') as service:
+            self.assertEqual({}, refresh_snapshot(self.store, ['goldline'], resume=True))
+        self.assertFalse(service.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
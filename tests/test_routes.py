@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_routes
+----------------------------------
+
+Tests for `opentranslink.routes` module.
+"""
+# stdlib imports
+import json
+import pickle
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# third-party imports
+from bs4 import BeautifulSoup
+
+# local imports
+from opentranslink import Service
+from opentranslink.cache import configure_parsed_cache
+from opentranslink.compact import NO_STOP
+from opentranslink.compact import TimetableBlock
+from opentranslink.routes import TIMETABLE_STRAINER
+from opentranslink.routes import Timetable
+from opentranslink.services import ROUTES_STRAINER
+from opentranslink.utils import available_parsers
+from tests.test_services import load_fixture
+from tests.test_utils import fake_response
+
+
+def dump_times(times):
+    return [{'label': label, 'headers': dataset.headers, 'rows': [list(row) for row in dataset]}
+            for label, dataset in times]
+
+
+class TestTimetableParsing(unittest.TestCase):
+
+    def setUp(self):
+        self.markup = load_fixture('timetable.html')
+        # what Timetable.times gave when it built each dataset a column at a
+        # time with tablib's append_col
+        self.expected = json.loads(load_fixture('timetable_expected.json'))
+
+    def test_expected_times(self):
+        """Timetable blocks are parsed into one dataset per weekday block
+        """
+        times = Timetable('', BeautifulSoup(self.markup, 'html.parser')).times
+        self.assertEqual(self.expected, dump_times(times))
+        label, dataset = times[0]
+        self.assertEqual('Mondays to Fridays', label)
+        self.assertEqual(4, len(dataset))
+        self.assertEqual('', dataset.dict[1]['Moira, Main Street'])
+
+    def test_parsers_agree(self):
+        """Every parser, with or without the strainer, gives identical timetables
+        """
+        for features in available_parsers():
+            for parse_only in (None, TIMETABLE_STRAINER):
+                soup = BeautifulSoup(self.markup, features, parse_only=parse_only)
+                self.assertEqual(self.expected, dump_times(Timetable('', soup).times), features)
+
+    def test_route_pages_parsers_agree(self):
+        """Every parser, with or without the strainer, gives identical route pages
+        """
+        service = Service('goldline')
+        markup = load_fixture('routes_page1.html')
+
+        def parse(soup):
+            routes, last_page = service._parse_routes_page(soup)
+            return [(r.code, r.name, r.url) for r in routes], last_page, service._parse_next_page_data(soup)
+
+        expected = parse(BeautifulSoup(markup, 'html.parser'))
+        self.assertEqual(3, len(expected[0]))
+        self.assertFalse(expected[1])
+        for features in available_parsers():
+            soup = BeautifulSoup(markup, features, parse_only=ROUTES_STRAINER)
+            self.assertEqual(expected, parse(soup), features)
+
+
+class TestTimetableBlock(unittest.TestCase):
+
+    def setUp(self):
+        self.block = TimetableBlock.from_columns(
+            'Saturdays', ['Belfast', 'Moira', 'Lurgan'],
+            [['0700', '2355'], ['', 'a'], ['0740', '2430']])
+
+    def test_times_stored_as_minutes(self):
+        """Times are held as minutes since midnight, with a sentinel for blank cells
+        """
+        self.assertEqual(2, self.block.n_trips)
+        self.assertEqual(3, self.block.n_stops)
+        self.assertEqual([420, NO_STOP, 460], list(self.block.trip_times(0)))
+        self.assertEqual([460, 24 * 60 + 30], list(self.block.stop_times(2)))
+        self.assertIsNone(self.block.time(1, 1))
+
+    def test_to_dataset_round_trips_cells(self):
+        """Converting back to a dataset restores every cell, including non-time notes
+        """
+        dataset = self.block.to_dataset()
+        self.assertEqual(['Belfast', 'Moira', 'Lurgan'], dataset.headers)
+        self.assertEqual([('0700', '', '0740'), ('2355', 'a', '2430')], list(dataset))
+
+    def test_stop_names_are_interned(self):
+        """Stop names repeated across blocks share a single string
+        """
+        other = TimetableBlock.from_columns('Sundays', [''.join(['Bel', 'fast'])], [['0900']])
+        self.assertIs(self.block.stops[0], other.stops[0])
+
+    def test_timetable_blocks_match_times(self):
+        """Timetable.blocks holds the same data as Timetable.times and releases the page
+        """
+        timetable = Timetable('', BeautifulSoup(load_fixture('timetable.html'), 'html.parser'))
+        blocks = timetable.blocks
+        self.assertIsNone(timetable.soup)
+        self.assertEqual(['Mondays to Fridays', 'Saturdays'], [block.label for block in blocks])
+        self.assertEqual([(block.label, block.to_dataset().dict) for block in blocks],
+                         [(label, dataset.dict) for label, dataset in timetable.times])
+
+    def test_unpickled_blocks_are_interned(self):
+        """Blocks pickled elsewhere (e.g. another process) share stop names once loaded
+        """
+        copy = pickle.loads(pickle.dumps(self.block, pickle.HIGHEST_PROTOCOL))
+        self.assertIs(self.block.stops[0], copy.stops[0])
+        self.assertEqual(list(self.block.times), list(copy.times))
+
+
+class TestParsedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.page = load_fixture('timetable.html')
+
+    def tearDown(self):
+        configure_parsed_cache()
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch_timetable(self, url):
+        with mock.patch('opentranslink.routes.fetch', return_value=fake_response(200, self.page)):
+            return Timetable(url)
+
+    def test_identical_pages_parsed_once(self):
+        """A page already parsed by one Timetable isn't parsed again by another
+        """
+        configure_parsed_cache()
+        first = self.fetch_timetable('http://example.com/1')
+        first.blocks
+        with mock.patch('opentranslink.routes.parse_html') as parse_html:
+            second = self.fetch_timetable('http://example.com/1')
+            other_url = self.fetch_timetable('http://example.com/2')
+        self.assertIs(first.blocks, second.blocks)
+        self.assertEqual([(label, dataset.dict) for label, dataset in first.times],
+                         [(label, dataset.dict) for label, dataset in second.times])
+        # the same page at another url is parsed
+        self.assertEqual(1, parse_html.call_count)
+
+    def test_changed_pages_parsed_again(self):
+        """A page whose content changed is parsed again
+        """
+        configure_parsed_cache()
+        first = self.fetch_timetable('http://example.com/1')
+        first.blocks
+        self.page = self.page.replace('Saturdays', 'Sundays')
+        second = self.fetch_timetable('http://example.com/1')
+        self.assertEqual(['Mondays to Fridays', 'Sundays'], [block.label for block in second.blocks])
+        self.assertEqual(['Mondays to Fridays', 'Saturdays'], [block.label for block in first.blocks])
+
+    def test_disk_tier_shared_between_caches(self):
+        """Parsed pages are shared through the cache directory, e.g. with other processes
+        """
+        configure_parsed_cache(path=self.tmp_dir)
+        first = self.fetch_timetable('http://example.com/1')
+        first.blocks
+        cache = configure_parsed_cache(path=self.tmp_dir)
+        with mock.patch('opentranslink.routes.parse_html') as parse_html:
+            second = self.fetch_timetable('http://example.com/1')
+        self.assertFalse(parse_html.called)
+        self.assertEqual([block.content_hash() for block in first.blocks],
+                         [block.content_hash() for block in second.blocks])
+        self.assertEqual(1, cache.stats.hits)
+
+    def test_superseded_pages_pruned_from_disk(self):
+        """Storing a new version of a page removes the old one from the cache directory
+        """
+        cache = configure_parsed_cache(path=self.tmp_dir)
+        cache.set('http://example.com/1', 'old', ('first',), 10)
+        cache.set('http://example.com/1', 'new', ('second',), 10)
+        cache.set('http://example.com/2', 'old', ('other',), 10)
+        pickles = [name for _, _, names in os.walk(self.tmp_dir) for name in names if name.endswith('.pickle')]
+        self.assertEqual(['new.pickle', 'old.pickle'], sorted(pickles))
+
+        cache = configure_parsed_cache(path=self.tmp_dir)
+        self.assertIsNone(cache.get('http://example.com/1', 'old'))
+        self.assertEqual(('second',), cache.get('http://example.com/1', 'new'))
+        cache.clear()
+        self.assertIsNone(configure_parsed_cache(path=self.tmp_dir).get('http://example.com/2', 'old'))
+
+    def test_shared_blocks_immutable(self):
+        """Timetables sharing a parsed page get a tuple, which none of them can change under the others
+        """
+        configure_parsed_cache()
+        first = self.fetch_timetable('http://example.com/1')
+        self.assertIsInstance(first.blocks, tuple)
+        self.assertIsInstance(self.fetch_timetable('http://example.com/1').blocks, tuple)
+
+    def test_size_bounded(self):
+        """The least recently used pages are dropped once over max_bytes
+        """
+        cache = configure_parsed_cache(max_bytes=100)
+        cache.set('a', 'hash', 'first', 60)
+        cache.set('b', 'hash', 'second', 60)
+        self.assertIsNone(cache.get('a', 'hash'))
+        self.assertEqual('second', cache.get('b', 'hash'))
+        self.assertEqual(1, cache.stats.evictions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,13 @@ test_opentranslink
 Tests for `opentranslink` module.
 """
 # stdlib imports
+import shutil
+import tempfile
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import os, sys
 THIS_DIR = os.path.dirname(__file__)
@@ -16,9 +22,24 @@ PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
 if PARENT_DIR not in sys.path:
     sys.path = [ PARENT_DIR, ] + sys.path
 
+
 # local imports
 from opentranslink import InvalidServiceError
 from opentranslink import Service
+from opentranslink.routes import Route
+from opentranslink.services import NIRailwaysLiveInfoProvider
+from opentranslink.services import ServiceRegistry
+from opentranslink.services import TransportServiceTimetableProvider
+from opentranslink.services import register_services
+from opentranslink.services import route_page_fingerprint
+from tests.test_utils import fake_response
+
+FIXTURES_DIR = os.path.join(THIS_DIR, 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read().decode('utf-8')
 
 
 class TestServices(unittest.TestCase):
@@ -71,5 +92,219 @@ class TestServices(unittest.TestCase):
             service.routes()
 
 
+class TestPrefetchTimetables(unittest.TestCase):
+
+    def setUp(self):
+        self.service = Service('goldline')
+        self.service._routes = [
+            Route('273', 'Belfast - Lurgan', 'http://example.com/273'),
+            Route('251', 'Belfast - Newry', 'http://example.com/251'),
+            Route('212', 'Belfast - Derry', 'http://example.com/broken'),
+        ]
+        self.timetable_html = load_fixture('timetable.html')
+
+    def fake_fetch(self, method, url, **kwargs):
+        if url.endswith('broken'):
+            raise IOError('connection reset')
+        return fake_response(200, self.timetable_html)
+
+    def test_prefetch_populates_timetables(self):
+        """Prefetching parses every route's timetable and captures failures per route
+        """
+        progress = []
+        with mock.patch('opentranslink.routes.fetch', self.fake_fetch):
+            errors = self.service.prefetch_timetables(
+                max_workers=2, progress=lambda *args: progress.append(args))
+            self.assertEqual(['http://example.com/broken'], list(errors.keys()))
+            self.assertIsInstance(errors['http://example.com/broken'], IOError)
+            self.assertEqual([1, 2, 3], [p[0] for p in progress])
+            self.assertTrue(all(p[1] == 3 for p in progress))
+
+        # timetables are now served without touching the network
+        with mock.patch('opentranslink.routes.fetch') as fetch:
+            timetable = self.service.route('273').timetable
+            self.assertFalse(fetch.called)
+        self.assertEqual(['Mondays to Fridays', 'Saturdays'], [label for label, _ in timetable])
+
+    def test_failures_of_routes_sharing_a_code(self):
+        """Failures are kept for every route, even when routes share a code
+        """
+        routes = [Route('212', 'Belfast - Derry', 'http://example.com/212/broken'),
+                  Route('212', 'Derry - Belfast', 'http://example.com/212/inbound/broken')]
+        with mock.patch('opentranslink.routes.fetch', self.fake_fetch):
+            errors = self.service.prefetch_timetables(routes)
+        self.assertEqual(sorted(route.url for route in routes), sorted(errors))
+
+
+class TestRouteLookup(unittest.TestCase):
+
+    def setUp(self):
+        self.service = Service('goldline')
+        self.service._routes = [
+            Route('212', 'Belfast - Derry', 'http://example.com/212'),
+            Route('X1', 'Belfast - Dublin', 'http://example.com/x1'),
+            Route('261', 'Belfast - Enniskillen', 'http://example.com/261'),
+        ]
+
+    def test_route_lookup(self):
+        """Routes are found by code or name, ignoring case
+        """
+        self.assertEqual('X1', self.service.route('x1').code)
+        self.assertIsNone(self.service.route('X2'))
+        self.assertEqual(['212', None, 'X1'], [r and r.code for r in self.service.route_many(['212', 'nope', 'X1'])])
+        self.assertEqual('261', self.service.route_by_name('belfast - enniskillen').code)
+
+    def test_timetable_links_fixed(self):
+        """Timetable links ask for the HTML page, leaving the rest of the url alone
+        """
+        fix = self.service._fix_url_format
+        self.assertEqual('http://example.com/Timetable/?routeId=212&outputFormat=0',
+                         fix('http://example.com/Timetable/?routeId=212&outputFormat=1'))
+        self.assertEqual('http://example.com/Timetable/?outputFormat=0&routeId=212',
+                         fix('http://example.com/Timetable/?outputFormat=2&routeId=212'))
+        self.assertEqual('http://example.com/Timetable/?routeId=212&outputFormat=0',
+                         fix('http://example.com/Timetable/?routeId=212'))
+
+    def test_routes_are_compact(self):
+        """Routes have no __dict__ and share the start of their urls
+        """
+        first = Route('1', 'One', 'http://example.com/Timetable/?routeId=1')
+        second = Route('2', 'Two', 'http://example.com/Timetable/?routeId=2')
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertEqual('http://example.com/Timetable/?routeId=2', second.url)
+        self.assertIs(first._url_base, second._url_base)
+        second.url = 'http://example.com/other'
+        self.assertEqual('http://example.com/other', second.url)
+
+    def test_search_routes(self):
+        """Prefix search covers codes and names
+        """
+        self.assertEqual(['212', '261'], [r.code for r in self.service.search_routes('2')])
+        self.assertEqual(['212', 'X1'], [r.code for r in self.service.search_routes('Belfast - D')])
+        self.assertEqual(['212'], [r.code for r in self.service.search_routes('belfast', limit=1)])
+
+    def test_index_follows_refresh(self):
+        """Replacing the route list rebuilds the index
+        """
+        self.service.route('212')
+        self.service._routes = [Route('999', 'Nowhere', 'http://example.com/999')]
+        self.assertIsNone(self.service.route('212'))
+        self.assertEqual('999', self.service.route('999').code)
+
+
+class TestServiceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ServiceRegistry()
+        register_services(self.registry)
+
+    def built(self):
+        return sorted(name for name, registration in self.registry._registrations.items()
+                      if registration.provider is not None)
+
+    def test_providers_built_lazily_and_shared(self):
+        """Providers are only built when first used, then shared by every caller
+        """
+        self.assertEqual([], self.built())
+        metro = self.registry.preferred_service_for_uri_prefix('translink-northern-ireland:/metro')
+        self.assertEqual('metro', metro.subservice)
+        self.assertEqual(['official_translink_metro_timetable_provider'], self.built())
+        self.assertIs(metro, self.registry.preferred_service_for_uri_prefix('translink-northern-ireland:/metro/routes/1a'))
+
+    def test_scored_selection(self):
+        """The longest matching prefix wins, then the highest score
+        """
+        self.assertEqual(['nir_live_info_provider', 'official_translink_nir_timetable_provider'],
+                         self.registry.names_for_uri_prefix('translink-northern-ireland:/nir/stations/GVA'))
+        self.assertEqual(['official_translink_nir_timetable_provider'],
+                         self.registry.names_for_uri_prefix(
+                             'translink-northern-ireland:/nir', TransportServiceTimetableProvider))
+        self.registry.register('station_provider', NIRailwaysLiveInfoProvider,
+                               {'translink-northern-ireland:/nir/stations': -5}, service_name='nir')
+        self.assertEqual('station_provider',
+                         self.registry.names_for_uri_prefix('translink-northern-ireland:/nir/stations/GVA')[0])
+        self.assertEqual([], self.registry.names_for_uri_prefix('translink-northern-ireland:/nirvana'))
+
+    def test_unknown_services(self):
+        """Unregistered names and URIs nothing serves raise InvalidServiceError
+        """
+        with self.assertRaises(InvalidServiceError):
+            self.registry.preferred_service_for_uri_prefix('somewhere-else:/metro')
+        self.registry.deregister('nir_live_info_provider')
+        with self.assertRaises(InvalidServiceError):
+            self.registry.provider('nir_live_info_provider')
+        self.assertEqual(['official_translink_nir_timetable_provider'],
+                         self.registry.names_for_uri_prefix('translink-northern-ireland:/nir'))
+
+    def test_station_uris(self):
+        """NI Railways stations are addressed by URI
+        """
+        provider = self.registry.preferred_service_for_uri_prefix('translink-northern-ireland:/nir')
+        self.assertEqual('GVA', provider.station_id('translink-northern-ireland:/nir/stations/GVA'))
+        with self.assertRaises(KeyError):
+            provider.station_id('translink-northern-ireland:/metro/stations/GVA')
+
+
+class TestSyncRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, 'goldline.json')
+        self.pages = {'get': load_fixture('routes_page1.html'), 'post': load_fixture('routes_page2.html')}
+        self.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fake_fetch(self, method, url, **kwargs):
+        self.requests.append(method)
+        return fake_response(200, self.pages[method])
+
+    def sync(self, **kwargs):
+        self.requests = []
+        with mock.patch('opentranslink.services.fetch', self.fake_fetch):
+            return Service('goldline').sync_routes(self.state_path, **kwargs)
+
+    def test_first_sync_adds_everything(self):
+        """The first sync walks every page and reports every route as added
+        """
+        diff = self.sync()
+        self.assertEqual(['212', '251', '261', '273', '274'], sorted(route.code for route in diff.added))
+        self.assertEqual(([], []), (diff.removed, diff.changed))
+        self.assertEqual(['get', 'post'], self.requests)
+
+    def test_unchanged_first_page_stops_paging(self):
+        """When the first page is unchanged the saved route list is used as is
+        """
+        self.sync()
+        # the viewstate changes on every request, but that shouldn't count
+        self.pages['get'] = self.pages['get'].replace('page1"', 'page1-again"')
+        service = Service('goldline')
+        with mock.patch('opentranslink.services.fetch', self.fake_fetch):
+            self.requests = []
+            diff = service.sync_routes(self.state_path)
+        self.assertEqual(['get'], self.requests)
+        self.assertEqual(([], [], []), diff)
+        self.assertEqual(5, len(service.routes()))
+
+    def test_changed_pages_are_diffed(self):
+        """Changes on later pages are found when walking every page
+        """
+        self.sync()
+        self.pages['post'] = self.pages['post'].replace('Belfast - Lurgan', 'Belfast - Craigavon').replace(
+            '<td>274</td>', '<td>275</td>')
+        diff = self.sync(check_pages=None)
+        self.assertEqual(['get', 'post'], self.requests)
+        self.assertEqual(['275'], [route.code for route in diff.added])
+        self.assertEqual(['274'], [route.code for route in diff.removed])
+        self.assertEqual([('273', 'Belfast - Craigavon')], [(route.code, route.name) for route in diff.changed])
+
+    def test_fingerprint_without_end_marker(self):
+        """A page cut off inside the route table still fingerprints all of what's there
+        """
+        truncated = self.pages['get'][:self.pages['get'].find('</table>', self.pages['get'].find('rgMasterTable'))]
+        self.assertNotEqual(route_page_fingerprint(truncated + '1'), route_page_fingerprint(truncated + '2'))
+
+
 if __name__ == '__main__':
     unittest.main()
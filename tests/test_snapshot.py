@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_snapshot
+----------------------------------
+
+Tests for `opentranslink.snapshot` module.
+"""
+# stdlib imports
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# local imports
+from opentranslink import Service
+from opentranslink.routes import Route
+from opentranslink.snapshot import IncompleteSnapshotError
+from opentranslink.snapshot import MissingSnapshotError
+from opentranslink.snapshot import MissingTimetableError
+from opentranslink.snapshot import SnapshotStore
+from tests.test_planner import make_route
+
+
+class TestSnapshotStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = SnapshotStore(os.path.join(self.tmp_dir, 'snapshot.sqlite'))
+        self.service = Service('goldline')
+        self.service._routes = [
+            make_route('212', 'Mondays to Fridays', ['Belfast', 'Moira', 'Lurgan'],
+                       [['0700', '2355'], ['', 'a'], ['0740', '2430']]),
+            make_route('251', 'Saturdays', ['Lisburn', 'Hillsborough'], [['0831'], ['0845']]),
+        ]
+        self.assertEqual({}, self.service.save_snapshot(self.store))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_offline_service(self):
+        """An offline service serves routes and timetables identical to the originals without fetching
+        """
+        offline = Service('goldline', snapshot=self.store)
+        with mock.patch('opentranslink.utils.fetch', side_effect=AssertionError('fetched')), \
+                mock.patch('opentranslink.routes.fetch', side_effect=AssertionError('fetched')):
+            routes = offline.routes()
+            route = offline.route('212')
+            times = route.timetable
+        self.assertEqual([('212', '212'), ('251', '251')], [(r.code, r.name) for r in routes])
+        original = self.service.route('212').timetable
+        self.assertEqual([(label, dataset.dict) for label, dataset in original],
+                         [(label, dataset.dict) for label, dataset in times])
+        self.assertEqual('a', route.compact_timetable[0].cell(1, 1))
+
+    def test_timetables_decoded_lazily(self):
+        """Only the timetables actually used are read from the store
+        """
+        routes = Service('goldline', snapshot=self.store).routes()
+        with mock.patch.object(self.store, 'load_blocks', wraps=self.store.load_blocks) as load_blocks:
+            routes[1].compact_timetable
+            routes[1].compact_timetable
+        self.assertEqual(1, load_blocks.call_count)
+        self.assertIsNone(routes[0]._timetable._blocks)
+
+    def test_missing_service(self):
+        """Offline services without a snapshot raise rather than going online
+        """
+        with self.assertRaises(MissingSnapshotError):
+            Service('metro', snapshot=self.store).routes()
+
+    def test_save_replaces_snapshot(self):
+        """Saving a service again replaces everything stored for it
+        """
+        self.service._routes = self.service._routes[1:]
+        self.service.save_snapshot(self.store)
+        self.assertEqual(['251'], [r.code for r in Service('goldline', snapshot=self.store).routes()])
+
+    def test_failed_routes_keep_old_snapshot(self):
+        """A save with failed routes leaves the old snapshot in place and the routes pending
+        """
+        self.service._routes = self.service._routes + [Route('261', '261', 'http://example.com/261')]
+        with mock.patch('opentranslink.routes.fetch', side_effect=IOError('connection reset')):
+            errors = self.service.save_snapshot(self.store)
+        self.assertEqual(['http://example.com/261'], list(errors.keys()))
+        self.assertEqual(['212', '251'], [r.code for r in Service('goldline', snapshot=self.store).routes()])
+        self.assertEqual([(2, '261', 'http://example.com/261')], self.store.pending_routes('goldline'))
+        with self.assertRaises(IncompleteSnapshotError):
+            self.store.finish_service('goldline')
+
+    def test_failed_routes_allowed(self):
+        """With allow_failures the new snapshot is used, and failed routes raise when used
+        """
+        self.service._routes = self.service._routes + [Route('261', '261', 'http://example.com/261')]
+        with mock.patch('opentranslink.routes.fetch', side_effect=IOError('connection reset')):
+            self.service.save_snapshot(self.store, allow_failures=True)
+        routes = Service('goldline', snapshot=self.store).routes()
+        self.assertEqual(['212', '251', '261'], [r.code for r in routes])
+        with self.assertRaises(MissingTimetableError):
+            routes[2].timetable
+
+    def test_reads_not_blocked_while_fetching(self):
+        """The current snapshot can be read while a new one is being fetched
+        """
+        created_at = self.store.created_at('goldline')
+        seen = []
+
+        def fetch(method, url, **kwargs):
+            # would deadlock if the store were locked for the whole save
+            seen.append((self.store.created_at('goldline'), len(self.store.load_routes('goldline'))))
+            raise IOError('connection reset')
+
+        self.service._routes = self.service._routes + [Route('261', '261', 'http://example.com/261')]
+        with mock.patch('opentranslink.routes.fetch', side_effect=fetch):
+            self.service.save_snapshot(self.store)
+        self.assertEqual([(created_at, 2)], seen)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_utils
+----------------------------------
+
+Tests for `opentranslink.utils` module.
+"""
+# stdlib imports
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import os, sys
+THIS_DIR = os.path.dirname(__file__)
+PARENT_DIR = os.path.abspath(os.path.join(THIS_DIR, ".."))
+if PARENT_DIR not in sys.path:
+    sys.path = [ PARENT_DIR, ] + sys.path
+
+# third-party imports
+import requests
+
+# local imports
+from opentranslink.utils import HTTPSession
+
+
+def fake_response(status_code, text=''):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = text.encode('utf-8')
+    response._content_consumed = True
+    response.url = 'http://example.com/'
+    return response
+
+
+class TestHTTPSession(unittest.TestCase):
+
+    def setUp(self):
+        self.session = HTTPSession(max_retries=2, backoff_factor=0)
+
+    def test_retries_server_errors(self):
+        """5xx responses are retried until a request succeeds
+        """
+        responses = [fake_response(503), fake_response(502), fake_response(200, 'ok')]
+        with mock.patch.object(self.session.session, 'request', side_effect=responses) as request:
+            response = self.session.request('get', 'http://example.com/')
+        self.assertEqual('ok', response.text)
+        self.assertEqual(3, request.call_count)
+
+    def test_retries_connection_errors(self):
+        """Connection errors are retried, then raised once retries run out
+        """
+        error = requests.ConnectionError('connection reset')
+        with mock.patch.object(self.session.session, 'request', side_effect=error) as request:
+            with self.assertRaises(requests.ConnectionError):
+                self.session.request('get', 'http://example.com/')
+        self.assertEqual(3, request.call_count)
+
+    def test_client_errors_not_retried(self):
+        """4xx responses are raised straight away
+        """
+        with mock.patch.object(self.session.session, 'request', return_value=fake_response(404)) as request:
+            with self.assertRaises(requests.HTTPError):
+                self.session.request('get', 'http://example.com/')
+        self.assertEqual(1, request.call_count)
+
+    def test_default_timeout(self):
+        """Requests get the session's timeout unless one is given
+        """
+        with mock.patch.object(self.session.session, 'request', return_value=fake_response(200)) as request:
+            self.session.request('get', 'http://example.com/')
+            self.session.request('get', 'http://example.com/', timeout=1)
+        self.assertEqual(self.session.timeout, request.call_args_list[0][1]['timeout'])
+        self.assertEqual(1, request.call_args_list[1][1]['timeout'])
+
+
+if __name__ == '__main__':
+    unittest.main()